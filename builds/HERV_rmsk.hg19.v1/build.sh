@@ -4,13 +4,28 @@
 which sortgtf.py
 if [[ "$?" != 0 ]]; then
     echo "Setting PATH"
-    export PATH=$(dirname $0)/scripts:$PATH
-    export PYTHONPATH=$(dirname $0)/python:$PYTHONPATH
+    # Use the tools in the repository, the copies in scripts/ and python/ do not
+    # support the options used below (i.e. rmsk2gtf.py --families)
+    TOOLS=$(cd $(dirname $0)/../../tools && pwd)
+    export PATH=$TOOLS:$PATH
+    export PYTHONPATH=$TOOLS:$PYTHONPATH
 fi
 
 # This file is used to specify the chromosome order, used in sorting
 CHROM=chrom.sizes
 
+# If the UCSC rmsk table dump is present, RepeatMasker hits for all families are
+# converted in one pass and build_family.sh skips the download and conversion steps
+if [[ -e rmsk.txt.gz ]]; then
+    gunzip -c rmsk.txt.gz | \
+        rmsk2gtf.py --no_header --chroms $CHROM --families families.tsv
+    status=("${PIPESTATUS[@]}")
+    if [[ ${status[0]} != 0 || ${status[1]} != 0 ]]; then
+        echo "Converting rmsk.txt.gz failed" && exit 1
+    fi
+    export RMSK_CONVERTED=true
+fi
+
 # Build annotations for each family, auto mode
 # resolve.[FAM].json must be present for families with overlapping annotations
 sed "s/$(printf '\t')/ /g" families.tsv | while read line; do
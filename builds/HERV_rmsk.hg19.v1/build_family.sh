@@ -23,37 +23,46 @@ mkdir -p $FAM
 which assembleHERV.py
 if [[ "$?" != 0 ]]; then
     echo "Setting PATH"
-    # Path to repository root
-    export PATH=$(dirname $0)/scripts:$PATH
-    export PYTHONPATH=$(dirname $0)/python:$PYTHONPATH
+    # Use the tools in the repository, the copies in scripts/ and python/ do not
+    # support the options used below (i.e. --model_lengths)
+    TOOLS=$(cd $(dirname $0)/../../tools && pwd)
+    export PATH=$TOOLS:$PATH
+    export PYTHONPATH=$TOOLS:$PYTHONPATH
 fi
 # Chromosome index
 CHROM=chrom.sizes
 
 ### Step 1: Download RepeatMasker tracks from UCSC #######################################
-# Internal model
-[[ ! -e $FAM/$intmodel.txt ]] && mysql -h genome-mysql.cse.ucsc.edu -u genome -D hg19 -A \
-    -e "SELECT * FROM rmsk WHERE repName = '$intmodel';" > $FAM/$intmodel.txt
-
-# LTR
-for model in $models; do
-    echo "Query: $model"
-    [[ ! -e $FAM/LTR.$model.txt ]] && mysql -h genome-mysql.cse.ucsc.edu -u genome -D hg19 -A \
-        -e "SELECT * FROM rmsk WHERE repName = '$model';" > $FAM/LTR.$model.txt
-done
-
-wc -l $FAM/*.txt
-     
-### Step 2: Convert RepeatMasker tables to GTF ###########################################
-rmsk2gtf.py --chroms $CHROM --gene_region internal $FAM/$intmodel.txt | \
-    fixRmskCoords.py | \
-    sortgtf.py --chrom $CHROM > $FAM/$intmodel.gtf
+# Skipped if build.sh converted RepeatMasker hits for all families
+if [[ $RMSK_CONVERTED != true ]]; then
+    # Internal model
+    [[ ! -e $FAM/$intmodel.txt ]] && mysql -h genome-mysql.cse.ucsc.edu -u genome -D hg19 -A \
+        -e "SELECT * FROM rmsk WHERE repName = '$intmodel';" > $FAM/$intmodel.txt
+
+    # LTR
+    for model in $models; do
+        echo "Query: $model"
+        [[ ! -e $FAM/LTR.$model.txt ]] && mysql -h genome-mysql.cse.ucsc.edu -u genome -D hg19 -A \
+            -e "SELECT * FROM rmsk WHERE repName = '$model';" > $FAM/LTR.$model.txt
+    done
+
+    wc -l $FAM/*.txt
+fi
 
-for model in $models; do
-    rmsk2gtf.py --chroms $CHROM --gene_region ltr $FAM/LTR.$model.txt | \
-        fixRmskCoords.py | \
-        sortgtf.py --chrom $CHROM > $FAM/LTR.$model.gtf
-done
+### Step 2: Convert RepeatMasker tables to GTF ###########################################
+if [[ $RMSK_CONVERTED != true ]]; then
+    # Model lengths are saved to $FAM/model_lengths.tsv and used by later steps
+    rm -f $FAM/model_lengths.tsv
+    rmsk2gtf.py --chroms $CHROM --gene_region internal $FAM/$intmodel.txt | \
+        fixRmskCoords.py --model_lengths $FAM/model_lengths.tsv | \
+        sortgtf.py --chrom $CHROM > $FAM/$intmodel.gtf
+
+    for model in $models; do
+        rmsk2gtf.py --chroms $CHROM --gene_region ltr $FAM/LTR.$model.txt | \
+            fixRmskCoords.py --model_lengths $FAM/model_lengths.tsv | \
+            sortgtf.py --chrom $CHROM > $FAM/LTR.$model.gtf
+    done
+fi
 
 ### Step 3: Merge internal hits ##########################################################
 mergeHits.py --prefix $FAM --longdist 10000 $FAM/$intmodel.gtf | \
@@ -66,7 +75,7 @@ grep 'span' $FAM/internal.merged.gtf | \
     bedtools intersect -wo -s -a - -b $FAM/LTR.*.gtf > $FAM/ltr.intersect.gtf
 
 ### Step 5: Assemble HERV proviruses #####################################################
-assembleHERV.py $FAM/internal.merged.gtf $FAM/ltr.intersect.gtf | \
+assembleHERV.py --model_lengths $FAM/model_lengths.tsv $FAM/internal.merged.gtf $FAM/ltr.intersect.gtf | \
     sortgtf.py --chrom $CHROM > $FAM/assembled.gtf
 
 ### Step 6: Filter short loci ############################################################
@@ -102,6 +111,7 @@ else
     # Polishing
     polishHERVLoci.py \
         --resolve_file resolve.$FAM.json \
+        --model_lengths $FAM/model_lengths.tsv \
         $FAM/filtered.gtf | \
         sortgtf.py --chrom $CHROM > $FAM/polished.gtf
 fi
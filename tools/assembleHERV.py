@@ -1,8 +1,10 @@
 #! /usr/bin/env python
 
 from collections import defaultdict
+import numpy as np
 import utils
 from utils import GTFLine
+from fixRmskCoords import replace_attr
 
 def calculate_internal_coverage(_locus):
     ''' Calculate number of internal model bases covered in locus
@@ -23,10 +25,7 @@ def locus_category(_locus):
     ''' Determine the category of locus
         Check whether locus begins and/or ends with LTR.
     '''
-    if _locus[0].strand == '+':
-        _locus.sort(key=lambda x:x.start)
-    else:
-        _locus.sort(key=lambda x:x.end, reverse=True)
+    _locus.sort(key=utils.position_key(_locus[0].strand))
     # Determine label
     regions = utils.simplify_list(a.attr['geneRegion'] for a in _locus)
     if regions[0] != 'ltr' and regions[-1] != 'ltr':
@@ -38,68 +37,334 @@ def locus_category(_locus):
     else:
         return 'unknown'
 
-def main(args):
-    # Load the internal GTF
-    combined_gtf = [GTFLine(l) for l in utils.tab_line_gen(args.internalGTF)]
-    combined_gtf = [g for g in combined_gtf if not g.feature.startswith('span')]
+def assemble_locus(locid, locus, model_lengths):
+    ''' Assemble locus from internal and LTR annotations
+        Returns list with spanning annotation followed by annotations sorted by
+        position.
+    '''
+    # Remove duplicate annotations
+    locus = utils.remove_dups(locus)
+    # Adjust overlaps
+    locus = utils.adjust_overlaps(locus)
+    # Determine category
+    category = locus_category(locus)
+    # Add information to all annotations
+    strand = set([a.strand for a in locus])
+    if len(strand) == 1 and '-' in locus:
+        locus.sort(key=utils.position_key('-'))
+    else:
+        locus.sort(key=utils.position_key('+'))
+    for i,a in enumerate(locus):
+        a.source = category
+        a.attr['exon_number'] = i+1
     
-    # Load the LTR GTF
-    for l in utils.tab_line_gen(args.ltrGTF):
-        l_b = GTFLine(l[-10:])
-        l_b.attr['locus'] = GTFLine(l[:9]).attr['locus']
-        combined_gtf.append(l_b)
+    # Create spanning annotation
+    spanning = utils.create_spanning(locus)        
+    # Calculate model coverage and percent
+    internal_model = get_internal_model(locus)
+    model_cov = calculate_internal_coverage(locus)
+    model_pct = min(100, (float(model_cov) / model_lengths[internal_model])*100)
+    spanning.attr = {'locus': locid ,
+                     'category': category,
+                     'model_cov': model_cov,
+                     'model_pct': float('%.1f' % model_pct),
+                     'exons':len(locus)
+                     }
+    return [spanning] + sorted(locus,key=utils.position_key('+'))
 
-    model_lengths = utils.guess_rmsk_model_lengths(combined_gtf)
-    
-    # Organize by locus    
-    byloc = defaultdict(list)
-    for g in combined_gtf:
-        byloc[g.attr['locus']].append(g)
+### Batch assembly #######################################################################
+# Attribute string of spanning annotations, in the order written by GTFLine
+_SPANATTRS = {'locus': None, 'category': None, 'model_cov': None, 'model_pct': None, 'exons': None}
+SPAN_ATTR_FORMAT = ' '.join('%s "%%(%s)s";' % (k,k) for k in
+                            [k for k in GTFLine.ATTRORDER if k in _SPANATTRS] +
+                            [k for k in _SPANATTRS if k not in GTFLine.ATTRORDER])
+
+def _group_bounds(keys):
+    ''' Start of each run of equal values in sorted keys, and the end of the last run '''
+    return np.r_[0, np.flatnonzero(keys[1:] != keys[:-1]) + 1, len(keys)]
+
+def _position_order(loc, key1, key2, idrank):
+    ''' Order rows by locus, key1, key2, then id, as with utils.position_key '''
+    return np.lexsort((idrank, key2, key1, loc))
+
+def assemble_arrays(table, model_lengths):
+    ''' Assemble all loci in GTFTable at once
+        table has the internal and LTR annotations of all loci, without spanning
+        annotations, with "locus" and "id" attributes (create with
+        GTFTable.from_rows(rows, catattrs=['id'])). The steps of assemble_locus are
+        applied to all loci with grouped array operations, sorting records by locus
+        and position instead of sorting each locus. Annotations at the same position
+        are ordered as with utils.position_key.
+        Returns (table without duplicates, dictionary of arrays). Arrays "start",
+        "end", "repStart", "repLeft", "adjusted" (True if trimmed) and "exon_number"
+        have one value per row of the table. "order" sorts rows by locus and
+        position, and loci are order[bounds[i]:bounds[i+1]]. Arrays "locus" (code),
+        "category", "model_cov", "model_pct" (not rounded), "span_start" and
+        "span_end" have one value per locus, in order of locus code.
+    '''
+    assert (table['locus'] >= 0).all(), "All annotations must have a locus"
+    assert (table['id'] >= 0).all(), "All annotations must have an id"
+    # Remove duplicate annotations, the last annotation with each id is kept
+    loc, ids = table['locus'], table['id']
+    o = np.lexsort((np.arange(len(table)), ids, loc))
+    last = np.r_[(loc[o][1:] != loc[o][:-1]) | (ids[o][1:] != ids[o][:-1]), True]
+    table = table.take(np.sort(o[last]))
+
+    loc = table['locus']
+    start, end = table['start'].copy(), table['end'].copy()
+    repstart, repleft, repend = table['repStart'].copy(), table['repLeft'].copy(), table['repEnd']
+    nloc = len(table.levels['locus'])
+    locs, firstrow = np.unique(loc, return_index=True)
+    lplus = np.zeros(nloc, dtype=bool)
+    lplus[locs] = table['strand'][firstrow] == table.code('strand', '+')
+    plus = lplus[loc]
+    # Rank of id labels, for breaking ties between annotations at the same position
+    idlabels = table.levels['id']
+    idrank = np.empty(len(idlabels), dtype=np.int64)
+    idrank[np.argsort(np.array(idlabels, dtype=str), kind='mergesort')] = np.arange(len(idlabels))
+    idrank = idrank[table['id']]
+
+    # Adjust overlaps, in order of position on the strand of the locus
+    o1 = _position_order(loc, np.where(plus, start, -end), np.where(plus, end, -start), idrank)
+    cur, prev = o1[1:], o1[:-1]
+    same = loc[cur] == loc[prev]
+    gdist = np.where(plus[cur], start[cur] - end[prev], start[prev] - end[cur])
+    adj = same & (gdist <= 0)
+    fixp, fixm = cur[adj & plus[cur]], cur[adj & ~plus[cur]]
+    start[fixp] -= gdist[adj & plus[cur]] - 1
+    repstart[fixp] -= gdist[adj & plus[cur]]
+    end[fixm] += gdist[adj & ~plus[cur]] - 1
+    repleft[fixm] -= gdist[adj & ~plus[cur]]
+    adjusted = np.zeros(len(table), dtype=bool)
+    adjusted[cur[adj]] = True
+
+    # Category from the first and last region on the strand
+    o2 = _position_order(loc, np.where(plus, start, -end), np.where(plus, end, -start), idrank)
+    b2 = _group_bounds(loc[o2])
+    isltr = table['geneRegion'] == table.code('geneRegion', 'ltr')
+    firstltr, lastltr = isltr[o2[b2[:-1]]], isltr[o2[b2[1:] - 1]]
+    category = np.where(firstltr & lastltr, 'prototype', np.where(firstltr | lastltr, 'oneside', 'internal'))
+
+    # Exon numbers in order of position
+    o3 = _position_order(loc, start, end, idrank)
+    b3 = _group_bounds(loc[o3])
+    gloc = loc[o3[b3[:-1]]]
+    exon = np.arange(len(o3)) - np.repeat(b3[:-1], np.diff(b3)) + 1
+
+    # Model coverage of the internal model
+    internal = table['geneRegion'][o3] == table.code('geneRegion', 'internal')
+    cov = np.where(lplus[loc[o3]], repend[o3] - repstart[o3], repend[o3] - repleft[o3])
+    cov = np.add.reduceat(np.where(internal, cov, 0), b3[:-1])
+    names = np.where(internal, table['repName'][o3], -1)
+    namemax = np.maximum.reduceat(names, b3[:-1])
+    namemin = np.minimum.reduceat(np.where(internal, names, np.iinfo(names.dtype).max), b3[:-1])
+    assert (namemax >= 0).all() and (namemin == namemax).all(), "Each locus must have one internal model"
+    lens = np.array([model_lengths[table.levels['repName'][c]] for c in namemax], dtype=np.float64)
+    pct = np.minimum(100, cov / lens * 100)
+    spanstart, spanend = np.minimum.reduceat(start[o3], b3[:-1]), np.maximum.reduceat(end[o3], b3[:-1])
+
+    exon_number = np.zeros(len(table), dtype=np.int64)
+    exon_number[o3] = exon
+    return table, {'start': start, 'end': end, 'repStart': repstart, 'repLeft': repleft,
+                   'adjusted': adjusted, 'exon_number': exon_number, 'order': o3, 'bounds': b3,
+                   'locus': gloc, 'category': category, 'model_cov': cov, 'model_pct': pct,
+                   'span_start': spanstart, 'span_end': spanend}
+
+def assemble_table(table, model_lengths):
+    ''' Assemble all loci in GTFTable at once, see assemble_arrays
+        Generates (locus id, lines) for each locus in order of first appearance, where
+        lines are the spanning annotation followed by annotations sorted by position.
+    '''
+    if len(table) == 0:
+        return
+    table, asm = assemble_arrays(table, model_lengths)
+    o3, b3, gloc, category, cov, pct = [asm[k] for k in ('order', 'bounds', 'locus', 'category', 'model_cov', 'model_pct')]
+    start, end, repstart, repleft, adjusted = [asm[k] for k in ('start', 'end', 'repStart', 'repLeft', 'adjusted')]
+    spanstart, spanend = asm['span_start'], asm['span_end']
+    exon = asm['exon_number'][o3]
+
+    # Format lines
+    lv = table.levels
+    def _labels(col, idx):
+        return np.array(lv[col], dtype=object)[table[col][idx]]
+    first = o3[b3[:-1]]
+    spans = []
+    for g,f in enumerate(zip(_labels('chrom', first), category, spanstart, spanend,
+                             _labels('strand', first), _labels('frame', first))):
+        attrs = {'locus': lv['locus'][gloc[g]], 'category': category[g], 'model_cov': cov[g],
+                 'model_pct': float('%.1f' % pct[g]), 'exons': b3[g+1] - b3[g]}
+        spans.append('%s\t%s\tspan\t%d\t%d\t.\t%s\t%s\t' % f + SPAN_ATTR_FORMAT % attrs)
+    attrs = [table.attrstrs[i] for i in o3]
+    for k in np.flatnonzero(adjusted[o3]):
+        i = o3[k]
+        a = replace_attr(' ' + attrs[k], 'repStart', table['repStart'][i], repstart[i])
+        attrs[k] = replace_attr(a, 'repLeft', table['repLeft'][i], repleft[i])[1:]
+    rows = zip(_labels('chrom', o3), category[np.repeat(np.arange(len(gloc)), np.diff(b3))],
+               _labels('feature', o3), start[o3], end[o3],
+               table.score_strs(o3),
+               _labels('strand', o3), _labels('frame', o3), attrs, exon)
+    lines = ['%s\t%s\t%s\t%d\t%d\t%s\t%s\t%s\t%s exon_number "%d";' % r for r in rows]
+
+    # Locus codes are in order of first appearance
+    for g,l in enumerate(gloc.tolist()):
+        yield lv['locus'][l], [spans[g]] + lines[b3[g]:b3[g+1]]
+
+def join_flanking_ltrs(spans, ltrgtf, flank, chromsizes):
+    ''' Find LTR hits overlapping flanked internal spans
+        Returns dictionary mapping locus to list of LTR hits. Hits are copied for each
+        locus they overlap.
+    '''
+    ltrs = defaultdict(list)
+    for spn, hits in utils.flank_join(spans, ltrgtf, flank, chromsizes):
+        for h in hits:
+            h = h.copy()
+            h.attr['locus'] = spn.attr['locus']
+            ltrs[spn.attr['locus']].append(h)
+    return ltrs
+
+def joined_ltr_groups(infile):
+    ''' Generate (span, [LTR hits]) from bedtools intersect -wo output
+        Consecutive lines with the same span are grouped, so each span and each LTR
+        hit is parsed once. Hits are given the locus attribute of the span.
+    '''
+    key, span, hits = None, None, []
+    for l in utils.tab_line_gen(infile):
+        if l[:9] != key:
+            if span is not None:
+                yield span, hits
+            key, span, hits = l[:9], GTFLine(l[:9]), []
+        h = GTFLine(l[-10:-1])
+        h.attr['locus'] = span.attr['locus']
+        hits.append(h)
+    if span is not None:
+        yield span, hits
+
+class JoinedLTRs(object):
+    ''' LTR hits for each locus from position-sorted bedtools intersect -wo output
+        Loci are requested as they are read from the sorted internal GTF. Groups are
+        read until the next flanked span starts after the requested locus, so only
+        hits of loci that have started but not yet been requested are kept.
+    '''
+    def __init__(self, infile):
+        self.groups = joined_ltr_groups(infile)
+        self.nextgroup = next(self.groups, None)
+        self.pending = {}
+        self.chroms = set()
+        self.chrom = None
     
-    for locid,locus in byloc.iteritems(): 
-        # Remove duplicate annotations
-        locus = utils.remove_dups(locus)
-        # Adjust overlaps
-        locus = utils.adjust_overlaps(locus)
-        # Determine category
-        category = locus_category(locus)
-        # Add information to all annotations
-        strand = set([a.strand for a in locus])
-        if len(strand) == 1 and '-' in locus:
-            locus.sort(key=lambda x:x.end, reverse=True)
+    def pop(self, locid, locus):
+        ''' Return LTR hits for locus '''
+        chrom, start = locus[0].chrom, min(g.start for g in locus)
+        if chrom != self.chrom:
+            # Loci on the previous chromosome are complete
+            self.pending = {}
+            self.chroms.add(chrom)
+            self.chrom = chrom
+        while self.nextgroup is not None:
+            span, hits = self.nextgroup
+            if span.chrom not in self.chroms or (span.chrom == chrom and span.start > start):
+                break
+            if span.chrom == chrom:
+                self.pending.setdefault(span.attr['locus'], []).extend(hits)
+            self.nextgroup = next(self.groups, None)
+        return self.pending.pop(locid, [])
+
+def main_batch(args):
+    ''' Assemble all loci in one table with assemble_table
+        The internal GTF and LTR annotations are parsed once into a GTFTable.
+    '''
+    internal, spans = [], []
+    for l in utils.tab_line_gen(args.internalGTF):
+        (spans if l[2].startswith('span') else internal).append(l)
+    if args.flank is None:
+        # Loci are taken from the attributes of the spans on each line
+        joined = list(utils.tab_line_gen(args.ltrGTF))
+        jspans = utils.GTFTable.from_rows([l[:9] for l in joined])
+        locids = [jspans.levels['locus'][c] for c in jspans['locus']]
+        ltrs = [l[-10:-2] + ['locus "%s"; %s' % (locid, l[-2])] for locid,l in zip(locids, joined)]
+    else:
+        chromsizes = utils.read_chrom_sizes(args.chrom_sizes) if args.chrom_sizes else None
+        ltrgtf = [GTFLine(l) for l in utils.tab_line_gen(args.ltrGTF)]
+        joined = join_flanking_ltrs([GTFLine(l) for l in spans], ltrgtf, args.flank, chromsizes)
+        ltrs = [g.fmt() for locid in joined for g in joined[locid]]
+    table = utils.GTFTable.from_rows(internal + ltrs, catattrs=['id'])
+    # LTRs of loci without internal annotations are not assembled
+    ninternal = len(internal)
+    keep = np.ones(len(table), dtype=bool)
+    hasint = np.zeros(len(table.levels['locus']), dtype=bool)
+    hasint[table['locus'][:ninternal]] = True
+    keep[ninternal:] = hasint[table['locus'][ninternal:]]
+    if args.model_lengths is None:
+        model_lengths = utils.guess_rmsk_model_lengths(table.take(np.arange(ninternal)))
+    else:
+        model_lengths = utils.load_model_lengths(args.model_lengths)
+    for locid,lines in assemble_table(table.filter(keep), model_lengths):
+        utils.write_locus(args.outfile, locid, lines)
+
+def main(args):
+    if args.batch:
+        return main_batch(args)
+    # The internal GTF is read twice, first to get model lengths and spans then to
+    # assemble loci. Only one pass is needed if model lengths are provided and
+    # flanking LTRs are from bedtools.
+    if args.model_lengths is not None and args.flank is None:
+        model_lengths = utils.load_model_lengths(args.model_lengths)
+        secondpass = args.internalGTF
+    else:
+        firstpass, secondpass = utils.two_pass(args.internalGTF)
+        internal_gtf = (GTFLine(l) for l in utils.tab_line_gen(firstpass))
+        spans = []
+        def _keep_spans(gtf):
+            for g in gtf:
+                if g.feature.startswith('span'): spans.append(g)
+                yield g
+        if args.model_lengths is None:
+            model_lengths = utils.guess_rmsk_model_lengths(_keep_spans(internal_gtf))
         else:
-            locus.sort(key=lambda x:x.start)
-        for i,a in enumerate(locus):
-            a.source = category
-            a.attr['exon_number'] = i+1
-        
-        # Create spanning annotation
-        spanning = utils.create_spanning(locus)        
-        # Calculate model coverage and percent
-        internal_model = get_internal_model(locus)
-        model_cov = calculate_internal_coverage(locus)
-        model_pct = min(100, (float(model_cov) / model_lengths[internal_model])*100)
-        spanning.attr = {'locus': locid ,
-                         'category': category,
-                         'model_cov': model_cov,
-                         'model_pct': '%.1f' % model_pct,
-                         'exons':len(locus)
-                         }
-        
-        print >>args.outfile, '### %s ###' % locid
-        print >>args.outfile, spanning
-        print >>args.outfile, '\n'.join(str(_) for _ in sorted(locus,key=lambda x:x.start))
+            model_lengths = utils.load_model_lengths(args.model_lengths)
+            spans = [g for g in internal_gtf if g.feature.startswith('span')]
+    
+    # LTR hits for each locus
+    if args.flank is None:
+        get_ltrs = JoinedLTRs(args.ltrGTF).pop
+    else:
+        chromsizes = utils.read_chrom_sizes(args.chrom_sizes) if args.chrom_sizes else None
+        ltrgtf = [GTFLine(l) for l in utils.tab_line_gen(args.ltrGTF)]
+        ltrs = join_flanking_ltrs(spans, ltrgtf, args.flank, chromsizes)
+        get_ltrs = lambda locid, locus: ltrs.pop(locid, [])
+    
+    # Organize by locus
+    for locid,locus in utils.locus_block_gen(secondpass):
+        ltrhits = get_ltrs(locid, locus)
+        locus = [g for g in locus if not g.feature.startswith('span')] + ltrhits
+        utils.write_locus(args.outfile, locid, assemble_locus(locid, locus, model_lengths))
 
 if __name__ == '__main__':
     import argparse
     import sys
     parser = argparse.ArgumentParser(description='Assemble HERV loci from internal and LTR annotations')
+    parser.add_argument('--flank', type=int,
+                        help='''Size of flanking region. If provided, ltrGTF contains
+                                LTR hits and hits overlapping the internal spans
+                                extended by this amount are found directly, instead of
+                                using bedtools output.''')
+    parser.add_argument('--chrom_sizes', type=argparse.FileType('rU'),
+                        help='''File with chromosome sizes, used to clip flanking
+                                regions. Only used with --flank.''')
+    parser.add_argument('--model_lengths',
+                        help='''Model lengths table written by fixRmskCoords. If not
+                                provided, lengths are guessed from internalGTF.''')
+    parser.add_argument('--batch', action='store_true',
+                        help='''Assemble all loci at once with array operations instead
+                                of one locus at a time. Uses more memory.''')
     parser.add_argument('internalGTF', type=argparse.FileType('rU'),
                         help="Merged hits for internal HERV regions as GTF file.")
     parser.add_argument('ltrGTF', type=argparse.FileType('rU'),
                         help='''LTR hits that overlap (flanked) internal regions. This
                                 should be output from bedtools intersect using the -wo 
-                                option, so overlapping records are on the same line.''')
+                                option, so overlapping records are on the same line,
+                                with spans sorted by position as in internalGTF.
+                                If --flank is provided, this is a GTF with LTR hits.''')
     parser.add_argument('outfile', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
                         help="Output GTF")
     main(parser.parse_args())
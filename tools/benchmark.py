@@ -0,0 +1,295 @@
+#! /usr/bin/env python
+""" Benchmarks for the GTF utilities
+
+Each subcommand times one component and prints the results to stdout. If no input
+file is given, synthetic RepeatMasker records are used.
+"""
+import sys
+import os
+import re
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+from collections import defaultdict
+from distutils import spawn
+
+import utils
+
+CHROMS = ['chr%s' % c for c in range(1,23) + ['X','Y']]
+
+def synthetic_gtf(nlines, seed=1, presorted=False):
+    ''' Generate rows resembling GTF converted from UCSC RepeatMasker tables
+        If presorted is True, rows are sorted by chromosome (in CHROMS order) and
+        start position.
+    '''
+    rng = random.Random(seed)
+    start = 1
+    for i in xrange(nlines):
+        strand = rng.choice('+-')
+        mlen = rng.choice([450, 968, 5600, 7400])
+        ms = rng.randint(1, mlen - 100)
+        me = rng.randint(ms + 50, mlen)
+        if presorted:
+            chrom = CHROMS[i * len(CHROMS) // nlines]
+            start = 1 if chrom != CHROMS[(i-1) * len(CHROMS) // nlines] else start + rng.randint(10, 2000)
+        else:
+            chrom = rng.choice(CHROMS)
+            start = rng.randint(1, 200000000)
+        if strand == '+':
+            rs, re_, rl = ms, me, me - mlen
+        else:
+            rs, re_, rl = me - mlen, me, ms
+        name = rng.choice(['HERVH-int','LTR7','HERVK-int','LTR5_Hs'])
+        attrs = {'repStart': rs, 'repEnd': re_, 'repLeft': rl,
+                 'id': '%s_%d' % (name, i+1), 'repName': name,
+                 'repClass': 'LTR', 'repFamily': 'ERV1', 'geneRegion': 'internal'}
+        yield [chrom, 'rmsk', 'exon', str(start), str(start + me - ms),
+               str(rng.randint(200,30000)), strand, '.',
+               ' '.join('%s "%s";' % (k,v) for k,v in attrs.iteritems())]
+
+def best_time(func, repeat):
+    ''' Best wall-clock time (seconds) for calling func '''
+    ret = None
+    for _ in range(repeat):
+        t0 = time.time()
+        func()
+        dt = time.time() - t0
+        ret = dt if ret is None else min(ret, dt)
+    return ret
+
+def legacy_parse_attrs(attrstr):
+    ''' Attribute parsing as originally implemented in GTFLine '''
+    ret = {}
+    for k,v in re.findall('(\S+)\s+"([\s\S]+?)";', attrstr):
+        try:
+            ret[k] = int(v)
+        except ValueError:
+            try:
+                ret[k] = float(v)
+            except ValueError:
+                ret[k] = v
+    return ret
+
+def bench_attrs(args):
+    if args.infile:
+        attrstrs = [l[8] for l in utils.tab_line_gen(args.infile)][:args.nlines]
+    else:
+        attrstrs = [l[8] for l in synthetic_gtf(args.nlines)]
+
+    print >>args.outfile, 'Parsing %d attribute strings (best of %d)' % (len(attrstrs), args.repeat)
+    print >>args.outfile, '%-12s%12s%12s' % ('parser', 'total (s)', 'us/line')
+    for name, func in [('regex', legacy_parse_attrs), ('schema', utils.parse_attrs)]:
+        t = best_time(lambda: [func(a) for a in attrstrs], args.repeat)
+        print >>args.outfile, '%-12s%12.3f%12.2f' % (name, t, t * 1e6 / len(attrstrs))
+
+def write_synthetic(fn, nlines, presorted=False):
+    with open(fn, 'w') as outh:
+        utils.write_lines(outh, ('\t'.join(r) for r in synthetic_gtf(nlines, presorted=presorted)))
+
+def run_tool(cmd, infn):
+    ''' Run command with input file, returns (seconds, max RSS in MB) '''
+    t0 = time.time()
+    with open(infn) as inh, open(os.devnull, 'w') as devnull:
+        p = subprocess.Popen(cmd, stdin=inh, stdout=devnull, stderr=devnull)
+        _, status, rusage = os.wait4(p.pid, 0)
+    if status != 0:
+        sys.exit('ERROR: command failed: %s' % ' '.join(cmd))
+    return time.time() - t0, rusage.ru_maxrss / 1024.
+
+def bench_stream(args):
+    tooldir = os.path.dirname(os.path.abspath(__file__))
+    tools = [('transferGTFAttr', ['transferGTFAttr.py', 'locus', 'transcript_id']),
+             ('sortgtf --presorted', ['sortgtf.py', '--presorted', '--chroms', '{chroms}']),
+             ('fixRmskCoords', ['fixRmskCoords.py']),
+            ]
+    sizes = [args.nlines // 4, args.nlines // 2, args.nlines]
+    tmpdir = tempfile.mkdtemp(dir=args.tmpdir)
+    chromfile = os.path.join(tmpdir, 'chroms.txt')
+    with open(chromfile, 'w') as outh:
+        utils.write_lines(outh, CHROMS)
+    try:
+        print >>args.outfile, '%-22s%12s%12s%12s' % ('tool', 'lines', 'time (s)', 'RSS (MB)')
+        for n in sizes:
+            infn = os.path.join(tmpdir, 'input.%d.gtf' % n)
+            write_synthetic(infn, n, presorted=True)
+            for name, cmd in tools:
+                cmd = [sys.executable, os.path.join(tooldir, cmd[0])] + [c.format(chroms=chromfile) for c in cmd[1:]]
+                t, rss = run_tool(cmd, infn)
+                print >>args.outfile, '%-22s%12d%12.1f%12.1f' % (name, n, t, rss)
+            os.remove(infn)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_sort(args):
+    tooldir = os.path.dirname(os.path.abspath(__file__))
+    tmpdir = tempfile.mkdtemp(dir=args.tmpdir)
+    try:
+        infn = os.path.join(tmpdir, 'input.gtf')
+        write_synthetic(infn, args.nlines)
+        chromfile = os.path.join(tmpdir, 'chroms.txt')
+        with open(chromfile, 'w') as outh:
+            utils.write_lines(outh, CHROMS)
+        sortcmd = [sys.executable, os.path.join(tooldir, 'sortgtf.py'), '--chroms', chromfile]
+        methods = [('in-memory', sortcmd),
+                   ('external', sortcmd + ['--max_memory', args.max_memory, '--tmpdir', tmpdir]),
+                   ('external+gz', sortcmd + ['--max_memory', args.max_memory, '--tmpdir', tmpdir, '--compress_tmp']),
+                  ]
+        print >>args.outfile, 'Sorting %d lines' % args.nlines
+        print >>args.outfile, '%-14s%12s%12s' % ('method', 'time (s)', 'RSS (MB)')
+        for name, cmd in methods:
+            t, rss = run_tool(cmd, infn)
+            print >>args.outfile, '%-14s%12.1f%12.1f' % (name, t, rss)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_fixcoords(args):
+    import fixRmskCoords
+    if args.infile:
+        rows = list(utils.tab_line_gen(args.infile))
+    else:
+        rows = list(synthetic_gtf(args.nlines))
+    
+    def per_record():
+        gtf = [utils.GTFLine(r) for r in rows]
+        mlen = utils.guess_rmsk_model_lengths(gtf)
+        return sum(1 for _ in fixRmskCoords.check_rmsk_model_coordinates(
+                   fixRmskCoords.correct_rmsk_model_coordinates(gtf, mlen), mlen))
+    
+    def table():
+        table = utils.GTFTable.from_rows(rows)
+        mlen = utils.guess_rmsk_model_lengths(table)
+        table, _ = fixRmskCoords.correct_table_coordinates(table, mlen)
+        return fixRmskCoords.check_table_coordinates(table, mlen).sum()
+    
+    print >>args.outfile, 'Correcting %d records (best of %d)' % (len(rows), args.repeat)
+    print >>args.outfile, '%-12s%12s%12s' % ('method', 'time (s)', 'rows/s')
+    for name, func in [('per-record', per_record), ('table', table)]:
+        t = best_time(func, args.repeat)
+        print >>args.outfile, '%-12s%12.3f%12d' % (name, t, len(rows) / t)
+
+def bench_merge(args):
+    import mergeHits
+    if args.infile:
+        rows = list(utils.tab_line_gen(args.infile))
+    else:
+        rows = list(synthetic_gtf(args.nlines, presorted=True))
+    
+    print >>args.outfile, 'Merging %d hits (best of %d)' % (len(rows), args.repeat)
+    print >>args.outfile, '%-12s%12s%12s' % ('mode', 'time (s)', 'loci')
+    for mode in ['greedy', 'chain']:
+        merge = lambda: mergeHits.merge_hits([utils.GTFLine(r) for r in rows], 'BENCH',
+                                             args.shortdist, args.longdist, mode=mode)
+        t = best_time(merge, args.repeat)
+        print >>args.outfile, '%-12s%12.3f%12d' % (mode, t, len(merge()))
+
+def bedtools_find_overlaps(gtf):
+    ''' Cluster annotations with "bedtools cluster", as originally implemented '''
+    p1 = subprocess.Popen('bedtools cluster -i -', shell=True, stdin=subprocess.PIPE,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    o,e = p1.communicate(input='\n'.join(str(g) for g in gtf))
+    _clust = defaultdict(list)
+    for l in utils.tab_line_gen(o.strip('\n').split('\n')):
+        _clust[l[-1]].append(utils.GTFLine(l[:9]))
+    return _clust
+
+def bench_cluster(args):
+    if args.infile:
+        spans = [utils.GTFLine(l) for l in utils.tab_line_gen(args.infile)]
+    else:
+        spans = [utils.GTFLine(r) for r in synthetic_gtf(args.nlines, presorted=True)]
+    
+    print >>args.outfile, 'Clustering %d intervals (best of %d)' % (len(spans), args.repeat)
+    print >>args.outfile, '%-12s%12s%12s' % ('method', 'time (s)', 'clusters')
+    methods = [('native', utils.find_overlaps)]
+    if spawn.find_executable('bedtools'):
+        methods.append(('bedtools', bedtools_find_overlaps))
+    else:
+        print >>sys.stderr, 'bedtools not found, skipping subprocess method'
+    for name, func in methods:
+        t = best_time(lambda: func(spans), args.repeat)
+        print >>args.outfile, '%-12s%12.3f%12d' % (name, t, len(func(spans)))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark GTF utilities',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers()
+
+    p_attrs = subparsers.add_parser('attrs', help='Per-line cost of attribute parsing',
+                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p_attrs.add_argument('--nlines', type=int, default=200000,
+                         help="Number of lines to parse")
+    p_attrs.add_argument('--repeat', type=int, default=3,
+                         help="Number of repetitions")
+    p_attrs.add_argument('infile', nargs='?', type=argparse.FileType('rU'),
+                         help="Input GTF (default: synthetic records)")
+    p_attrs.add_argument('outfile', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
+                         help="Output file")
+    p_attrs.set_defaults(func=bench_attrs)
+
+    p_stream = subparsers.add_parser('stream', help='Memory use of streaming tools',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p_stream.add_argument('--nlines', type=int, default=4000000,
+                          help="Number of lines in largest input")
+    p_stream.add_argument('--tmpdir',
+                          help="Directory for temporary files")
+    p_stream.add_argument('outfile', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
+                          help="Output file")
+    p_stream.set_defaults(func=bench_stream)
+
+    p_sort = subparsers.add_parser('sort', help='In-memory vs external sort',
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p_sort.add_argument('--nlines', type=int, default=10000000,
+                        help="Number of lines to sort")
+    p_sort.add_argument('--max_memory', default='256M',
+                        help="Memory limit for external sort")
+    p_sort.add_argument('--tmpdir',
+                        help="Directory for temporary files")
+    p_sort.add_argument('outfile', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
+                        help="Output file")
+    p_sort.set_defaults(func=bench_sort)
+
+    p_cluster = subparsers.add_parser('cluster', help='Interval clustering, native vs bedtools',
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p_cluster.add_argument('--nlines', type=int, default=1000000,
+                           help="Number of synthetic intervals")
+    p_cluster.add_argument('--repeat', type=int, default=3,
+                           help="Number of repetitions")
+    p_cluster.add_argument('infile', nargs='?', type=argparse.FileType('rU'),
+                           help="Input GTF, sorted by position (default: synthetic records)")
+    p_cluster.add_argument('outfile', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
+                           help="Output file")
+    p_cluster.set_defaults(func=bench_cluster)
+
+    p_fix = subparsers.add_parser('fixcoords', help='Model coordinate correction, per record vs table',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p_fix.add_argument('--nlines', type=int, default=1000000,
+                       help="Number of synthetic records")
+    p_fix.add_argument('--repeat', type=int, default=3,
+                       help="Number of repetitions")
+    p_fix.add_argument('infile', nargs='?', type=argparse.FileType('rU'),
+                       help="Input GTF with RepeatMasker records (default: synthetic records)")
+    p_fix.add_argument('outfile', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
+                       help="Output file")
+    p_fix.set_defaults(func=bench_fixcoords)
+
+    p_merge = subparsers.add_parser('merge', help='Merging hits, greedy vs chain',
+                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p_merge.add_argument('--nlines', type=int, default=200000,
+                         help="Number of synthetic hits")
+    p_merge.add_argument('--repeat', type=int, default=3,
+                         help="Number of repetitions")
+    p_merge.add_argument('--shortdist', type=int, default=10,
+                         help="See mergeHits.py")
+    p_merge.add_argument('--longdist', type=int, default=10000,
+                         help="See mergeHits.py")
+    p_merge.add_argument('infile', nargs='?', type=argparse.FileType('rU'),
+                         help="Input GTF with RepeatMasker hits (default: synthetic records)")
+    p_merge.add_argument('outfile', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
+                         help="Output file")
+    p_merge.set_defaults(func=bench_merge)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,295 @@
+#! /usr/bin/env python
+""" Build HERV annotations for all families in families.tsv
+
+Families are built with pipeline.py on a pool of worker processes. Families that took
+longest in previous runs are started first; timings are kept in a JSON file. Output of
+each family build is written to FAM/build.log. If any family fails, the remaining
+builds are stopped.
+
+The sorted per-family GTFs are merged into transcripts.gtf (without spanning
+annotations) and genes.gtf (spanning annotations only, with feature "gene"). Families
+are merged as they finish (see FamilyMerger), the outputs are written when all
+families are built. Stages with unchanged inputs are not rerun (see
+pipeline.Pipeline), and the merge is skipped if no family output has changed.
+"""
+import os
+import sys
+import json
+import time
+import heapq
+import shutil
+import argparse
+import traceback
+from multiprocessing import Pool
+
+import utils
+import pipeline
+
+def read_families(infile, flank):
+    ''' Read families table
+        Columns are family, internal model, LTR models (comma-separated) and
+        optionally the flank size. Lines starting with "#" are skipped.
+    '''
+    fams = []
+    for l in utils.tab_line_gen(infile):
+        l = [f for f in l if f]
+        if not l: continue
+        fams.append((l[0], l[1], l[2].split(','), int(l[3]) if len(l) > 3 else flank))
+    return fams
+
+def load_timings(fn):
+    if fn is None or not os.path.exists(fn):
+        return {}
+    with open(fn, 'rU') as fh:
+        return json.load(fh)
+
+def save_timings(fn, timings):
+    if fn is None:
+        return
+    with open(fn, 'w') as outh:
+        json.dump(timings, outh, indent=2, sort_keys=True)
+
+def schedule(fams, timings):
+    ''' Order families by previous build time, longest first
+        Families without a previous timing are started first.
+    '''
+    return sorted(fams, key=lambda f: -timings.get(f[0], float('inf')))
+
+def build_family(task):
+    ''' Build one family, output is written to FAM/build.log
+        Returns (family, seconds, key of final stage, error message or None). Seconds
+        is None if any stage output was taken from the cache.
+    '''
+    (fam, intmodel, ltrmodels, flank), opts = task
+    t0 = time.time()
+    if not os.path.isdir(fam):
+        os.makedirs(fam)
+    stderr = sys.stderr
+    key, secs = None, None
+    with open(os.path.join(fam, 'build.log'), 'w') as logh:
+        sys.stderr = logh
+        try:
+            args = argparse.Namespace(fam=fam, intmodel=intmodel, ltrmodels=ltrmodels,
+                                      flank=flank, outdir=fam, **opts)
+            with open(opts['chroms'], 'rU') as chromh:
+                args.chroms = chromh
+                p = pipeline.main(args)
+            key = p.keys['final']
+            if p.cache_hits == 0:
+                secs = time.time() - t0
+            err = None
+        except SystemExit as e:
+            err = str(e.code)
+        except Exception as e:
+            traceback.print_exc(file=logh)
+            err = '%s: %s' % (type(e).__name__, e)
+        finally:
+            sys.stderr = stderr
+    return fam, secs, key, err
+
+class FamilyMerger(object):
+    ''' Merge sorted family GTFs into transcripts.gtf and genes.gtf as families finish
+        Finished families are kept as sorted runs; when the last two runs contain the
+        same number of families they are merged into one run in OUTDIR/.stages/merge,
+        so each line is rewritten about log2(families) times. finish() merges the
+        remaining runs into the outputs. Lines in merged runs are prefixed with the
+        family index so that lines with the same position are ordered by family, as
+        with utils.merge_sorted_gtf over all families.
+    '''
+    def __init__(self, fams, chroms, outdir):
+        self.index = {f:i for i,f in enumerate(fams)}
+        self.rank = {c:i for i,c in enumerate(chroms)}
+        self.outdir = outdir
+        self.tmpdir = os.path.join(outdir, '.stages', 'merge')
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        os.makedirs(self.tmpdir)
+        # (number of families, file, family or None for merged runs)
+        self.runs = []
+        self.nmerged = 0
+
+    def _lines(self, run):
+        ''' Generate ((chromosome rank, start, family index), fields) for lines in run '''
+        size, fn, fam = run
+        with open(fn, 'rU') as fh:
+            for l in utils.tab_line_gen(fh):
+                if fam is None:
+                    i, l = int(l[0]), l[1:]
+                elif l[0] in self.rank:
+                    i = self.index[fam]
+                else:
+                    continue
+                yield (self.rank[l[0]], int(l[3]), i), l
+
+    def _merged(self, runs):
+        return heapq.merge(*[self._lines(r) for r in runs])
+
+    def add(self, fam):
+        ''' Add output of finished family, merging runs of equal size '''
+        self.runs.append((1, os.path.join(fam, '%s.gtf' % fam), fam))
+        while len(self.runs) > 1 and self.runs[-1][0] == self.runs[-2][0]:
+            r2, r1 = self.runs.pop(), self.runs.pop()
+            fn = os.path.join(self.tmpdir, 'run%d.gtf' % self.nmerged)
+            self.nmerged += 1
+            with open(fn, 'w') as outh:
+                utils.write_lines(outh, ('%d\t%s' % (k[2], '\t'.join(l))
+                                         for k,l in self._merged([r1, r2])))
+            for r in (r1, r2):
+                if r[2] is None: os.remove(r[1])
+            self.runs.append((r1[0] + r2[0], fn, None))
+
+    def finish(self):
+        ''' Merge runs into transcripts.gtf and genes.gtf '''
+        with open(os.path.join(self.outdir, 'transcripts.gtf'), 'w') as txh, \
+             open(os.path.join(self.outdir, 'genes.gtf'), 'w') as geneh:
+            txbuf, genebuf = [], []
+            for k,l in self._merged(self.runs):
+                if l[2].startswith('span'):
+                    genebuf.append('\t'.join(l[:2] + ['gene'] + l[3:]))
+                else:
+                    txbuf.append('\t'.join(l))
+                if len(txbuf) >= 10000:
+                    utils.write_lines(txh, txbuf)
+                    txbuf = []
+            utils.write_lines(txh, txbuf)
+            utils.write_lines(geneh, genebuf)
+        self.close()
+
+    def close(self):
+        ''' Remove merged runs '''
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        self.runs = []
+
+def main(args):
+    fams = read_families(args.families, args.flank)
+    if args.rmsk:
+        # Partition local RepeatMasker table instead of downloading from UCSC
+        from partitionRmsk import model_outputs, partition_rmsk, open_rmsk
+        outputs = model_outputs(fams)
+        print >>sys.stderr, 'Partitioning %s for %d models' % (args.rmsk, len(outputs))
+        with open_rmsk(args.rmsk) as fh:
+            partition_rmsk(fh, outputs)
+    timings = load_timings(args.timings)
+    opts = {'chroms': args.chroms,
+            'cytoband': args.cytoband,
+            'db': args.db,
+            'rmsk_db': args.rmsk_db,
+            'shortdist': args.shortdist,
+            'longdist': args.longdist,
+            'merge_mode': args.merge_mode,
+            'min_internal_pct': args.min_internal_pct,
+            'min_internal_bases': args.min_internal_bases,
+            'resolve_file': None,
+            'save_intermediate': args.save_intermediate,
+            'force': args.force,
+            }
+    tasks = [(f, opts) for f in schedule(fams, timings)]
+    print >>sys.stderr, 'Building %d families with %d processes' % (len(tasks), args.jobs)
+
+    # The merge is skipped if no family output has changed since the last merge, so
+    # finished families are only merged once an output differs from the last merge
+    manifestfn = os.path.join(args.outdir, '.stages', 'merge.json')
+    outfns = [os.path.join(args.outdir, fn) for fn in ('transcripts.gtf', 'genes.gtf')]
+    last = None
+    if not args.force and all(os.path.exists(fn) for fn in outfns + [manifestfn]):
+        with open(manifestfn, 'rU') as fh:
+            last = json.load(fh)
+    lastkeys = dict(last['families']) if last is not None else {}
+    chroms = utils.read_chrom_sizes(open(args.chroms, 'rU')).keys()
+    merger = FamilyMerger([f[0] for f in fams], chroms, args.outdir)
+    merging, pending = last is None, []
+
+    done, failed, keys = [], None, {}
+    pool = Pool(args.jobs)
+    try:
+        for fam, secs, key, err in pool.imap_unordered(build_family, tasks):
+            if err is not None:
+                failed = (fam, err)
+                break
+            keys[fam] = key
+            done.append(fam)
+            if secs is None:
+                print >>sys.stderr, '%-12s%9s   (%d/%d)' % (fam, 'cached', len(done), len(tasks))
+            else:
+                timings[fam] = secs
+                print >>sys.stderr, '%-12s%8.1fs   (%d/%d)' % (fam, secs, len(done), len(tasks))
+            pending.append(fam)
+            merging = merging or lastkeys.get(fam) != key
+            if merging:
+                for f in pending:
+                    merger.add(f)
+                pending = []
+    finally:
+        if failed is None:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+    save_timings(args.timings, timings)
+
+    if failed is not None:
+        merger.close()
+        fam, err = failed
+        notrun = [f[0] for f,_ in tasks if f[0] not in done and f[0] != fam]
+        print >>sys.stderr, '\nERROR: build failed for %s' % fam
+        print >>sys.stderr, '  %s' % err
+        print >>sys.stderr, '  See %s' % os.path.join(fam, 'build.log')
+        print >>sys.stderr, 'Completed: %d  Failed: 1  Stopped or not started: %d' % (len(done), len(notrun))
+        if notrun:
+            print >>sys.stderr, '  %s' % ' '.join(notrun)
+        sys.exit(1)
+
+    manifest = {'families': [[f[0], keys[f[0]]] for f in fams],
+                'chroms': utils.file_sha1(args.chroms)}
+    if last == manifest:
+        merger.close()
+        print >>sys.stderr, '%s and %s are up to date' % tuple(outfns)
+        return
+    
+    for f in pending:
+        merger.add(f)
+    merger.finish()
+    with open(manifestfn, 'w') as outh:
+        json.dump(manifest, outh, indent=2)
+    print >>sys.stderr, 'Wrote %s and %s' % tuple(outfns)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build HERV annotations for all families',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of families built in parallel")
+    parser.add_argument('--timings', default='build.timings.json',
+                        help="JSON file with build time for each family, used for scheduling")
+    parser.add_argument('--chroms', default='chrom.sizes',
+                        help="Chromosome sizes")
+    parser.add_argument('--cytoband', default='cytoband.gtf',
+                        help="Cytoband GTF used for naming loci")
+    parser.add_argument('--flank', type=int, default=1000,
+                        help="Size of flanking region, if not given in families table")
+    parser.add_argument('--shortdist', type=int, default=10,
+                        help="Hits closer than this are always merged")
+    parser.add_argument('--longdist', type=int, default=10000,
+                        help="Maximum distance between merged hits")
+    parser.add_argument('--merge_mode', choices=['greedy', 'chain'], default='greedy',
+                        help="Algorithm for merging internal hits (see mergeHits.py)")
+    parser.add_argument('--min_internal_pct', type=float, default=0.1,
+                        help="Minimum fraction of internal model matched")
+    parser.add_argument('--min_internal_bases', type=int, default=0,
+                        help="Minimum number of bases matching internal model")
+    parser.add_argument('--db',
+                        help="UCSC database (i.e. hg19) for downloading RepeatMasker tables")
+    parser.add_argument('--rmsk_db',
+                        help="RepeatMasker store (see rmskdb.py) for extracting tables")
+    parser.add_argument('--rmsk',
+                        help='''Local UCSC rmsk table dump (rmsk.txt.gz). If provided,
+                                RepeatMasker tables for all families are extracted from
+                                this file instead of downloaded.''')
+    parser.add_argument('--save_intermediate', action='store_true',
+                        help="Write output of each stage to family directory")
+    parser.add_argument('--force', action='store_true',
+                        help="Run all stages, ignoring cached outputs")
+    parser.add_argument('--outdir', default='.',
+                        help="Directory for transcripts.gtf and genes.gtf")
+    parser.add_argument('families', type=argparse.FileType('rU'),
+                        help="Families table (families.tsv)")
+    main(parser.parse_args())
@@ -1,9 +1,89 @@
 #! /usr/bin/env python
 
-from collections import defaultdict, Counter
+import re
+from collections import Counter, deque
 import itertools
+from multiprocessing import Pool
 import utils
-from utils import GTFLine
+
+def filter_loci(loci, min_internal_pct=0., min_internal_bases=0):
+    ''' Filter loci by coverage of the internal model
+        min_internal_pct is the minimum fraction of the internal model matched.
+        Generates (locus id, [spanning annotation] + annotations, passed) for each
+        locus in loci.
+    '''
+    min_internal_pct = min_internal_pct * 100
+    for locid,locus in loci:
+        spn = utils.get_span(locus)
+        locus  = [a for a in locus if a != spn] # not a.feature.startswith('span')]
+        passed = spn.attr['model_pct'] >= min_internal_pct and spn.attr['model_cov'] >= min_internal_bases
+        yield locid, [spn] + sorted(locus,key=lambda x:x.start), passed
+
+### Chunked filtering ####################################################################
+LOCUS_ATTR = re.compile('locus "([^"]*)"')
+
+def locus_chunks(infile, chunksize=20000):
+    ''' Split GTF file into chunks of about chunksize lines with complete loci
+        Chunks end before a "### <locus> ###" separator, or before a line from a new
+        locus where utils.locus_block_gen would complete all loci in the chunk, so
+        filtering chunks gives the same output as filtering the whole file. Lines
+        are only split to get the position and locus.
+    '''
+    chunk, loci, chrom, spanend = [], set(), None, -1
+    for l in infile:
+        if l.startswith('#'):
+            if len(chunk) >= chunksize and utils.LOCUS_SEPARATOR.match(l):
+                yield chunk
+                chunk, loci = [], set()
+            chunk.append(l)
+            continue
+        f = l.split('\t', 5)
+        m = LOCUS_ATTR.search(f[-1])
+        locid = m.group(1) if m else None
+        if len(chunk) >= chunksize and locid not in loci and (f[0] != chrom or int(f[3]) > spanend):
+            yield chunk
+            chunk, loci = [], set()
+        if f[0] != chrom:
+            chrom, spanend = f[0], -1
+        if f[2].startswith('span'):
+            spanend = max(spanend, int(f[4]))
+        loci.add(locid)
+        chunk.append(l)
+    if chunk:
+        yield chunk
+
+def filter_chunk(task):
+    ''' Filter loci in chunk of GTF lines
+        task is (lines, min_internal_pct, min_internal_bases). Returns (passed text,
+        rejected text, category counts, [(locus, model_cov, model_pct, category)]
+        for rejected loci). Loci are framed with "### <locus> ###" separators.
+    '''
+    lines, min_internal_pct, min_internal_bases = task
+    passbuf, rejectbuf = [], []
+    counts, rejected = Counter(), []
+    for locid,locus,passed in filter_loci(utils.locus_block_gen(lines), min_internal_pct, min_internal_bases):
+        spn = locus[0]
+        category = spn.attr['category']
+        if passed:
+            counts[category] += 1
+            buf = passbuf
+        else:
+            counts['rejected'] += 1
+            rejected.append((locid, spn.attr['model_cov'], spn.attr['model_pct'], category))
+            buf = rejectbuf
+        buf.append('### %s ###\n' % locid)
+        buf.extend('%s\n' % g for g in locus)
+    return ''.join(passbuf), ''.join(rejectbuf), counts, rejected
+
+def _bounded_imap(pool, func, tasks, window):
+    ''' Like pool.imap, but at most window tasks are submitted at once '''
+    pending = deque()
+    for t in tasks:
+        pending.append(pool.apply_async(func, (t,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
 def main(args):
     # Filehandle for rejected loci
@@ -15,43 +95,38 @@ def main(args):
     min_internal_pct = args.min_internal_pct * 100
     min_internal_bases = args.min_internal_bases
     
-    # Load the internal GTF
-    combined_gtf = [GTFLine(l) for l in utils.tab_line_gen(args.infile)]
-    model_lengths = utils.guess_rmsk_model_lengths(combined_gtf)
-    
     loccounts = Counter()
-    byloc = defaultdict(list)
-    for g in combined_gtf:
-        byloc[g.attr['locus']].append(g)
     
     if min_internal_pct > 0:
         print >>sys.stderr, "Removing loci matching less than %d percent of internal model..." % int(min_internal_pct)
     if min_internal_bases > 0:
         print >>sys.stderr, "Removing loci matching less than %d internal bases..." % min_internal_bases
     
+    # Chunks of loci are filtered in order, results are written as they complete
+    tasks = ((chunk, args.min_internal_pct, min_internal_bases)
+             for chunk in locus_chunks(args.infile, args.chunksize))
+    pool = Pool(args.processes) if args.processes > 1 else None
+    if pool is None:
+        results = itertools.imap(filter_chunk, tasks)
+    else:
+        results = _bounded_imap(pool, filter_chunk, tasks, 2 * args.processes)
+    
     rejectflag = False
-    for locid,locus in byloc.iteritems():
-        spn = utils.get_span(locus)
-        locus  = [a for a in locus if a != spn] # not a.feature.startswith('span')]
-        category = spn.attr['category']
-        model_pct = spn.attr['model_pct']
-        model_cov = spn.attr['model_cov']
-        
-        if model_pct >= min_internal_pct and model_cov >= min_internal_bases:
-            loccounts[category] += 1
-            outh = args.outfile
-        else:
-            if not rejectflag:
-                print >>sys.stderr, 'Removed loci:'
-                print >>sys.stderr, '%-18s%-6s%-6s%s' % ('locus','bp','pct','category')
-                rejectflag = True
-            loccounts['rejected'] += 1
-            print >>sys.stderr, '%-18s%-6d%-6.1f%s' % (locid, model_cov, model_pct, category)
-            outh = args.reject_gtf
-        
-        print >>outh, '### %s ###' % locid
-        print >>outh, spn
-        print >>outh, '\n'.join(str(_) for _ in sorted(locus,key=lambda x:x.start))            
+    try:
+        for passtxt, rejecttxt, counts, rejected in results:
+            args.outfile.write(passtxt)
+            args.reject_gtf.write(rejecttxt)
+            loccounts.update(counts)
+            for r in rejected:
+                if not rejectflag:
+                    print >>sys.stderr, 'Removed loci:'
+                    print >>sys.stderr, '%-18s%-6s%-6s%s' % ('locus','bp','pct','category')
+                    rejectflag = True
+                print >>sys.stderr, '%-18s%-6d%-6.1f%s' % r
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
     
     if not rejectflag:
         print >>sys.stderr, 'All passed filter.'
@@ -69,6 +144,10 @@ if __name__ == '__main__':
                         help="Minimum number of bases matching internal model")
     parser.add_argument('--min_internal_pct', type=float, default=0.,
                         help="Minimum percentage of internal model matched")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="Number of processes for filtering chunks of loci")
+    parser.add_argument('--chunksize', type=int, default=20000,
+                        help="Approximate number of lines in each chunk of loci")
     parser.add_argument('--reject_gtf', type=argparse.FileType('w'),
                         help="File to output loci failing filters")
     parser.add_argument('infile', type=argparse.FileType('rU'),
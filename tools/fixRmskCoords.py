@@ -1,8 +1,9 @@
 #! /usr/bin/env python
 import sys
-from collections import defaultdict, Counter
+import re
+import numpy as np
+
 import utils
-from utils import GTFLine
 
 def correct_rmsk_model_coordinates(gtflines, modellen):
     ''' Fix incorrect model coordinates using model length '''
@@ -19,33 +20,117 @@ def correct_rmsk_model_coordinates(gtflines, modellen):
                 replen = g.attr['repEnd'] - g.attr['repLeft']
                 g.attr['repEnd'] = trueend
                 g.attr['repLeft'] = trueend - replen
+        yield g
+
+def check_rmsk_model_coordinates(gtflines, modellen):
+    ''' Check that model coordinates agree with model length '''
+    for g in gtflines:
+        if g.strand == '+':
+            trueend = modellen[g.attr['repName']] + g.attr['repLeft']
+        else:
+            trueend = modellen[g.attr['repName']] + g.attr['repStart']
+        assert trueend == g.attr['repEnd']
+        yield g
+
+REPCOLS = ['repStart', 'repEnd', 'repLeft']
+
+def replace_attr(attrstr, name, old, new):
+    ''' Replace integer value of attribute in attribute string '''
+    ostr, nstr = ' %s "%d";' % (name, old), ' %s "%d";' % (name, new)
+    if ostr in attrstr:
+        return attrstr.replace(ostr, nstr, 1)
+    # Value is not formatted as integer
+    return re.sub('(\s%s\s+)"[^"]*";' % name, '\\g<1>"%d";' % new, attrstr, count=1)
+
+def correct_table_coordinates(table, modellen):
+    ''' Fix incorrect model coordinates in GTFTable using model length
+        Returns (corrected table, boolean array of corrected rows). Coordinates in
+        attribute strings are replaced only for corrected rows.
+    '''
+    NA = utils.GTFTable.NA
+    lens = np.array([modellen.get(n, NA) for n in table.levels['repName']] + [NA], dtype=np.int64)
+    # Missing repName (code -1) selects the last element, NA
+    mlen = lens[table['repName']]
+    plus = table['strand'] == table.code('strand', '+')
+    rs, rend, rl = table['repStart'], table['repEnd'], table['repLeft']
+    trueend = np.where(plus, mlen + rl, mlen + rs)
+    fix = (mlen != NA) & (trueend != rend)
+    fixplus, fixminus = fix & plus, fix & ~plus
+    
+    cols = dict(table.cols)
+    cols['repEnd'] = np.where(fix, trueend, rend)
+    cols['repStart'] = np.where(fixplus, trueend - (rend - rs), rs)
+    cols['repLeft'] = np.where(fixminus, trueend - (rend - rl), rl)
+    attrstrs = list(table.attrstrs)
+    idx = np.flatnonzero(fix)
+    oldvals = [table[c][idx].tolist() for c in REPCOLS]
+    newvals = [cols[c][idx].tolist() for c in REPCOLS]
+    for j,i in enumerate(idx.tolist()):
+        # Leading space so that each attribute name follows a space
+        a = ' ' + attrstrs[i]
+        for c,o,n in zip(REPCOLS, oldvals, newvals):
+            if o[j] != n[j]:
+                a = replace_attr(a, c, o[j], n[j])
+        attrstrs[i] = a[1:]
+    return utils.GTFTable(cols, table.levels, attrstrs), fix
+
+def check_table_coordinates(table, modellen):
+    ''' Check that model coordinates in GTFTable agree with model length
+        Returns boolean array that is True for rows that do not agree, including rows
+        without a known model length.
+    '''
+    NA = utils.GTFTable.NA
+    lens = np.array([modellen.get(n, NA) for n in table.levels['repName']] + [NA], dtype=np.int64)
+    mlen = lens[table['repName']]
+    return (mlen == NA) | (utils.rmsk_model_sizes(table) != mlen)
 
 def main(args):
     ### Read the GTF file ################################################################
-    gtf = [GTFLine(l) for l in utils.tab_line_gen(args.infile)]
+    # The file is read twice: once to find the model lengths and once to correct the
+    # records. Each pass reads the file in chunks of records stored as arrays.
+    firstpass, secondpass = utils.two_pass(args.infile)
     
     ### Correct model coordinates ########################################################
     # The repStart, repEnd, and repLeft attributes downloaded from the UCSC rmsk database
     # does not always give the same model length. Here we guess what the correct model
     # length is then correct each record    
-    mlen = utils.guess_rmsk_model_lengths(gtf)
+    counts, offset = {}, 0
+    for table in utils.GTFTable.chunks(utils.tab_line_gen(firstpass), args.chunksize):
+        utils.count_model_lengths(table, counts, offset)
+        offset += len(table)
+    mlen = utils.select_model_lengths(counts)
     print >>sys.stderr, 'Model lengths:'
     print >>sys.stderr, '\n'.join('%s%d' % (k.ljust(16), mlen[k]) for k in sorted(mlen.keys()))
-    correct_rmsk_model_coordinates(gtf,mlen)
-    # Check that model coordinates are correct
-    for g in gtf:
-        if g.strand == '+':
-            trueend = mlen[g.attr['repName']] + g.attr['repLeft']
-        else:
-            trueend = mlen[g.attr['repName']] + g.attr['repStart']
-        assert trueend == g.attr['repEnd']
-        
-        print >>args.outfile, g
+    if args.model_lengths:
+        # Saved for later stages (assembleHERV, polishHERVLoci)
+        utils.write_model_lengths(args.model_lengths, mlen, update=True)
+    
+    ncorrected, violations, offset = 0, [], 0
+    for table in utils.GTFTable.chunks(utils.tab_line_gen(secondpass), args.chunksize):
+        table, fixed = correct_table_coordinates(table, mlen)
+        ncorrected += fixed.sum()
+        # Check that model coordinates are correct
+        violations.extend(offset + np.flatnonzero(check_table_coordinates(table, mlen)))
+        utils.write_lines(args.outfile, ('\t'.join(table.row(i)) for i in xrange(len(table))))
+        offset += len(table)
+    print >>sys.stderr, 'Corrected %d of %d records' % (ncorrected, offset)
+    
+    if violations:
+        print >>sys.stderr, 'ERROR: %d records have incorrect model coordinates:' % len(violations)
+        print >>sys.stderr, '\n'.join('  record %d' % (i+1) for i in violations[:20])
+        if len(violations) > 20:
+            print >>sys.stderr, '  ...'
+        sys.exit(1)
 
 if __name__ == '__main__':
     import argparse
     import sys
     parser = argparse.ArgumentParser(description='Correct model coordinates of GTF converted from UCSC RepeatMasker tables')
+    parser.add_argument('--chunksize', type=int, default=500000,
+                        help="Number of records corrected at a time")
+    parser.add_argument('--model_lengths',
+                        help='''Add model lengths to this table. Lengths of other models
+                                already in the table are kept.''')
     parser.add_argument('infile', nargs='?', type=argparse.FileType('rU'), default=sys.stdin,
                         help="Input GTF with UCSC RepeatMasker records")
     parser.add_argument('outfile', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+
+import sys
+import os
+import time
+
+import utils
+
+def cmd_list(args):
+    dirs = args.cachedir or [os.path.join(os.getcwd(), utils.GTFCACHE_NAME)]
+    print >>args.outfile, '\t'.join(['entry', 'last_used', 'size'])
+    for d in dirs:
+        for entry, used, size in sorted(utils.list_gtf_cache(d), key=lambda x:x[1]):
+            print >>args.outfile, '\t'.join([entry, time.ctime(used), str(size)])
+
+def cmd_invalidate(args):
+    for fn in args.gtf:
+        if utils.invalidate_gtf_cache(fn):
+            print >>sys.stderr, 'Removed cache for %s' % fn
+        else:
+            print >>sys.stderr, 'No cache for %s' % fn
+
+def cmd_clear(args):
+    dirs = args.cachedir or [os.path.join(os.getcwd(), utils.GTFCACHE_NAME)]
+    for d in dirs:
+        n = len(utils.list_gtf_cache(d))
+        utils.evict_gtf_cache(d, 0)
+        print >>sys.stderr, 'Removed %d entries from %s' % (n, d)
+
+def cmd_build(args):
+    for fn in args.gtf:
+        table = utils.read_gtf_table(fn, cache=True)
+        print >>sys.stderr, 'Cached %s (%d lines)' % (fn, len(table))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Manage the cache of parsed GTF files')
+    subparsers = parser.add_subparsers()
+
+    p_list = subparsers.add_parser('list', help='List cache entries')
+    p_list.add_argument('--outfile', type=argparse.FileType('w'), default=sys.stdout,
+                        help="Output file")
+    p_list.add_argument('cachedir', nargs='*',
+                        help="Cache directories (default: ./%s)" % utils.GTFCACHE_NAME)
+    p_list.set_defaults(func=cmd_list)
+
+    p_inval = subparsers.add_parser('invalidate', help='Remove cache entries for GTF files')
+    p_inval.add_argument('gtf', nargs='+',
+                         help="GTF files")
+    p_inval.set_defaults(func=cmd_invalidate)
+
+    p_clear = subparsers.add_parser('clear', help='Remove all entries from cache directories')
+    p_clear.add_argument('cachedir', nargs='*',
+                         help="Cache directories (default: ./%s)" % utils.GTFCACHE_NAME)
+    p_clear.set_defaults(func=cmd_clear)
+
+    p_build = subparsers.add_parser('build', help='Parse GTF files and add to cache')
+    p_build.add_argument('gtf', nargs='+',
+                         help="GTF files (may be gzipped)")
+    p_build.set_defaults(func=cmd_build)
+
+    args = parser.parse_args()
+    args.func(args)
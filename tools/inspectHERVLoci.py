@@ -2,11 +2,9 @@
 
 import os, sys
 # from collections import defaultdict, Counter
-from collections import OrderedDict
 import json
 
 import utils
-from utils import GTFLine
 from IGV import *
 
 # from polishHERVLoci import find_conflicts, groupstr, prompt_cmd
@@ -49,17 +47,8 @@ def main(args):
     if not args.interactive:
         igv.setSleepInterval(args.sleep_interval)
     
-    # Load the GTF
-    combined_gtf = [GTFLine(l) for l in utils.tab_line_gen(args.infile)]
-    
     if args.inspect == 'all':
-        byloc = OrderedDict()
-        for g in combined_gtf:
-            if g.attr['locus'] not in byloc:
-                byloc[g.attr['locus']] = list()
-            byloc[g.attr['locus']].append(g)
-           
-        for locid,locus in byloc.iteritems():
+        for locid,locus in utils.locus_block_gen(args.infile):
             spn = utils.get_span(locus)
             category = spn.attr['category'] if 'category' in spn.attr else None
             ds = get_display_str(locus)
@@ -83,6 +72,7 @@ def main(args):
                 z = utils.raw_input_stderr('%s%s%s ' % (locid.ljust(22), category.ljust(12), ds)).strip()
         
     elif args.inspect == 'overlap':
+        combined_gtf = utils.read_gtf_table(args.infile).lines()
         # Find overlaps within the span features
         overlap_groups = utils.find_overlaps([g for g in combined_gtf if g.feature.startswith('span')])
         overlap_groups = {k:v for k,v in overlap_groups.iteritems() if len(v) > 1}
@@ -131,8 +121,8 @@ if __name__ == '__main__':
     parser.add_argument('--inspect', default='all', choices=['all','overlap',],
                          help='''Select the mode in which the program will run. If 
                                  --inspect is "all", every locus in the GTF will be
-                                 shown. If --inspect is "overlap", bedtools is used to 
-                                 cluster overlapping loci; clusters with 2 or more loci 
+                                 shown. If --inspect is "overlap", overlapping loci are
+                                 clustered; clusters with 2 or more loci 
                                  are shown.''')
     parser.add_argument('--interactive', action='store_true',
                         help='''Enables interactive features. If --inspect is "all", the
@@ -1,70 +1,222 @@
 #! /usr/bin/env python
 
+import heapq
 import utils
 from utils import GTFLine
 from collections import defaultdict
+from multiprocessing import Pool
 
+import numpy as np
 
-def main(args):
-    ### Read the GTF file ################################################################
-    gtf = [GTFLine(l) for l in utils.tab_line_gen(args.infile)]
-    
+
+def merge_bucket(bucket, strand, shortdist=10, longdist=10000):
+    ''' Merge hits on one chromosome and strand
+        bucket is an array with rows start, end, and model coordinate (repLeft for
+        plus strand, repStart for minus strand). Hits on the plus strand are ordered by
+        start, hits on the minus strand by end (descending). Consecutive hits are
+        merged if the genomic distance is <shortdist> or less, or if the model
+        coordinates agree and the distance is less than <longdist>.
+        Returns (order, breaks): indexes of hits in merge order and the positions in
+        order where a new merged hit starts.
+    '''
+    start, end, mcoord = bucket
+    if strand == '+':
+        order = np.argsort(start, kind='mergesort')
+    else:
+        order = np.argsort(-end, kind='mergesort')
+    start, end, mcoord = start[order], end[order], mcoord[order]
+    # Genomic distance between hits
+    if strand == '+':
+        gdist = start[1:] - end[:-1]
+    else:
+        gdist = start[:-1] - end[1:]
+    domerge = (gdist <= shortdist) | ((mcoord[:-1] < mcoord[1:]) & (gdist < longdist))
+    return order, np.flatnonzero(~domerge) + 1
+
+class _MaxTree(object):
+    ''' Segment tree over positions 0..n-1 for prefix maximum queries
+        Each position holds a score and a value, positions can be cleared.
+    '''
+    def __init__(self, n):
+        self.size = 1
+        while self.size < n:
+            self.size *= 2
+        self.score = [-1] * (2 * self.size)
+        self.value = [-1] * (2 * self.size)
+
+    def set(self, pos, score, value):
+        pos += self.size
+        self.score[pos], self.value[pos] = score, value
+        pos //= 2
+        while pos:
+            l, r = 2 * pos, 2 * pos + 1
+            c = l if self.score[l] >= self.score[r] else r
+            self.score[pos], self.value[pos] = self.score[c], self.value[c]
+            pos //= 2
+
+    def prefix_max(self, end):
+        ''' (score, value) with maximum score in positions before end '''
+        best, val = -1, -1
+        lo, hi = self.size, end + self.size
+        while lo < hi:
+            if lo & 1:
+                if self.score[lo] > best: best, val = self.score[lo], self.value[lo]
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                if self.score[hi] > best: best, val = self.score[hi], self.value[hi]
+            lo //= 2
+            hi //= 2
+        return best, val
+
+def chain_scores(start, end, mcoord, shortdist=10, longdist=10000):
+    ''' Score of the best chain ending at each hit
+        Hits are sorted by start. Returns (best, pred), where pred is the previous hit
+        in the best chain or -1.
+    '''
+    n = len(start)
+    # Each hit has its own slot in the tree, ordered by model coordinate. Hits with a
+    # smaller model coordinate than hit j are in the slots before qend[j]
+    morder = np.argsort(mcoord, kind='mergesort')
+    slot = np.empty(n, dtype=np.int64)
+    slot[morder] = np.arange(n)
+    qend = np.searchsorted(mcoord[morder], mcoord, 'left').tolist()
+    slot = slot.tolist()
+    byend = sorted(xrange(n), key=lambda i: end[i])
+
+    tree = _MaxTree(max(n, 1))
+    near = []
+    best, pred = [0] * n, [-1] * n
+    k = 0
+    for j in xrange(n):
+        # Remove hits that are too far away
+        while k < j and end[byend[k]] <= start[j] - longdist:
+            tree.set(slot[byend[k]], -1, -1)
+            k += 1
+        while near and end[near[0][1]] < start[j] - shortdist:
+            heapq.heappop(near)
+        score, i = tree.prefix_max(qend[j])
+        if near and -near[0][0] > score:
+            score, i = -near[0][0], near[0][1]
+        best[j] = end[j] - start[j] + 1 + max(score, 0)
+        pred[j] = i
+        tree.set(slot[j], best[j], j)
+        heapq.heappush(near, (-best[j], j))
+    return best, pred
+
+def chain_bucket(bucket, strand, shortdist=10, longdist=10000):
+    ''' Merge hits on one chromosome and strand by colinear chaining
+        Hits are ordered as in merge_bucket. A hit can follow any earlier hit that
+        ends <shortdist> or less before it, or any earlier hit with a smaller model
+        coordinate that ends less than <longdist> before it. The highest scoring
+        chains (by total hit length) are found by dynamic programming, using a segment
+        tree over model coordinates for hits within <longdist>, so out-of-order
+        fragments do not break a chain. Chains are extracted best first, then chains
+        with overlapping spans (i.e. fragments inside a provirus) are combined.
+        Returns (order, breaks) as merge_bucket.
+    '''
+    start, end, mcoord = bucket
+    if strand == '-':
+        # Mirror coordinates so that hits are in transcription order
+        start, end = -end, -start
+    order = np.argsort(start, kind='mergesort')
+    start, end, mcoord = start[order].tolist(), end[order].tolist(), mcoord[order]
+    n = len(start)
+    best, pred = chain_scores(start, end, mcoord, shortdist, longdist)
+
+    # Extract chains, best first
+    chain = [-1] * n
+    nchains = 0
+    for j in sorted(xrange(n), key=lambda x: -best[x]):
+        if chain[j] >= 0: continue
+        while j >= 0 and chain[j] < 0:
+            chain[j] = nchains
+            j = pred[j]
+        nchains += 1
+
+    # Combine chains with overlapping spans
+    cstart, cend = [None] * nchains, [None] * nchains
+    for j in xrange(n):
+        c = chain[j]
+        if cstart[c] is None:
+            cstart[c], cend[c] = start[j], end[j]
+        else:
+            cend[c] = max(cend[c], end[j])
+    locus = [0] * nchains
+    curend = None
+    for c in sorted(xrange(nchains), key=lambda x: cstart[x]):
+        if curend is not None and cstart[c] <= curend:
+            locus[c] = locus[prev]
+            curend = max(curend, cend[c])
+        else:
+            locus[c] = c
+            curend = cend[c]
+        prev = c
+
+    # Hits in order of locus start, then position
+    lstart = [cstart[locus[chain[j]]] for j in xrange(n)]
+    lorder = np.lexsort((np.arange(n), lstart)) if n else np.array([], dtype=np.int64)
+    lid = np.array([locus[chain[j]] for j in xrange(n)], dtype=np.int64)[lorder]
+    return order[lorder], np.flatnonzero(lid[1:] != lid[:-1]) + 1
+
+MERGE_MODES = {'greedy': merge_bucket, 'chain': chain_bucket}
+
+def _merge_bucket(task):
+    mode, args = task[0], task[1:]
+    return MERGE_MODES[mode](*args)
+
+def merge_hits(gtf, prefix, shortdist=10, longdist=10000, processes=1, mode='greedy'):
+    ''' Merge hits belonging to the same model
+        Hits are grouped by chromosome and strand, and each group is merged by
+        merge_bucket (mode "greedy") or chain_bucket (mode "chain"). If processes > 1,
+        groups are merged in a pool of worker processes; the result is the same as
+        merging serially.
+        Returns list of (locus, [spanning annotation] + hits) for each merged locus.
+    '''
     bychrom = defaultdict(lambda:{'+':list(), '-':list()})
     for g in gtf:
         bychrom[g.chrom][g.strand].append(g)
 
-    merged_hits = []
+    buckets, tasks = [], []
     for cchrom, strands in bychrom.iteritems():
-        # Plus strand
-        if len(strands['+']):
-            strands['+'].sort(key=lambda x:x.start)
-            cur = [ strands['+'][0] ]
-            for g1 in strands['+'][1:]:
-                g0 = cur[-1]
-                # Genomic distance between hits
-                gdist = g1.start - g0.end            
-                if gdist <= args.shortdist:
-                    domerge = True
-                else:
-                    domerge = g0.attr['repLeft'] < g1.attr['repLeft']
-                    domerge &= gdist < args.longdist
-                if domerge:
-                    cur.append(g1)
-                else:
-                    merged_hits.append(cur)
-                    cur = [ g1 ]
-            merged_hits.append(cur)
-
-        # Minus strand
-        if len(strands['-']):
-            strands['-'].sort(key=lambda x:x.end, reverse=True)
-            cur = [ strands['-'][0] ]
-            for g1 in strands['-'][1:]:
-                g0 = cur[-1]
-                # Genomic distance between hits
-                gdist = g0.start - g1.end
-                if gdist <= args.shortdist:
-                    domerge = True
-                else:
-                    domerge = g0.attr['repStart'] < g1.attr['repStart']
-                    domerge &= gdist < args.longdist
-                if domerge:
-                    cur.append(g1)
-                else:
-                    merged_hits.append(cur)
-                    cur = [ g1 ]
-            merged_hits.append(cur)
+        for strand, mattr in [('+', 'repLeft'), ('-', 'repStart')]:
+            hits = strands[strand]
+            if not len(hits): continue
+            arr = np.array([(g.start, g.end, g.attr[mattr]) for g in hits], dtype=np.int64).T
+            buckets.append(hits)
+            tasks.append((mode, arr, strand, shortdist, longdist))
+    
+    if processes > 1 and len(tasks) > 1:
+        pool = Pool(processes)
+        try:
+            results = pool.map(_merge_bucket, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_merge_bucket(t) for t in tasks]
     
+    merged_hits = []
+    for hits, (order, breaks) in zip(buckets, results):
+        for idx in np.split(order, breaks):
+            merged_hits.append([hits[i] for i in idx])
+    
+    ret = []
     for i,cur in enumerate(merged_hits):
-        locid = '%s_%04d' % (args.prefix, i+1)
+        locid = '%s_%04d' % (prefix, i+1)
         spanning = utils.create_spanning(cur)
         spanning.attr['locus'] = locid
         for g in cur:
             g.attr['locus'] = locid
-        
-        print >>args.outfile, '### %s ###' % locid 
-        print >>args.outfile, spanning
-        print >>args.outfile, '\n'.join(str(_) for _ in sorted(cur,key=lambda x:x.start))
+        ret.append((locid, [spanning] + sorted(cur,key=lambda x:x.start)))
+    return ret
+
+def main(args):
+    ### Read the GTF file ################################################################
+    gtf = [GTFLine(l) for l in utils.tab_line_gen(args.infile)]
+    
+    for locid,locus in merge_hits(gtf, args.prefix, args.shortdist, args.longdist, args.processes, args.mode):
+        utils.write_locus(args.outfile, locid, locus)
 
 if __name__ == '__main__':
     import argparse
@@ -78,6 +230,13 @@ if __name__ == '__main__':
                         help='''An extreme distance. Annotations with genomic distance of
                                 <longdist> or less are checked for consistency. If the
                                 model coordinates agree, annotations are merged.''')
+    parser.add_argument('--mode', choices=sorted(MERGE_MODES), default='greedy',
+                        help='''Merge algorithm. "greedy" compares each hit with the
+                                previous hit only. "chain" finds colinear chains of
+                                hits, so out-of-order fragments do not split a locus.''')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='''Number of processes. Hits on each chromosome and strand
+                                are merged in parallel.''')
     parser.add_argument('--prefix',
                         help='''Prefix for locus''')
     parser.add_argument('infile', nargs='?', type=argparse.FileType('rU'), default=sys.stdin,
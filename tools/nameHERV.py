@@ -1,28 +1,26 @@
 #! /usr/bin/env python
-from subprocess import Popen, PIPE
 from string import letters as someletters
 from collections import defaultdict, Counter
 
 import utils
 from utils import GTFLine
 
-def main(args):
-    combined_gtf = [GTFLine(l) for l in utils.tab_line_gen(args.infile)]
-    if args.prefix is None:
-        prefix = Counter(g.attr['locus'].split('_')[0] for g in combined_gtf).most_common()[0][0]
-    else:
-        prefix = args.prefix
+def name_loci(gtf, cytoband=None, prefix=None):
+    ''' Name loci according to cytogenetic band
+        The original locus name is kept in the "oLocus" attribute. If cytoband is
+        not provided, loci keep their original names.
+    '''
+    if prefix is None:
+        prefix = Counter(g.attr['locus'].split('_')[0] for g in gtf).most_common()[0][0]
 
     namemap = {}
-    if args.cytoband:
+    if cytoband:
+        cytobands = utils.load_cytoband_index(cytoband)
+        spans = [g for g in gtf if g.feature.startswith('span')]
         byband = defaultdict(list)
-        p1 = Popen('bedtools intersect -wo -a - -b %s' % args.cytoband, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        o,e = p1.communicate(input='\n'.join(str(g) for g in combined_gtf if g.feature.startswith('span')))
-        for l in utils.tab_line_gen(o.strip('\n').split('\n')):
-            g1 = GTFLine(l[:9])
-            g2 = GTFLine(l[9:-1])
-            band = '%s%s' % (g2.chrom.strip('chr'),g2.attr['gene_id'])
-            byband[band].append(g1)
+        for g,bands in zip(spans, cytobands.assign(spans)):
+            for band in bands:
+                byband[band].append(g)
 
         for band, locs in byband.iteritems():
             if len(locs) == 1:
@@ -32,13 +30,18 @@ def main(args):
                 for i,loc in enumerate(locs):
                     namemap[loc.attr['locus']] = '%s_%s%s' % (prefix, band, someletters[i])
     else:
-        for g in combined_gtf:
+        for g in gtf:
             namemap[g.attr['locus']] = g.attr['locus']
     
-    for g in combined_gtf:
+    for g in gtf:
         g.attr['oLocus'] = g.attr['locus']
         g.attr['locus'] = namemap[g.attr['locus']]
-        print g
+    return gtf
+
+def main(args):
+    combined_gtf = [GTFLine(l) for l in utils.tab_line_gen(args.infile)]
+    name_loci(combined_gtf, args.cytoband, args.prefix)
+    utils.write_lines(args.outfile, (str(g) for g in combined_gtf))
 
 if __name__ == '__main__':
     import argparse
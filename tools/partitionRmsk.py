@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+""" Partition a local RepeatMasker table by HERV family
+
+Reads the UCSC database dump of the rmsk table (rmsk.txt.gz, no header) once and
+writes the records for each model in families.tsv to the family directory, using the
+file names expected by build_family.sh and pipeline.py:
+
+    FAM/INTMODEL.txt      records for the internal model
+    FAM/LTR.MODEL.txt     records for each LTR model
+
+Tables are written with a header line, as returned by the UCSC MySQL server. Records
+are written to the tables of their model as they are read. With --gtf, records are
+converted and corrected as by "rmsk2gtf.py --families" instead, writing
+FAM/INTMODEL.gtf, FAM/LTR.MODEL.gtf and FAM/model_lengths.tsv as created by
+build_family.sh.
+"""
+import os
+import io
+import sys
+import gzip
+from collections import defaultdict
+
+from utils import RMSK_COLUMNS
+
+def open_rmsk(fn):
+    if fn.endswith('.gz'):
+        return io.BufferedReader(gzip.open(fn, 'rb'), 1 << 20)
+    return open(fn, 'rU')
+
+def model_outputs(fams, outdir='.'):
+    ''' Map model name to list of (path without extension, gene region)
+        A model can be used by more than one family.
+    '''
+    outputs = defaultdict(list)
+    for fam, intmodel, ltrmodels, _ in fams:
+        famdir = os.path.join(outdir, fam)
+        outputs[intmodel].append((os.path.join(famdir, intmodel), 'internal'))
+        for model in ltrmodels:
+            outputs[model].append((os.path.join(famdir, 'LTR.%s' % model), 'ltr'))
+    return outputs
+
+def partition_rmsk(rmskfile, outputs):
+    ''' Write records of each model in outputs to PREFIX.txt as they are read
+        Tables are written with a header line. Returns dictionary mapping model name
+        to number of records.
+    '''
+    header = '\t'.join(RMSK_COLUMNS) + '\n'
+    nameidx = RMSK_COLUMNS.index('repName')
+    handles = defaultdict(list)
+    try:
+        for model, outs in outputs.iteritems():
+            for prefix, gene_region in outs:
+                if not os.path.isdir(os.path.dirname(prefix)):
+                    os.makedirs(os.path.dirname(prefix))
+                outh = open(prefix + '.txt', 'w')
+                handles[model].append(outh)
+                outh.write(header)
+        counts = dict.fromkeys(outputs, 0)
+        for l in rmskfile:
+            name = l.split('\t', nameidx + 1)[nameidx]
+            if name in counts:
+                for outh in handles[name]:
+                    outh.write(l)
+                counts[name] += 1
+    finally:
+        for outh in (h for hs in handles.itervalues() for h in hs):
+            outh.close()
+    return counts
+
+def main(args):
+    if args.chroms:
+        chroms = [l.strip('\n').split('\t')[0] for l in args.chroms]
+    else:
+        chroms = None
+    
+    if args.gtf:
+        from rmsk2gtf import write_families
+        print >>sys.stderr, 'Converting records for families in %s' % args.families.name
+        with open_rmsk(args.rmsk) as fh:
+            write_families(fh, args.families, args.outdir, 'rmsk', chroms, header=RMSK_COLUMNS)
+        return
+    
+    from buildHERV import read_families
+    fams = read_families(args.families, None)
+    outputs = model_outputs(fams, args.outdir)
+    print >>sys.stderr, 'Partitioning %d models for %d families' % (len(outputs), len(fams))
+    with open_rmsk(args.rmsk) as fh:
+        counts = partition_rmsk(fh, outputs)
+    for model in sorted(outputs):
+        print >>sys.stderr, '%s%d' % (model.ljust(24), counts[model])
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Partition local RepeatMasker table by HERV family')
+    parser.add_argument('--outdir', default='.',
+                        help="Directory containing family directories")
+    parser.add_argument('--gtf', action='store_true',
+                        help='''Convert records to GTF with corrected model coordinates
+                                and write model lengths (see rmsk2gtf.py --families)
+                                instead of writing tables''')
+    parser.add_argument('--chroms', type=argparse.FileType('rU'),
+                        help='''File with chromosome names, used with --gtf. If
+                                tab-delimited, names must be in first column''')
+    parser.add_argument('families', type=argparse.FileType('rU'),
+                        help="Families table (families.tsv)")
+    parser.add_argument('rmsk',
+                        help="UCSC rmsk table dump (rmsk.txt.gz)")
+    main(parser.parse_args())
@@ -0,0 +1,357 @@
+#! /usr/bin/env python
+""" Build the annotation for one HERV family in a single process
+
+Runs the same stages as build_family.sh, but records are passed between stages as
+GTFLine objects instead of being formatted and reparsed by each script:
+
+    rmsk2gtf -> fixRmskCoords -> sortgtf -> mergeHits -> (flanking LTRs) ->
+    assembleHERV -> filterHERVLoci -> polishHERVLoci -> nameHERV -> transferGTFAttr
+
+Intermediate files are written to the output directory only if --save_intermediate
+is set. Stage outputs are cached in OUTDIR/.stages and reused if the inputs,
+parameters, and tools for the stage have not changed (see Pipeline).
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import subprocess
+
+import utils
+from utils import GTFLine
+from rmsk2gtf import convert_rows
+from fixRmskCoords import correct_rmsk_model_coordinates, check_rmsk_model_coordinates
+from mergeHits import merge_hits
+from assembleHERV import join_flanking_ltrs, assemble_locus
+from filterHERVLoci import filter_loci
+from polishHERVLoci import find_conflicts, resolve_conflicts
+from nameHERV import name_loci
+from transferGTFAttr import transfer_attr
+
+UCSC_MYSQL = 'genome-mysql.cse.ucsc.edu'
+
+def download_rmsk(model, db, outfn):
+    ''' Download RepeatMasker table for model from UCSC '''
+    cmd = ['mysql', '-h', UCSC_MYSQL, '-u', 'genome', '-D', db, '-A',
+           '-e', "SELECT * FROM rmsk WHERE repName = '%s';" % model]
+    with open(outfn, 'w') as outh:
+        subprocess.check_call(cmd, stdout=outh)
+
+def load_rmsk(fn, gene_region, chroms):
+    ''' Convert RepeatMasker table to GTFLine objects with corrected coordinates '''
+    with open(fn, 'rU') as fh:
+        gtf = [GTFLine(r) for r in convert_rows(fh, gene_region, 'rmsk', chroms)]
+    mlen = utils.guess_rmsk_model_lengths(gtf)
+    gtf = correct_rmsk_model_coordinates(gtf, mlen)
+    gtf = check_rmsk_model_coordinates(gtf, mlen)
+    return utils.sort_gtflines(gtf, chroms)
+
+def flatten(loci):
+    ''' Concatenate annotations from (locus, annotations) pairs '''
+    return [g for locid,locus in loci for g in locus]
+
+# Stages: dependencies, modules with stage logic, and parameters included in the key
+STAGES = [('internal',  [],                       ['rmsk2gtf', 'fixRmskCoords'], ['chroms']),
+          ('ltr',       [],                       ['rmsk2gtf', 'fixRmskCoords'], ['chroms']),
+          ('merged',    ['internal'],             ['mergeHits'], ['shortdist', 'longdist', 'merge_mode', 'chroms']),
+          ('assembled', ['merged', 'ltr'],        ['assembleHERV'], ['flank', 'chroms']),
+          ('filtered',  ['assembled'],            ['filterHERVLoci'], ['min_internal_pct', 'min_internal_bases', 'chroms']),
+          ('polished',  ['filtered'],             ['polishHERVLoci', 'assembleHERV'], ['chroms']),
+          ('final',     ['polished'],             ['nameHERV', 'transferGTFAttr'], []),
+         ]
+
+def source_sha1(fn):
+    ''' SHA1 digest of Python source, fn may be the compiled file '''
+    return utils.file_sha1(fn[:-1] if fn.endswith('.pyc') else fn)
+
+def module_sha1(name):
+    ''' SHA1 digest of module source '''
+    return source_sha1(sys.modules[name].__file__)
+
+class Pipeline(object):
+    ''' Build annotation for one family
+        The output of each stage is cached in OUTDIR/.stages, named by a key computed
+        from the keys of the stages it depends on, the contents of its input files,
+        its parameters, and the source code of the modules implementing it (including
+        pipeline.py and utils). A stage is only run if no cached output exists for its
+        key.
+    '''
+    def __init__(self, args):
+        self.args = args
+        self.chroms = None
+        self.chromsizes = None
+        if args.chroms:
+            self.chromsizes = utils.read_chrom_sizes(args.chroms)
+            self.chroms = self.chromsizes.keys()
+        self.resolve_file = args.resolve_file or 'resolve.%s.json' % args.fam
+        self.results = {}
+        self.mlen = None
+        self.cache_hits = 0
+        self.t0 = time.time()
+
+    def log(self, msg):
+        print >>sys.stderr, '[%7.1fs] %s' % (time.time() - self.t0, msg)
+
+    def path(self, fn):
+        return os.path.join(self.args.outdir, fn)
+
+    def save(self, fn, gtf, loci=False):
+        ''' Write intermediate file if --save_intermediate is set '''
+        if not self.args.save_intermediate:
+            return
+        with open(self.path(fn), 'w') as outh:
+            if loci:
+                for locid,locus in gtf:
+                    utils.write_locus(outh, locid, locus)
+            else:
+                utils.write_lines(outh, (str(g) for g in gtf))
+
+    def rmsk_table(self, model, fn):
+        fn = self.path(fn)
+        if not os.path.exists(fn):
+            if self.args.rmsk_db is not None:
+                store = utils.open_rmsk_store(self.args.rmsk_db)
+                with open(fn, 'w') as outh:
+                    store.write_table(outh, store.models([model]))
+            elif self.args.db is not None:
+                self.log('Downloading %s from %s' % (model, self.args.db))
+                download_rmsk(model, self.args.db, fn)
+            else:
+                sys.exit('ERROR: %s not found. Use --rmsk_db or --db to obtain tables.' % fn)
+        return fn
+
+    ### Stage keys and cache #############################################################
+    def stage_inputs(self):
+        ''' Input files for each stage '''
+        args = self.args
+        return {'internal': [self.rmsk_table(args.intmodel, '%s.txt' % args.intmodel)],
+                'ltr': [self.rmsk_table(m, 'LTR.%s.txt' % m) for m in args.ltrmodels],
+                'polished': [self.resolve_file],
+                'final': [args.cytoband],
+                }
+
+    def compute_keys(self):
+        inputs = self.stage_inputs()
+        params = vars(self.args).copy()
+        params['chroms'] = utils.file_sha1(self.args.chroms.name) if self.args.chroms else None
+        # The stage glue code is in this file, which may be running as __main__
+        tools = [('pipeline', source_sha1(os.path.abspath(__file__))), ('utils', module_sha1('utils'))]
+        self.keys = {}
+        for name, deps, modules, pnames in STAGES:
+            desc = [name,
+                    [self.keys[d] for d in deps],
+                    [(os.path.basename(fn), utils.file_sha1(fn)) if fn and os.path.exists(fn) else fn
+                        for fn in inputs.get(name, [])],
+                    [(p, params[p]) for p in pnames],
+                    tools + [(m, module_sha1(m)) for m in modules],
+                    ]
+            self.keys[name] = hashlib.sha1(json.dumps(desc)).hexdigest()
+        return self.keys
+
+    def cache_path(self, name):
+        return self.path(os.path.join('.stages', '%s.%s.gtf' % (name, self.keys[name][:16])))
+
+    def cached(self, name):
+        return not self.args.force and os.path.exists(self.cache_path(name))
+
+    def get(self, name):
+        ''' Output of stage, from cache if available, otherwise run the stage '''
+        if name in self.results:
+            return self.results[name]
+        fn = self.cache_path(name)
+        if self.cached(name):
+            self.log('Using cached %s' % name)
+            self.cache_hits += 1
+            gtf = utils.read_gtf_table(fn).lines()
+        else:
+            self.log('Running %s' % name)
+            gtf = getattr(self, 'stage_%s' % name)()
+            cachedir = os.path.dirname(fn)
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+            # Remove outputs with other keys
+            for old in os.listdir(cachedir):
+                if old.startswith('%s.' % name):
+                    utils.invalidate_gtf_cache(os.path.join(cachedir, old))
+                    os.remove(os.path.join(cachedir, old))
+            with open(fn + '.tmp', 'w') as outh:
+                utils.write_lines(outh, (str(g) for g in gtf))
+            os.rename(fn + '.tmp', fn)
+        self.results[name] = gtf
+        return gtf
+
+    def get_table(self, name, catattrs=()):
+        ''' Output of stage as GTFTable, loaded through the GTF parse cache '''
+        if not self.cached(name):
+            self.get(name)
+        return utils.read_gtf_table(self.cache_path(name), catattrs=catattrs)
+
+    def model_lengths(self):
+        ''' Lengths of internal and LTR models, computed once from the corrected hits
+            The table is cached with the keys of the internal and LTR stages and
+            copied to OUTDIR/model_lengths.tsv.
+        '''
+        if self.mlen is not None:
+            return self.mlen
+        key = hashlib.sha1(self.keys['internal'] + self.keys['ltr']).hexdigest()
+        fn = self.path(os.path.join('.stages', 'model_lengths.%s.tsv' % key[:16]))
+        if self.args.force or not os.path.exists(fn):
+            mlen = utils.guess_rmsk_model_lengths(self.get('internal') + self.get('ltr'))
+            cachedir = os.path.dirname(fn)
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+            for old in os.listdir(cachedir):
+                if old.startswith('model_lengths.'):
+                    os.remove(os.path.join(cachedir, old))
+            utils.write_model_lengths(fn, mlen)
+        self.mlen = utils.load_model_lengths(fn)
+        shutil.copyfile(fn, self.path('model_lengths.tsv'))
+        return self.mlen
+
+    ### Stages ###########################################################################
+    def stage_internal(self):
+        args = self.args
+        gtf = load_rmsk(self.path('%s.txt' % args.intmodel), 'internal', self.chroms)
+        self.save('%s.gtf' % args.intmodel, gtf)
+        self.log('Internal model %s: %d hits' % (args.intmodel, len(gtf)))
+        return gtf
+
+    def stage_ltr(self):
+        ltr_gtf = []
+        for model in self.args.ltrmodels:
+            _gtf = load_rmsk(self.path('LTR.%s.txt' % model), 'ltr', self.chroms)
+            self.save('LTR.%s.gtf' % model, _gtf)
+            self.log('LTR model %s: %d hits' % (model, len(_gtf)))
+            ltr_gtf.extend(_gtf)
+        return ltr_gtf
+
+    def stage_merged(self):
+        args = self.args
+        merged = merge_hits(self.get('internal'), args.fam, args.shortdist, args.longdist,
+                            mode=args.merge_mode)
+        merged = utils.sort_gtflines(flatten(merged), self.chroms)
+        self.save('internal.merged.gtf', merged)
+        return merged
+
+    def stage_assembled(self):
+        # Find LTRs flanking internal regions
+        merged = self.get('merged')
+        spans = [g for g in merged if g.feature.startswith('span')]
+        self.log('Merged into %d loci' % len(spans))
+        ltrs = join_flanking_ltrs(spans, self.get('ltr'), self.args.flank, self.chromsizes)
+
+        # Assemble HERV proviruses
+        model_lengths = self.model_lengths()
+        assembled = []
+        for locid,locus in utils.locus_blocks(merged):
+            locus = [g for g in locus if not g.feature.startswith('span')] + ltrs.pop(locid, [])
+            assembled.extend(assemble_locus(locid, locus, model_lengths))
+        assembled = utils.sort_gtflines(assembled, self.chroms)
+        self.save('assembled.gtf', assembled)
+        return assembled
+
+    def stage_filtered(self):
+        args = self.args
+        filtered, rejected = [], []
+        for locid,locus,passed in filter_loci(utils.locus_blocks(self.get('assembled')),
+                                              args.min_internal_pct, args.min_internal_bases):
+            (filtered if passed else rejected).append((locid, locus))
+        self.log('Rejected %d loci, %d remaining' % (len(rejected), len(filtered)))
+        self.save('rejected.gtf', rejected, loci=True)
+        filtered = utils.sort_gtflines(flatten(filtered), self.chroms)
+        self.save('filtered.gtf', filtered)
+        return filtered
+
+    def stage_polished(self):
+        filtered = self.get('filtered')
+        overlap_groups = find_conflicts(filtered)
+        if not overlap_groups:
+            self.log('No overlaps found')
+            return filtered
+        self.log('%d overlaps found' % len(overlap_groups))
+        if not os.path.exists(self.resolve_file):
+            sys.exit('ERROR: %d overlaps found but %s does not exist.' % (len(overlap_groups), self.resolve_file))
+        with open(self.resolve_file, 'rU') as fh:
+            resolve_cmds = json.load(fh)
+        byloc = resolve_conflicts(filtered, overlap_groups, resolve_cmds, self.model_lengths())
+        polished = utils.sort_gtflines(flatten(byloc.iteritems()), self.chroms)
+        self.save('polished.gtf', polished)
+        return polished
+
+    def stage_final(self):
+        # Rename loci by genomic location
+        final = name_loci(self.get('polished'), self.args.cytoband)
+        final = transfer_attr(final, 'locus', 'transcript_id')
+        final = transfer_attr(final, 'locus', 'gene_id')
+        return list(final)
+
+    def run(self):
+        ''' Build FAM.gtf, returns key of the final stage '''
+        self.compute_keys()
+        outfn = self.path('%s.gtf' % self.args.fam)
+        if self.cached('final'):
+            self.log('All stages are up to date')
+            self.cache_hits += 1
+        else:
+            self.get('final')
+        shutil.copyfile(self.cache_path('final'), outfn)
+        self.model_lengths()
+        self.log('Wrote %s' % outfn)
+        return self.keys['final']
+
+def main(args):
+    if args.outdir is None:
+        args.outdir = args.fam
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    p = Pipeline(args)
+    p.run()
+    return p
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Build HERV annotation for one family',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--chroms', type=argparse.FileType('rU'),
+                        help='''Chromosome sizes (i.e. chrom.sizes). Used for sorting and
+                                for clipping flanking regions.''')
+    parser.add_argument('--cytoband',
+                        help="Cytoband GTF used for naming loci")
+    parser.add_argument('--shortdist', type=int, default=10,
+                        help="Hits closer than this are always merged")
+    parser.add_argument('--longdist', type=int, default=10000,
+                        help="Maximum distance between merged hits")
+    parser.add_argument('--merge_mode', choices=['greedy', 'chain'], default='greedy',
+                        help="Algorithm for merging internal hits (see mergeHits.py)")
+    parser.add_argument('--min_internal_pct', type=float, default=0.1,
+                        help="Minimum fraction of internal model matched")
+    parser.add_argument('--min_internal_bases', type=int, default=0,
+                        help="Minimum number of bases matching internal model")
+    parser.add_argument('--resolve_file',
+                        help='''JSON file with commands for resolving conflicts. Default
+                                is resolve.FAM.json''')
+    parser.add_argument('--db',
+                        help='''UCSC database (i.e. hg19). RepeatMasker tables missing
+                                from the output directory are downloaded.''')
+    parser.add_argument('--rmsk_db',
+                        help='''RepeatMasker store (see rmskdb.py). RepeatMasker tables
+                                missing from the output directory are extracted from
+                                the store.''')
+    parser.add_argument('--outdir',
+                        help='''Output directory, also containing the RepeatMasker tables
+                                MODEL.txt and LTR.MODEL.txt. Default is FAM''')
+    parser.add_argument('--save_intermediate', action='store_true',
+                        help="Write output of each stage to output directory")
+    parser.add_argument('--force', action='store_true',
+                        help="Run all stages, ignoring cached outputs")
+    parser.add_argument('fam',
+                        help="Family name, used as prefix for loci")
+    parser.add_argument('intmodel',
+                        help="Name of internal model")
+    parser.add_argument('ltrmodels', type=lambda x: x.split(','),
+                        help="Comma-separated names of LTR models")
+    parser.add_argument('flank', type=int,
+                        help="Size of flanking region for finding LTRs")
+    main(parser.parse_args())
@@ -25,12 +25,13 @@ def resolve_reject(cmd, cgroup, fulllocs):
     for r in rem: del fulllocs[r]
     return fulllocs
 
-def resolve_merge(cmd, cgroup, fulllocs):
+def resolve_merge(cmd, cgroup, fulllocs, model_lengths=None):
     ''' Resolve conflict by merging loci
         Take the union of annotations from conflicting loci (without spanning annotations),
         create a new spanning annotation. If no argument is provided, default is to merge
         all loci. If an argument is provided, it must be delimited by '+' and loci that 
-        are not listed are removed.
+        are not listed are removed. If model_lengths is not provided, model lengths are
+        guessed from the merged annotations.
     '''
     if len(cmd) == 1:
         mer = [a.attr['locus'] for a in cgroup]
@@ -44,7 +45,8 @@ def resolve_merge(cmd, cgroup, fulllocs):
     newloc = [a for a in chain.from_iterable(fulllocs[m] for m in mer) if not a.feature.startswith('span')]
     newstrand = Counter(a.strand for a in newloc).most_common()[0][0]    
     # Calculate model information
-    model_lengths = utils.guess_rmsk_model_lengths(newloc)
+    if model_lengths is None:
+        model_lengths = utils.guess_rmsk_model_lengths(newloc)
     internal_model = get_internal_model(newloc)
     # Remove duplicates, adjust overlaps
     newloc = utils.remove_dups(newloc)
@@ -79,10 +81,11 @@ def resolve_merge(cmd, cgroup, fulllocs):
     return { newloc_id : [spn] + newloc }
 
 
-def resolve_diff(cmd, cgroup, fulllocs):
+def resolve_diff(cmd, cgroup, fulllocs, model_lengths=None):
     ''' Resolve conflict by subtracting loci
         The overlapping portion is removed from A and the remaining portion of A is 
-        reported. B is reported without changes.
+        reported. B is reported without changes. If model_lengths is not provided,
+        model lengths are guessed from the annotations of A.
     '''
     assert len(cgroup) == 2, "Only two loci allowed for diff"
     if len(cmd) == 1:
@@ -102,7 +105,8 @@ def resolve_diff(cmd, cgroup, fulllocs):
 
     newloc = sorted(fulllocs[idA], key=lambda x:x.start)
     newloc = [loc for loc in newloc if not loc.feature.startswith('span')]
-    model_lengths = utils.guess_rmsk_model_lengths(newloc)
+    if model_lengths is None:
+        model_lengths = utils.guess_rmsk_model_lengths(newloc)
     internal_model = get_internal_model(newloc)
     
     trimside = None
@@ -171,22 +175,53 @@ def resolve_diff(cmd, cgroup, fulllocs):
     fulllocs[idA] = [spn] + newloc
     return fulllocs
 
-def resolve(cmd, cgroup, fulllocs):
+def resolve(cmd, cgroup, fulllocs, model_lengths=None):
     if cmd[0] == 'ignore':
         return fulllocs
     elif cmd[0] == 'reject':
         return resolve_reject(cmd, cgroup, fulllocs)
     elif cmd[0] == 'diff':
-        return resolve_diff(cmd, cgroup, fulllocs)
+        return resolve_diff(cmd, cgroup, fulllocs, model_lengths)
     elif cmd[0] == 'merge':
-        return resolve_merge(cmd, cgroup, fulllocs)
+        return resolve_merge(cmd, cgroup, fulllocs, model_lengths)
+
+def find_conflicts(gtf):
+    ''' Find groups of loci with overlapping spans
+        Returns dictionary mapping group id to spanning annotations in group.
+    '''
+    overlap_groups = utils.find_overlaps([g for g in gtf if g.feature.startswith('span')])
+    return {k:v for k,v in overlap_groups.iteritems() if len(v) > 1}
+
+def resolve_conflicts(gtf, overlap_groups, resolve_cmds, model_lengths=None):
+    ''' Resolve conflicting loci using resolve commands
+        model_lengths is used for model coverage of merged or trimmed loci, see
+        utils.load_model_lengths. Returns dictionary mapping locus id to annotations.
+    '''
+    byloc = defaultdict(list)
+    for g in gtf:
+        byloc[g.attr['locus']].append(g)
+    
+    for groupid, ogroup in overlap_groups.iteritems():
+        print >>sys.stderr, utils.groupstr(groupid, ogroup)    
+        locids = [a.attr['locus'] for a in ogroup]
+        # Temporarily remove the loci
+        fulllocs = {}
+        for locid in locids:
+            print >>sys.stderr, '\tRemoving %s' % locid      
+            fulllocs[locid] = byloc.pop(locid)
+        assert groupid in resolve_cmds
+        newlocs = resolve(resolve_cmds[groupid], ogroup, fulllocs, model_lengths)
+        for newlocid, newlocus in newlocs.iteritems():
+            print >>sys.stderr, '\tInserting %s' % newlocid
+            # print >>sys.stderr, '\n'.join(str(_) for _ in newlocus)
+        byloc.update(newlocs)
+    return byloc
 
 def main(args):
     combined_gtf = [GTFLine(l) for l in utils.tab_line_gen(args.infile)]
 
     # Find overlaps within the span features
-    overlap_groups = utils.find_overlaps([g for g in combined_gtf if g.feature.startswith('span')])
-    overlap_groups = {k:v for k,v in overlap_groups.iteritems() if len(v) > 1}
+    overlap_groups = find_conflicts(combined_gtf)
     print >>sys.stderr, "Found %d groups with conflict." % len(overlap_groups)    
     
     # Resolve commands
@@ -209,28 +244,12 @@ def main(args):
         print >>sys.stderr, json.dumps(resolve_cmds)
 
     # Resolve the conflicts
-    byloc = defaultdict(list)
-    for g in combined_gtf:
-        byloc[g.attr['locus']].append(g)
-    
-    for groupid, ogroup in overlap_groups.iteritems():
-        print >>sys.stderr, utils.groupstr(groupid, ogroup)    
-        locids = [a.attr['locus'] for a in ogroup]
-        # Temporarily remove the loci
-        fulllocs = {}
-        for locid in locids:
-            print >>sys.stderr, '\tRemoving %s' % locid      
-            fulllocs[locid] = byloc.pop(locid)
-        assert groupid in resolve_cmds
-        newlocs = resolve(resolve_cmds[groupid], ogroup, fulllocs)
-        for newlocid, newlocus in newlocs.iteritems():
-            print >>sys.stderr, '\tInserting %s' % newlocid
-            # print >>sys.stderr, '\n'.join(str(_) for _ in newlocus)
-        byloc.update(newlocs)
-
+    model_lengths = None
+    if args.model_lengths is not None:
+        model_lengths = utils.load_model_lengths(args.model_lengths)
+    byloc = resolve_conflicts(combined_gtf, overlap_groups, resolve_cmds, model_lengths)
     for locid,locus in byloc.iteritems():
-        print >>args.outfile, '### %s ###' % locid
-        print >>args.outfile, '\n'.join(str(_) for _ in sorted(locus,key=lambda x:x.start))
+        utils.write_locus(args.outfile, locid, sorted(locus,key=lambda x:x.start))
 
 if __name__ == '__main__':
     import argparse
@@ -241,6 +260,10 @@ if __name__ == '__main__':
                         help='''String with resolve commands, in JSON format''')
     parser.add_argument('--resolve_file', type=argparse.FileType('rU'),
                         help='''File containing resolve commands, in JSON format''')    
+    parser.add_argument('--model_lengths',
+                        help='''Model lengths table written by fixRmskCoords. If not
+                                provided, lengths are guessed from the annotations of
+                                each resolved locus.''')
     parser.add_argument('infile', type=argparse.FileType('rU'),
                         help="GTF with HERV loci")
     parser.add_argument('outfile', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
@@ -1,63 +1,288 @@
 #! /usr/bin/env python
+""" Convert UCSC RepeatMasker table to GTF
 
+The table is read in chunks. Each record is formatted as soon as it is read, with
+column indices resolved once, and buffered by chromosome together with its start
+position. Buffers are sorted by start position using arrays of integer keys, and the
+"id" counter is assigned in sorted order.
 
-def convert(infile, outfile, gene_region, source, chroms):
-    from collections import defaultdict
-    import math
-    
-    alllines = defaultdict(list)  
-    lines = (l.strip('\n').split('\t') for l in infile)
-    header = lines.next()
-
-    # Find column indices
-    cidx = header.index('genoName')
-    sidx = header.index('genoStart')
-    eidx = header.index('genoEnd')
-    stidx = header.index('strand')
-    
-    # Organize original lines by chromosome
-    for l in lines:
-        alllines[ l[cidx] ].append(l)
-    
+If --max_rows is given, buffered records are spilled to temporary files (one per
+chromosome) whenever more than max_rows records are held in memory, so the complete
+UCSC rmsk table can be converted in bounded memory.
+
+With --families, the records for all models in families.tsv are converted in a single
+pass over the complete table. Each model is numbered separately, so the output for a
+model is the same as converting its table alone.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+from array import array
+from operator import itemgetter
+from collections import defaultdict
+from itertools import islice
+
+import numpy as np
+
+import utils
+
+# Placeholder for the id counter, which is filled in after sorting
+IDMARK = '\0'
+
+def record_format(header, gene_region, source):
+    ''' Returns function that formats a split table line as a GTF line
+        Column indices are looked up once. The id attribute of the formatted line is
+        "REPNAME_" followed by IDMARK.
+    '''
+    # Attributes are written in the order the attribute dictionary was iterated in
+    # earlier versions, so output does not change
+    attrs = {'repStart': 'repStart',
+             'repEnd': 'repEnd',
+             'repLeft': 'repLeft',
+             'id': 'repName',
+             'repName': 'repName',
+             'repClass': 'repClass',
+             'repFamily': 'repFamily',
+             }
+    if gene_region is not None:
+        attrs['geneRegion'] = None
+    fmt, cols = [], []
+    for k,c in attrs.iteritems():
+        if k == 'id':
+            fmt.append('id "%s_' + IDMARK + '";')
+        elif k == 'geneRegion':
+            fmt.append('geneRegion "%s";' % gene_region.replace('%', '%%'))
+        else:
+            fmt.append('%s "%%s";' % k)
+        if c is not None:
+            cols.append(header.index(c))
+    fmt = '\t'.join(['%s', source.replace('%', '%%'), 'exon', '%d', '%s', '%s', '%s', '.', ' '.join(fmt)])
+
+    cidx, sidx, eidx = header.index('genoName'), header.index('genoStart'), header.index('genoEnd')
+    scidx, stidx = header.index('swScore'), header.index('strand')
+    getattrs = itemgetter(*cols)
+    def _format(l):
+        # Add 1 to start because GTF is 1-based. Don't change end because GTF is inclusive
+        spos = int(l[sidx]) + 1
+        assert spos < int(l[eidx]), "ERROR start >= end %s" % l
+        return fmt % ((l[cidx], spos, l[eidx], l[scidx], l[stidx]) + getattrs(l))
+    return _format
+
+class ChromBuffers(object):
+    ''' Formatted records and start positions by chromosome
+        Start positions are kept in integer arrays. If max_rows is set, all buffers
+        are spilled to temporary files when more than max_rows records are held.
+    '''
+    def __init__(self, max_rows=None, tmpdir=None):
+        self.max_rows = max_rows
+        self.tmpdir = tmpdir
+        self.spilldir = None
+        self.spilled = set()
+        self.lines = defaultdict(list)
+        self.starts = defaultdict(lambda: array('l'))
+        self.nrows = 0
+
+    def add(self, chrom, start, line):
+        self.lines[chrom].append(line)
+        self.starts[chrom].append(start)
+        self.nrows += 1
+        if self.max_rows is not None and self.nrows > self.max_rows:
+            self.spill()
+
+    def chroms(self):
+        return set(self.lines) | self.spilled
+
+    def _spillfn(self, chrom, ext):
+        return os.path.join(self.spilldir, '%s.%s' % (chrom, ext))
+
+    def spill(self):
+        ''' Append all buffers to temporary files '''
+        if self.spilldir is None:
+            self.spilldir = tempfile.mkdtemp(dir=self.tmpdir)
+        for chrom in self.lines:
+            with open(self._spillfn(chrom, 'txt'), 'ab') as outh:
+                utils.write_lines(outh, self.lines[chrom])
+            with open(self._spillfn(chrom, 'start'), 'ab') as outh:
+                self.starts[chrom].tofile(outh)
+            self.spilled.add(chrom)
+        self.lines.clear()
+        self.starts.clear()
+        self.nrows = 0
+
+    def pop(self, chrom):
+        ''' Remove records for chromosome, returns (lines, starts as numpy array) '''
+        lines, starts = [], array('l')
+        if chrom in self.spilled:
+            with open(self._spillfn(chrom, 'txt'), 'rb') as fh:
+                lines = fh.read().split('\n')[:-1]
+            with open(self._spillfn(chrom, 'start'), 'rb') as fh:
+                starts.fromfile(fh, len(lines))
+            os.remove(self._spillfn(chrom, 'txt'))
+            os.remove(self._spillfn(chrom, 'start'))
+            self.spilled.discard(chrom)
+        inmem = self.lines.pop(chrom, [])
+        self.nrows -= len(inmem)
+        lines.extend(inmem)
+        starts.extend(self.starts.pop(chrom, array('l')))
+        return lines, np.frombuffer(starts, dtype='i%d' % starts.itemsize)
+
+    def cleanup(self):
+        if self.spilldir is not None:
+            shutil.rmtree(self.spilldir, ignore_errors=True)
+
+def _read_header(infile, header):
+    infile = iter(infile)
+    if header is None:
+        header = infile.next().strip('\n').split('\t')
+    return infile, header
+
+def sorted_lines(buffers, chroms):
+    ''' Remove lines from ChromBuffers sorted by chromosome and start position
+        The id counter starts at 1 and follows the sorted order.
+    '''
     # Chroms was not provided
     if chroms is None:
-        chroms = sorted(alllines.keys())
+        chroms = sorted(buffers.chroms())
 
-    # Sorting and formatting lines
+    # Sorting and numbering lines
     counter = 1
     for cchrom in chroms:
-        if cchrom not in alllines: continue 
-        for l in sorted(alllines[cchrom],key=lambda x:int(x[sidx])):
-            # Add 1 to start because GTF is 1-based
-            spos = '%d' % (int(l[sidx]) + 1)
-            # Don't change end because GTF is inclusive
-            epos = l[eidx]
-            assert int(spos)<int(epos), "ERROR start >= end %s" % l      
-            score = l[header.index('swScore')]
-            
-            # Attributes
-            attrs = {'repStart': l[header.index('repStart')],
-                     'repEnd': l[header.index('repEnd')],
-                     'repLeft': l[header.index('repLeft')],
-                     'id': '%s_%d' % (l[header.index('repName')], counter),
-                     'repName': l[header.index('repName')],
-                     'repClass': l[header.index('repClass')],
-                     'repFamily': l[header.index('repFamily')],
-                     }
-            if gene_region is not None:
-                attrs['geneRegion'] = gene_region
-            attr = ' '.join('%s "%s";' % (k,v) for k,v in attrs.iteritems())
-            print >>outfile, '\t'.join([cchrom,source,'exon',spos,epos,score,l[stidx],'.',attr])
+        if cchrom not in buffers.chroms(): continue
+        lines, starts = buffers.pop(cchrom)
+        for i in np.argsort(starts, kind='mergesort').tolist():
+            yield lines[i].replace(IDMARK, str(counter))
             counter += 1
 
+def convert_lines(infile, gene_region, source, chroms, header=None, chunksize=100000,
+                  max_rows=None, tmpdir=None):
+    ''' Convert UCSC RepeatMasker table to GTF
+        Yields lines (strings) sorted by chromosome and start position. If header is
+        None, the first line of infile is the header. Records are spilled to disk when
+        more than max_rows are held in memory (see ChromBuffers).
+    '''
+    infile, header = _read_header(infile, header)
+    fmtrow = record_format(header, gene_region, source)
+    cidx, sidx = header.index('genoName'), header.index('genoStart')
+
+    # Organize formatted lines by chromosome
+    buffers = ChromBuffers(max_rows, tmpdir)
+    try:
+        while True:
+            chunk = list(islice(infile, chunksize))
+            if not chunk:
+                break
+            for l in chunk:
+                l = l.strip('\n').split('\t')
+                buffers.add(l[cidx], int(l[sidx]), fmtrow(l))
+        for l in sorted_lines(buffers, chroms):
+            yield l
+    finally:
+        buffers.cleanup()
+
+def convert_models(infile, outputs, source, chroms, header=None, chunksize=100000,
+                   max_rows=None, tmpdir=None):
+    ''' Convert records for several models with one pass over the table
+        outputs maps model name to list of (output prefix, gene region), see
+        partitionRmsk.model_outputs. Records of other models are skipped. Yields
+        (model, gene region, prefixes, lines) for each model and gene region. Lines
+        are sorted and numbered as if the model was converted alone with
+        convert_lines, so ids do not depend on which other models are converted.
+    '''
+    infile, header = _read_header(infile, header)
+    cidx, sidx = header.index('genoName'), header.index('genoStart')
+    nidx = header.index('repName')
+    targets = defaultdict(list)
+    for model in sorted(outputs):
+        for gene_region in sorted(set(r for p,r in outputs[model])):
+            targets[model].append((gene_region, record_format(header, gene_region, source),
+                                   ChromBuffers(max_rows, tmpdir)))
+    try:
+        while True:
+            chunk = list(islice(infile, chunksize))
+            if not chunk:
+                break
+            for l in chunk:
+                if l.split('\t', nidx + 1)[nidx] not in targets: continue
+                l = l.strip('\n').split('\t')
+                for gene_region, fmtrow, buffers in targets[l[nidx]]:
+                    buffers.add(l[cidx], int(l[sidx]), fmtrow(l))
+        for model in sorted(targets):
+            for gene_region, _, buffers in targets[model]:
+                prefixes = [p for p,r in outputs[model] if r == gene_region]
+                yield model, gene_region, prefixes, sorted_lines(buffers, chroms)
+    finally:
+        for model in targets:
+            for _, _, buffers in targets[model]:
+                buffers.cleanup()
+
+def convert_rows(infile, gene_region, source, chroms):
+    ''' Convert UCSC RepeatMasker table to GTF
+        Yields rows (lists) sorted by chromosome and start position.
+    '''
+    for l in convert_lines(infile, gene_region, source, chroms):
+        yield l.split('\t')
+
+def convert(infile, outfile, gene_region, source, chroms, **kwargs):
+    ''' Convert table to GTF file, returns number of records written '''
+    nrows = [0]
+    def _counted(lines):
+        for l in lines:
+            nrows[0] += 1
+            yield l
+    utils.write_lines(outfile, _counted(convert_lines(infile, gene_region, source, chroms, **kwargs)),
+                      blocksize=100000)
+    return nrows[0]
+
+def write_families(infile, famfile, outdir, source, chroms, **kwargs):
+    ''' Convert and correct RepeatMasker records for all families in one pass
+        Writes FAM/INTMODEL.gtf, FAM/LTR.MODEL.gtf, and FAM/model_lengths.tsv, as
+        created by build_family.sh. Returns number of records written.
+    '''
+    from buildHERV import read_families
+    from partitionRmsk import model_outputs
+    from fixRmskCoords import correct_table_coordinates, check_table_coordinates
+    outputs = model_outputs(read_families(famfile, None), outdir)
+    nrows = 0
+    for model, gene_region, prefixes, lines in convert_models(infile, outputs, source, chroms, **kwargs):
+        table = utils.GTFTable.from_rows(l.split('\t') for l in lines)
+        mlen = utils.guess_rmsk_model_lengths(table)
+        table, fixed = correct_table_coordinates(table, mlen)
+        nbad = check_table_coordinates(table, mlen).sum()
+        if nbad:
+            sys.exit('ERROR: %d records for %s have incorrect model coordinates' % (nbad, model))
+        print >>sys.stderr, '%s%-10s%10d records%10d corrected' % (model.ljust(24), gene_region, len(table), fixed.sum())
+        for prefix in prefixes:
+            if not os.path.isdir(os.path.dirname(prefix)):
+                os.makedirs(os.path.dirname(prefix))
+            with open(prefix + '.gtf', 'w') as outh:
+                utils.write_lines(outh, ('\t'.join(table.row(i)) for i in xrange(len(table))),
+                                  blocksize=100000)
+            utils.write_model_lengths(os.path.join(os.path.dirname(prefix), 'model_lengths.tsv'),
+                                      mlen, update=True)
+            nrows += len(table)
+    return nrows
+
 def main(parser):
     args = parser.parse_args()
     if args.chroms:
         chroms = [l.strip('\n').split('\t')[0] for l in args.chroms]
     else:
         chroms = None
-    
-    convert(args.infile, args.outfile, args.gene_region, args.source, chroms)
+
+    t0 = time.time()
+    opts = {'header': utils.RMSK_COLUMNS if args.no_header else None,
+            'chunksize': args.chunksize,
+            'max_rows': args.max_rows,
+            'tmpdir': args.tmpdir,
+            }
+    if args.families:
+        nrows = write_families(args.infile, args.families, args.outdir, args.source, chroms, **opts)
+    else:
+        nrows = convert(args.infile, args.outfile, args.gene_region, args.source, chroms, **opts)
+    secs = time.time() - t0
+    print >>sys.stderr, 'Converted %d records in %.1fs (%d rows/s)' % (nrows, secs, nrows / max(secs, 1e-6))
 
 if __name__ == '__main__':
     import argparse
@@ -66,9 +291,31 @@ if __name__ == '__main__':
     parser.add_argument('--source', default='rmsk',
                         help="Value for source column of GTF file")
     parser.add_argument('--chroms', type=argparse.FileType('rU'),
-                        help="File with chromosome names. If tab-delimited, names must be in first column")    
+                        help="File with chromosome names. If tab-delimited, names must be in first column")
     parser.add_argument('--gene_region',
                         help='Name for gene region, i.e. internal, ltr, 5end, orf2')
+    parser.add_argument('--families', type=argparse.FileType('rU'),
+                        help='''Families table (families.tsv). If provided, records for
+                                the internal and LTR models of all families are
+                                converted in one pass, model coordinates are corrected
+                                (see fixRmskCoords.py), and output is written to
+                                OUTDIR/FAM/INTMODEL.gtf and OUTDIR/FAM/LTR.MODEL.gtf.
+                                --gene_region and outfile are ignored.''')
+    parser.add_argument('--outdir', default='.',
+                        help="Directory containing family directories, used with --families")
+    parser.add_argument('--no_header', action='store_true',
+                        help='''Input has no header line, i.e. the UCSC database dump
+                                (rmsk.txt.gz). Columns are in the order of the UCSC
+                                rmsk table.''')
+    parser.add_argument('--chunksize', type=int, default=100000,
+                        help="Number of lines read at a time")
+    parser.add_argument('--max_rows', type=int,
+                        help='''Maximum number of records held in memory. If exceeded,
+                                records are written to temporary files by chromosome.
+                                With --families, the limit applies to each model.
+                                Default is to keep all records in memory.''')
+    parser.add_argument('--tmpdir',
+                        help="Directory for temporary files")
     parser.add_argument('infile', nargs='?', type=argparse.FileType('rU'), default=sys.stdin,
                         help="Input UCSC RepeatMasker table")
     parser.add_argument('outfile', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
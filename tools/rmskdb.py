@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+""" Build and query a local RepeatMasker store
+
+The store is a SQLite database built once per assembly from the UCSC rmsk table
+dump (see utils.RmskStore). Queries return records in UCSC table format, or as GTF
+with --gtf.
+"""
+import sys
+import re
+
+import utils
+from partitionRmsk import open_rmsk
+from rmsk2gtf import convert_rows
+
+def parse_region(s):
+    ''' Parse region string "chrom:start-end" with 1-based, inclusive coordinates
+        Returns (chrom, start, end) with 0-based, half-open coordinates.
+    '''
+    m = re.match('^(\S+):([\d,]+)-([\d,]+)$', s)
+    if m is None:
+        raise ValueError('Invalid region: %s' % s)
+    return m.group(1), int(m.group(2).replace(',', '')) - 1, int(m.group(3).replace(',', ''))
+
+def build(args):
+    with open_rmsk(args.rmsk) as fh:
+        store = utils.RmskStore.build(args.db, fh, args.assembly)
+    print >>sys.stderr, 'Stored %s records (assembly: %s)' % (store.meta['rows'], store.meta['assembly'] or 'unknown')
+
+def query(args):
+    store = utils.open_rmsk_store(args.db)
+    models = args.model.split(',') if args.model else None
+    if args.region:
+        try:
+            chrom, start, end = parse_region(args.region)
+        except ValueError as e:
+            sys.exit('ERROR: %s' % e)
+        rows = store.region(chrom, start, end, models)
+    elif models:
+        rows = store.models(models)
+    elif args.family:
+        rows = store.families(args.family.split(','))
+    else:
+        sys.exit('ERROR: one of --model, --family, or --region is required')
+    
+    if args.gtf:
+        lines = ['\t'.join(utils.RMSK_COLUMNS)] + ['\t'.join(r) for r in rows]
+        gtf = convert_rows(lines, args.gene_region, 'rmsk', None)
+        utils.write_lines(args.outfile, ('\t'.join(r) for r in gtf))
+    else:
+        store.write_table(args.outfile, rows)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Build and query local RepeatMasker store')
+    subparsers = parser.add_subparsers()
+
+    p_build = subparsers.add_parser('build', help='Build store from UCSC rmsk table dump')
+    p_build.add_argument('--assembly',
+                         help="Genome assembly (i.e. hg38)")
+    p_build.add_argument('rmsk',
+                         help="UCSC rmsk table dump (rmsk.txt.gz)")
+    p_build.add_argument('db',
+                         help="Output database")
+    p_build.set_defaults(func=build)
+
+    p_query = subparsers.add_parser('query', help='Query records by model, family, or region')
+    p_query.add_argument('--model',
+                         help="Comma-separated model names (repName)")
+    p_query.add_argument('--family',
+                         help="Comma-separated repeat families (repFamily)")
+    p_query.add_argument('--region',
+                         help='''Genomic region, i.e. chr19:1-5000000. Can be combined
+                                 with --model''')
+    p_query.add_argument('--gtf', action='store_true',
+                         help="Output GTF (see rmsk2gtf.py)")
+    p_query.add_argument('--gene_region',
+                         help='Name for gene region with --gtf, i.e. internal, ltr')
+    p_query.add_argument('db',
+                         help="RepeatMasker store")
+    p_query.add_argument('outfile', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
+                         help="Output file")
+    p_query.set_defaults(func=query)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,15 +1,33 @@
 #! /usr/bin/env python
 
+import sys
 import utils
 
+def memory_size(s):
+    ''' Convert size with optional K, M or G suffix to bytes '''
+    units = {'K':1024, 'M':1024**2, 'G':1024**3}
+    if s[-1].upper() in units:
+        return int(float(s[:-1]) * units[s[-1].upper()])
+    return int(s)
+
 def main(args):
     if args.chroms:
         chroms = [l.strip('\n').split('\t')[0] for l in args.chroms]
     else:
         chroms = None
     
-    for l in utils.sort_gtf(utils.tab_line_gen(args.infile), chroms):
-        print >>args.outfile, '\t'.join(l)
+    if args.presorted:
+        lines = utils.check_sorted_gtf(utils.tab_line_gen(args.infile), chroms)
+    elif args.max_memory:
+        lines = utils.external_sort_gtf(utils.tab_line_gen(args.infile), chroms,
+                                        args.max_memory, args.tmpdir, args.compress_tmp)
+    else:
+        lines = utils.sort_gtf(utils.tab_line_gen(args.infile), chroms)
+    
+    try:
+        utils.write_lines(args.outfile, ('\t'.join(l) for l in lines))
+    except ValueError as e:
+        sys.exit('ERROR: %s' % e)
 
 if __name__ == '__main__':
     import argparse
@@ -17,6 +35,17 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Sort GTF file')
     parser.add_argument('--chroms', type=argparse.FileType('rU'),
                         help="File with chromosome names. If tab-delimited, names must be in first column")                        
+    parser.add_argument('--presorted', action='store_true',
+                        help='''Input is already sorted. Lines are checked and written
+                                as they are read, without holding the file in memory.''')
+    parser.add_argument('--max_memory', type=memory_size,
+                        help='''Approximate memory limit, i.e. 512M or 2G. If provided,
+                                sorted chunks are written to temporary files and
+                                merged.''')
+    parser.add_argument('--tmpdir',
+                        help="Directory for temporary files used with --max_memory")
+    parser.add_argument('--compress_tmp', action='store_true',
+                        help="Compress temporary files used with --max_memory")
     parser.add_argument('infile', nargs='?', type=argparse.FileType('rU'), default=sys.stdin,
                         help="Input GTF file")
     parser.add_argument('outfile', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
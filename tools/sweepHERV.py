@@ -0,0 +1,235 @@
+#! /usr/bin/env python
+""" Evaluate merge, flank and filter parameters for one HERV family
+
+RepeatMasker hits for the family are loaded once, using the same tables and stage
+cache as pipeline.py, and loci are assembled for every combination of --shortdist,
+--longdist, --flank and --min_internal_pct without writing GTF files:
+
+    hits are merged once for each (shortdist, longdist) pair,
+    merged loci are assembled once for each flank size (assembleHERV.assemble_arrays),
+    filter thresholds only select from the assembled loci.
+
+Flanking LTR hits are found with a start-sorted index for each chromosome and strand
+that is shared by all settings.
+
+One line is written for each setting with the number of loci in each category, the
+quartiles of model coverage (percent of internal model) of loci passing the filter,
+and the number of conflict groups (groups of overlapping loci passing the filter, as
+found by polishHERVLoci.find_conflicts).
+"""
+import sys
+import itertools
+import argparse
+import numpy as np
+
+import utils
+import pipeline
+from mergeHits import MERGE_MODES
+from assembleHERV import assemble_arrays
+
+CATEGORIES = ['internal', 'prototype', 'oneside']
+COLUMNS = ['shortdist', 'longdist', 'flank', 'min_internal_pct', 'loci'] + CATEGORIES + \
+          ['rejected', 'pct_q25', 'pct_median', 'pct_q75', 'conflicts']
+
+def int_list(s):
+    return [int(v) for v in s.split(',')]
+
+def float_list(s):
+    return [float(v) for v in s.split(',')]
+
+### Shared arrays ########################################################################
+class HitIndex(object):
+    ''' Rows of GTFTable sorted by start for each chromosome and strand '''
+    def __init__(self, table, rows):
+        self.buckets = {}
+        for chrom,cidx in table.groupby('chrom'):
+            cidx = np.intersect1d(cidx, rows)
+            for strand,sidx in [(s, cidx[table['strand'][cidx] == table.code('strand', s)]) for s in '+-']:
+                if not len(sidx): continue
+                sidx = sidx[np.argsort(table['start'][sidx], kind='mergesort')]
+                starts, ends = table['start'][sidx], table['end'][sidx]
+                self.buckets[(chrom, strand)] = (sidx, starts, ends, (ends - starts).max())
+
+    def overlapping(self, chrom, strand, qstart, qend):
+        ''' Find rows overlapping intervals qstart-qend (arrays)
+            Returns (interval index, row) arrays, rows for each interval are sorted by
+            start position.
+        '''
+        if (chrom, strand) not in self.buckets:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        sidx, starts, ends, maxlen = self.buckets[(chrom, strand)]
+        lo = np.searchsorted(starts, qstart - maxlen, 'left')
+        hi = np.searchsorted(starts, qend, 'right')
+        counts = hi - lo
+        qi = np.repeat(np.arange(len(qstart)), counts)
+        pos = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+        keep = ends[pos] >= qstart[qi]
+        return qi[keep], sidx[pos[keep]]
+
+def merge_table(table, buckets, shortdist, longdist, mode):
+    ''' Merge internal hits, see mergeHits.merge_hits
+        buckets is a list of (rows, strand, array) for each chromosome and strand.
+        Returns locus code for each row in buckets.
+    '''
+    loc = np.full(len(table), -1, dtype=np.int32)
+    nloc = 0
+    for rows, strand, arr in buckets:
+        order, breaks = MERGE_MODES[mode](arr, strand, shortdist, longdist)
+        gid = np.zeros(len(order), dtype=np.int32)
+        gid[breaks] = 1
+        loc[rows[order]] = nloc + np.cumsum(gid)
+        nloc += len(breaks) + 1
+    return loc
+
+def assemble_loci(table, nint, loc, ltrindex, flank, chromsizes, model_lengths):
+    ''' Assemble merged loci with LTR hits within flank of the internal span
+        Returns (table, arrays) from assemble_arrays, with locus chromosome codes in
+        arrays["chrom"].
+    '''
+    nloc = loc[:nint].max() + 1
+    first = np.full(nloc, nint, dtype=np.int64)
+    np.minimum.at(first, loc[:nint], np.arange(nint))
+    spstart = np.full(nloc, np.iinfo(np.int64).max, dtype=np.int64)
+    spend = np.zeros(nloc, dtype=np.int64)
+    np.minimum.at(spstart, loc[:nint], table['start'][:nint])
+    np.maximum.at(spend, loc[:nint], table['end'][:nint])
+
+    # Flanking LTR hits, as in utils.flank_join
+    ltrrows, ltrloc = [np.arange(nint)], [loc[:nint]]
+    lchrom, lstrand = table['chrom'][first], table['strand'][first]
+    for c,s in set(zip(lchrom.tolist(), lstrand.tolist())):
+        chrom, strand = table.levels['chrom'][c], table.levels['strand'][s]
+        locs = np.flatnonzero((lchrom == c) & (lstrand == s))
+        fs = np.maximum(1, spstart[locs] - flank)
+        fe = spend[locs] + flank
+        if chromsizes is not None and chrom in chromsizes:
+            fe = np.minimum(chromsizes[chrom], fe)
+        qi, rows = ltrindex.overlapping(chrom, strand, fs, fe)
+        ltrrows.append(rows)
+        ltrloc.append(locs[qi])
+    t = table.take(np.concatenate(ltrrows))
+    t.cols['locus'] = np.concatenate(ltrloc).astype(np.int32)
+    t.levels = dict(table.levels, locus=[str(i) for i in xrange(nloc)])
+    t, asm = assemble_arrays(t, model_lengths)
+    asm['chrom'] = lchrom[asm['locus']]
+    return t, asm
+
+def count_conflicts(chrom, start, end):
+    ''' Number of groups of overlapping loci, as found by polishHERVLoci.find_conflicts
+        Loci are clustered regardless of strand, book-ended loci are clustered.
+    '''
+    if len(start) == 0:
+        return 0
+    # Offset positions by chromosome so that loci on different chromosomes never overlap
+    offset = chrom.astype(np.int64) * (end.max() + 2)
+    order = np.lexsort((start, chrom))
+    s, e = (start + offset)[order], (end + offset)[order]
+    newgroup = np.r_[True, (s[1:] - 1) - np.maximum.accumulate(e)[:-1] > 0]
+    sizes = np.bincount(np.cumsum(newgroup) - 1)
+    return int((sizes > 1).sum())
+
+def filter_summary(asm, min_internal_pct, min_internal_bases):
+    ''' Summary of loci passing filter, see filterHERVLoci.filter_loci
+        Returns dictionary with values for COLUMNS.
+    '''
+    pct = np.array([float('%.1f' % p) for p in asm['model_pct']])
+    passed = (pct >= min_internal_pct * 100) & (asm['model_cov'] >= min_internal_bases)
+    ret = {'loci': len(passed), 'rejected': int((~passed).sum())}
+    for cat in CATEGORIES:
+        ret[cat] = int((passed & (asm['category'] == cat)).sum())
+    if passed.any():
+        ret['pct_q25'], ret['pct_median'], ret['pct_q75'] = np.percentile(pct[passed], [25, 50, 75])
+    else:
+        ret['pct_q25'] = ret['pct_median'] = ret['pct_q75'] = float('nan')
+    ret['conflicts'] = count_conflicts(asm['chrom'][passed], asm['span_start'][passed], asm['span_end'][passed])
+    return ret
+
+def sweep(internal, ltr, model_lengths, chromsizes, args):
+    ''' Generate summary for each combination of parameters
+        internal and ltr are GTFTables with categorical "id", as loaded by
+        pipeline.Pipeline.get_table.
+    '''
+    table = utils.GTFTable.concat([internal, ltr])
+    nint = len(internal)
+    plus = table['strand'] == table.code('strand', '+')
+    modelcoord = np.where(plus, table['repLeft'], table['repStart'])
+    buckets = []
+    for chrom,cidx in table.groupby('chrom'):
+        cidx = cidx[cidx < nint]
+        for strand,rows in [('+', cidx[plus[cidx]]), ('-', cidx[~plus[cidx]])]:
+            if not len(rows): continue
+            arr = np.array([table['start'][rows], table['end'][rows], modelcoord[rows]], dtype=np.int64)
+            buckets.append((rows, strand, arr))
+    ltrindex = HitIndex(table, np.arange(nint, len(table)))
+
+    for shortdist, longdist in itertools.product(args.shortdist, args.longdist):
+        loc = merge_table(table, buckets, shortdist, longdist, args.merge_mode)
+        for flank in args.flank:
+            t, asm = assemble_loci(table, nint, loc, ltrindex, flank, chromsizes, model_lengths)
+            for mip in args.min_internal_pct:
+                ret = filter_summary(asm, mip, args.min_internal_bases)
+                ret.update(shortdist=shortdist, longdist=longdist, flank=flank, min_internal_pct=mip)
+                yield ret
+
+def main(args):
+    if args.outdir is None:
+        args.outdir = args.fam
+    # Hits are loaded with the pipeline stage cache, parameters for later stages are
+    # not used
+    pargs = argparse.Namespace(fam=args.fam, intmodel=args.intmodel, ltrmodels=args.ltrmodels,
+                               chroms=args.chroms, cytoband=None, db=args.db, rmsk_db=args.rmsk_db,
+                               outdir=args.outdir, resolve_file=None, save_intermediate=False,
+                               force=False, shortdist=args.shortdist[0], longdist=args.longdist[0],
+                               merge_mode=args.merge_mode, flank=args.flank[0],
+                               min_internal_pct=args.min_internal_pct[0],
+                               min_internal_bases=args.min_internal_bases)
+    p = pipeline.Pipeline(pargs)
+    p.compute_keys()
+    internal, ltr = p.get_table('internal', ['id']), p.get_table('ltr', ['id'])
+    model_lengths = p.model_lengths()
+
+    nsettings = len(args.shortdist) * len(args.longdist) * len(args.flank) * len(args.min_internal_pct)
+    p.log('Evaluating %d settings' % nsettings)
+    print >>args.outfile, '\t'.join(COLUMNS)
+    for ret in sweep(internal, ltr, model_lengths, p.chromsizes, args):
+        print >>args.outfile, '\t'.join('%.1f' % ret[c] if isinstance(ret[c], float) else str(ret[c])
+                                        for c in COLUMNS)
+    p.log('Done')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate merge, flank and filter parameters for one HERV family',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--chroms', type=argparse.FileType('rU'),
+                        help='''Chromosome sizes (i.e. chrom.sizes). Used for sorting and
+                                for clipping flanking regions.''')
+    parser.add_argument('--shortdist', type=int_list, default=[10],
+                        help="Comma-separated values for mergeHits --shortdist")
+    parser.add_argument('--longdist', type=int_list, default=[10000],
+                        help="Comma-separated values for mergeHits --longdist")
+    parser.add_argument('--flank', type=int_list, default=[1000],
+                        help="Comma-separated sizes of flanking region")
+    parser.add_argument('--min_internal_pct', type=float_list, default=[0.1],
+                        help="Comma-separated values for filterHERVLoci --min_internal_pct")
+    parser.add_argument('--min_internal_bases', type=int, default=0,
+                        help="Minimum number of bases matching internal model")
+    parser.add_argument('--merge_mode', choices=['greedy', 'chain'], default='greedy',
+                        help="Algorithm for merging internal hits (see mergeHits.py)")
+    parser.add_argument('--db',
+                        help='''UCSC database (i.e. hg19). RepeatMasker tables missing
+                                from the output directory are downloaded.''')
+    parser.add_argument('--rmsk_db',
+                        help='''RepeatMasker store (see rmskdb.py). RepeatMasker tables
+                                missing from the output directory are extracted from
+                                the store.''')
+    parser.add_argument('--outdir',
+                        help='''Directory containing the RepeatMasker tables MODEL.txt
+                                and LTR.MODEL.txt and the stage cache. Default is FAM''')
+    parser.add_argument('fam',
+                        help="Family name")
+    parser.add_argument('intmodel',
+                        help="Name of internal model")
+    parser.add_argument('ltrmodels', type=lambda x: x.split(','),
+                        help="Comma-separated names of LTR models")
+    parser.add_argument('outfile', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
+                        help="Output table")
+    main(parser.parse_args())
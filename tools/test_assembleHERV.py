@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+''' Tests for assembleHERV, run with "python -m unittest test_assembleHERV" in tools/ '''
+import random
+import unittest
+
+import utils
+from utils import GTFLine
+from assembleHERV import assemble_locus, assemble_table
+
+MODEL_LENGTHS = {'HERVH-int': 5600, 'LTR7': 450}
+
+def hit(locid, strand, start, end, region, hid, repstart, repend, repleft):
+    model = 'HERVH-int' if region == 'internal' else 'LTR7'
+    attrs = 'locus "%s"; repName "%s"; repStart "%d"; repEnd "%d"; repLeft "%d"; geneRegion "%s"; id "%s";' % \
+            (locid, model, repstart, repend, repleft, region, hid)
+    return ['chr1', 'rmsk', 'exon', str(start), str(end), '100', strand, '.', attrs]
+
+def random_loci(nloci, seed=1):
+    ''' Loci with many hits sharing start or end positions '''
+    rand = random.Random(seed)
+    loci = []
+    for i in range(nloci):
+        locid = 'HERVH_%04d' % (i + 1)
+        strand = rand.choice('+-')
+        base = 10000 * (i + 1)
+        rows = []
+        for j in range(rand.randint(1, 6)):
+            start = base + rand.choice([0, 0, 100, 500])
+            end = start + rand.choice([300, 800, 800, 1500])
+            rstart = rand.randint(1, 3000)
+            rows.append(hit(locid, strand, start, end, 'internal', 'HERVH-int_%d_%d' % (i, j),
+                            rstart, rstart + end - start, rstart - 5600))
+        for j in range(rand.randint(0, 3)):
+            start = base + rand.choice([-500, 0, 1200, 2000])
+            end = start + 450
+            rows.append(hit(locid, strand, start, end, 'ltr', 'LTR7_%d_%d' % (i, j), 1, 450, 0))
+        rand.shuffle(rows)
+        loci.append((locid, rows))
+    return loci
+
+def normalize(lines):
+    ''' Compare annotations regardless of attribute order '''
+    ret = []
+    for l in lines:
+        g = GTFLine(str(l).split('\t'))
+        ret.append((g.chrom, g.source, g.feature, g.start, g.end, g.strand, sorted(g.attr.items())))
+    return ret
+
+class TestBatchAssembly(unittest.TestCase):
+    def test_tied_positions(self):
+        ''' Batch assembly matches per-locus assembly when hits share positions '''
+        loci = random_loci(200)
+        expected = [(locid, normalize(assemble_locus(locid, [GTFLine(r) for r in rows], MODEL_LENGTHS)))
+                    for locid,rows in loci]
+        table = utils.GTFTable.from_rows([r for locid,rows in loci for r in rows], catattrs=['id'])
+        batch = [(locid, normalize(lines)) for locid,lines in assemble_table(table, MODEL_LENGTHS)]
+        self.assertEqual(len(batch), len(expected))
+        for e,b in zip(expected, batch):
+            self.assertEqual(e, b)
+
+    def test_input_order(self):
+        ''' Per-locus assembly does not depend on the order of hits '''
+        for locid,rows in random_loci(50, seed=2):
+            a = normalize(assemble_locus(locid, [GTFLine(r) for r in rows], MODEL_LENGTHS))
+            b = normalize(assemble_locus(locid, [GTFLine(r) for r in reversed(rows)], MODEL_LENGTHS))
+            self.assertEqual(a, b)
+
+if __name__ == '__main__':
+    unittest.main()
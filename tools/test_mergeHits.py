@@ -0,0 +1,143 @@
+#! /usr/bin/env python
+''' Tests for mergeHits, run with "python -m unittest test_mergeHits" in tools/ '''
+import random
+import unittest
+from collections import defaultdict
+
+import numpy as np
+
+from utils import GTFLine
+from mergeHits import chain_bucket, chain_scores, merge_hits
+
+def random_hits(nhits, seed=1, chroms=('chr1', 'chr2')):
+    ''' Internal hits with many close, overlapping and out-of-order fragments '''
+    rand = random.Random(seed)
+    rows = []
+    for i in range(nhits):
+        start = rand.randint(1, 40000)
+        end = start + rand.choice([50, 200, 800, 2000])
+        repleft = rand.randint(-5600, 0)
+        repstart = rand.randint(1, 5600)
+        attrs = 'repName "HERVH-int"; repStart "%d"; repEnd "%d"; repLeft "%d"; id "HERVH-int_%d";' % \
+                (repstart, repstart + end - start, repleft, i + 1)
+        rows.append([rand.choice(chroms), 'rmsk', 'exon', str(start), str(end), '.',
+                     rand.choice('+-'), '.', attrs])
+    return rows
+
+def greedy_loci(gtf, prefix, shortdist=10, longdist=10000):
+    ''' Merge hits with the greedy loop used before merge_bucket
+        Returns list of (locus, [hit ids]).
+    '''
+    bychrom = defaultdict(lambda:{'+':list(), '-':list()})
+    for g in gtf:
+        bychrom[g.chrom][g.strand].append(g)
+
+    merged_hits = []
+    for cchrom, strands in bychrom.iteritems():
+        # Plus strand
+        if len(strands['+']):
+            strands['+'].sort(key=lambda x:x.start)
+            cur = [ strands['+'][0] ]
+            for g1 in strands['+'][1:]:
+                g0 = cur[-1]
+                gdist = g1.start - g0.end
+                if gdist <= shortdist:
+                    domerge = True
+                else:
+                    domerge = g0.attr['repLeft'] < g1.attr['repLeft']
+                    domerge &= gdist < longdist
+                if domerge:
+                    cur.append(g1)
+                else:
+                    merged_hits.append(cur)
+                    cur = [ g1 ]
+            merged_hits.append(cur)
+
+        # Minus strand
+        if len(strands['-']):
+            strands['-'].sort(key=lambda x:x.end, reverse=True)
+            cur = [ strands['-'][0] ]
+            for g1 in strands['-'][1:]:
+                g0 = cur[-1]
+                gdist = g0.start - g1.end
+                if gdist <= shortdist:
+                    domerge = True
+                else:
+                    domerge = g0.attr['repStart'] < g1.attr['repStart']
+                    domerge &= gdist < longdist
+                if domerge:
+                    cur.append(g1)
+                else:
+                    merged_hits.append(cur)
+                    cur = [ g1 ]
+            merged_hits.append(cur)
+    return [('%s_%04d' % (prefix, i+1), [g.attr['id'] for g in cur]) for i,cur in enumerate(merged_hits)]
+
+def brute_force_scores(start, end, mcoord, shortdist, longdist):
+    ''' O(n^2) chaining, hits are sorted by start '''
+    n = len(start)
+    best = [0] * n
+    for j in range(n):
+        prev = [best[i] for i in range(j)
+                if start[j] - end[i] <= shortdist or
+                   (mcoord[i] < mcoord[j] and start[j] - end[i] < longdist)]
+        best[j] = end[j] - start[j] + 1 + max(prev + [0])
+    return best
+
+class TestGreedyMerge(unittest.TestCase):
+    def test_merge_hits(self):
+        ''' Loci match the greedy loop used before merge_bucket '''
+        rows = random_hits(2000)
+        for shortdist, longdist in [(10, 10000), (0, 500), (200, 3000)]:
+            expected = greedy_loci([GTFLine(r) for r in rows], 'HERVH', shortdist, longdist)
+            for processes in (1, 2):
+                merged = merge_hits([GTFLine(r) for r in rows], 'HERVH', shortdist, longdist, processes)
+                self.assertEqual([(locid, sorted(g.attr['id'] for g in locus[1:])) for locid,locus in merged],
+                                 [(locid, sorted(ids)) for locid,ids in expected])
+                for locid,locus in merged:
+                    self.assertEqual(locus[0].feature, 'span')
+                    self.assertTrue(all(g.attr['locus'] == locid for g in locus))
+
+class TestChainMerge(unittest.TestCase):
+    def test_chain_scores(self):
+        ''' Chain scores match brute force dynamic programming '''
+        rand = random.Random(2)
+        for trial in range(200):
+            n = rand.randint(1, 60)
+            start = sorted(rand.randint(1, 20000) for _ in range(n))
+            end = [s + rand.choice([0, 10, 300, 1500]) for s in start]
+            mcoord = np.array([rand.choice([rand.randint(1, 6000), 100]) for _ in range(n)], dtype=np.int64)
+            shortdist, longdist = rand.choice([(10, 10000), (0, 1000), (500, 2000)])
+            best, pred = chain_scores(start, end, mcoord, shortdist, longdist)
+            self.assertEqual(best, brute_force_scores(start, end, mcoord, shortdist, longdist))
+            for j,i in enumerate(pred):
+                if i < 0:
+                    self.assertEqual(best[j], end[j] - start[j] + 1)
+                    continue
+                # pred is an allowed predecessor and gives the best score
+                self.assertTrue(i < j)
+                self.assertTrue(start[j] - end[i] <= shortdist or
+                                (mcoord[i] < mcoord[j] and start[j] - end[i] < longdist))
+                self.assertEqual(best[j], end[j] - start[j] + 1 + best[i])
+
+    def test_chain_bucket(self):
+        ''' Each hit is in exactly one locus and loci do not overlap '''
+        rows = random_hits(1000, seed=3, chroms=('chr1',))
+        for strand, mattr in [('+', 'repLeft'), ('-', 'repStart')]:
+            gtf = [GTFLine(r) for r in rows if r[6] == strand]
+            arr = np.array([(g.start, g.end, g.attr[mattr]) for g in gtf], dtype=np.int64).T
+            order, breaks = chain_bucket(arr, strand)
+            self.assertEqual(sorted(order.tolist()), range(len(gtf)))
+            spans = sorted((min(gtf[i].start for i in idx), max(gtf[i].end for i in idx))
+                           for idx in np.split(order, breaks))
+            for (s0, e0), (s1, e1) in zip(spans[:-1], spans[1:]):
+                self.assertTrue(e0 < s1)
+
+    def test_chain_empty(self):
+        ''' Empty buckets give no loci '''
+        order, breaks = chain_bucket(np.zeros((3, 0), dtype=np.int64), '+')
+        self.assertEqual(len(order), 0)
+        self.assertEqual(len(breaks), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+''' Tests for utils, run with "python -m unittest test_utils" in tools/ '''
+import unittest
+
+import utils
+from utils import GTFLine
+
+def line(locid, feature, start, end, chrom='chr1'):
+    attrs = 'locus "%s";' % locid
+    return '\t'.join([chrom, 'rmsk', feature, str(start), str(end), '.', '+', '.', attrs]) + '\n'
+
+def blocks(lines):
+    ''' Locus blocks from GTF lines as (locus, [(feature, start)]) '''
+    return [(locid, [(g.feature, g.start) for g in locus])
+            for locid,locus in utils.locus_block_gen(iter(lines))]
+
+class TestLocusBlocks(unittest.TestCase):
+    def test_separators(self):
+        ''' Lines between separators belong to one block per locus '''
+        lines = ['### A ###\n', line('A', 'span', 100, 900), line('A', 'exon', 100, 400),
+                 line('A', 'exon', 600, 900),
+                 '### B ###\n', line('B', 'span', 50, 5000), line('B', 'exon', 50, 5000),
+                 '### C ###\n', line('C', 'span', 5000, 6000, chrom='chr2'),
+                 line('C', 'exon', 5000, 6000, chrom='chr2')]
+        self.assertEqual(blocks(lines),
+                         [('A', [('span', 100), ('exon', 100), ('exon', 600)]),
+                          ('B', [('span', 50), ('exon', 50)]),
+                          ('C', [('span', 5000), ('exon', 5000)])])
+
+    def test_sorted_overlapping(self):
+        ''' Overlapping loci in position-sorted input are not split '''
+        lines = [line('A', 'span', 100, 1000), line('A', 'exon', 100, 300),
+                 line('B', 'span', 200, 1500), line('B', 'exon', 200, 500),
+                 line('A', 'exon', 400, 1000), line('B', 'exon', 900, 1500),
+                 line('C', 'span', 1501, 2000), line('C', 'exon', 1501, 2000),
+                 line('D', 'span', 100, 200, chrom='chr2'), line('D', 'exon', 100, 200, chrom='chr2')]
+        self.assertEqual(blocks(lines),
+                         [('A', [('span', 100), ('exon', 100), ('exon', 400)]),
+                          ('B', [('span', 200), ('exon', 200), ('exon', 900)]),
+                          ('C', [('span', 1501), ('exon', 1501)]),
+                          ('D', [('span', 100), ('exon', 100)])])
+
+    def test_span_end(self):
+        ''' A locus is complete when a line starts after the end of its span '''
+        lines = [line('A', 'span', 100, 200), line('A', 'exon', 100, 200),
+                 line('B', 'span', 200, 300), line('B', 'exon', 200, 300),
+                 line('C', 'span', 301, 400), line('C', 'exon', 301, 400)]
+        nread = []
+        def _lines():
+            for l in lines:
+                nread.append(l)
+                yield l
+        done = [(locid, len(nread)) for locid,locus in utils.locus_block_gen(_lines())]
+        # A (ending at 200) is open at B (starting at 200), both are complete at C
+        self.assertEqual(done, [('A', 5), ('B', 5), ('C', 6)])
+
+    def test_span_exon_ties(self):
+        ''' Exons sorted before the span line with the same start stay in the locus '''
+        lines = [line('A', 'exon', 100, 300), line('B', 'exon', 100, 200),
+                 line('A', 'span', 100, 800), line('B', 'span', 100, 200),
+                 line('A', 'exon', 500, 800), line('C', 'exon', 801, 900),
+                 line('C', 'span', 801, 900)]
+        self.assertEqual(blocks(lines),
+                         [('B', [('exon', 100), ('span', 100)]),
+                          ('A', [('exon', 100), ('span', 100), ('exon', 500)]),
+                          ('C', [('exon', 801), ('span', 801)])])
+
+    def test_no_span(self):
+        ''' Loci without span lines extend to the largest end read '''
+        lines = [line('A', 'exon', 100, 500), line('B', 'exon', 200, 300),
+                 line('A', 'exon', 250, 600), line('B', 'exon', 280, 350),
+                 line('C', 'exon', 601, 700)]
+        self.assertEqual(blocks(lines),
+                         [('A', [('exon', 100), ('exon', 250)]),
+                          ('B', [('exon', 200), ('exon', 280)]),
+                          ('C', [('exon', 601)])])
+
+    def test_locus_blocks(self):
+        ''' locus_blocks accepts GTFLine objects and None as separator '''
+        gtf = [GTFLine(line('A', 'exon', 100, 200).strip('\n').split('\t')), None,
+               GTFLine(line('B', 'exon', 100, 200).strip('\n').split('\t')),
+               GTFLine(line('A', 'exon', 150, 250).strip('\n').split('\t'))]
+        self.assertEqual([(locid, len(locus)) for locid,locus in utils.locus_blocks(gtf)],
+                         [('A', 1), ('B', 1), ('A', 1)])
+
+if __name__ == '__main__':
+    unittest.main()
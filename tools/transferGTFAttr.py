@@ -3,12 +3,16 @@
 import utils
 from utils import GTFLine
 
+def transfer_attr(gtf, fromAttr, toAttr):
+    ''' Copy value of attribute fromAttr to toAttr '''
+    for g in gtf:
+        if fromAttr in g.attr:
+            g.attr[toAttr] = g.attr[fromAttr]
+        yield g
+
 def main(args):
-    combined_gtf = [GTFLine(l) for l in utils.tab_line_gen(args.infile)]
-    for g in combined_gtf:
-        if args.fromAttr in g.attr:
-            g.attr[args.toAttr] = g.attr[args.fromAttr]
-        print >>args.outfile, g
+    gtf = (GTFLine(l) for l in utils.tab_line_gen(args.infile))
+    utils.write_lines(args.outfile, transfer_attr(gtf, args.fromAttr, args.toAttr))
 
 if __name__ == '__main__':
     import argparse
@@ -1,59 +1,272 @@
 #! /bin/bash
 import sys
+import os
 import re
-from collections import defaultdict, Counter
-from itertools import groupby
-from subprocess import Popen,PIPE
+import gzip
+import json
+import shutil
+import heapq
+import hashlib
+import sqlite3
+import tempfile
+from collections import defaultdict, Counter, OrderedDict
+from itertools import groupby, islice
+
+import numpy as np
+
+# Separator line written between loci
+LOCUS_SEPARATOR = re.compile('^### (\S+) ###$')
 
 def tab_line_gen(infile):
     ''' Returns a generator for tab-delmited file '''
     return (l.strip('\n').split('\t') for l in infile if not l.startswith('#'))
 
+def write_lines(outfile, lines, blocksize=10000):
+    ''' Write lines to outfile in blocks of blocksize lines
+        Items in lines are converted with str(), newlines are added.
+    '''
+    buf = []
+    for l in lines:
+        buf.append(str(l))
+        if len(buf) >= blocksize:
+            buf.append('')
+            outfile.write('\n'.join(buf))
+            buf = []
+    if buf:
+        buf.append('')
+        outfile.write('\n'.join(buf))
+
+def two_pass(infile):
+    ''' Return (first, second) iterables for reading infile twice
+        Regular files are rewound before the second pass. Other input, i.e. stdin, is
+        copied to a temporary file during the first pass.
+    '''
+    if os.path.isfile(getattr(infile, 'name', '')):
+        return infile, _rewound(infile)
+    spool = tempfile.TemporaryFile()
+    def _spooled():
+        for l in infile:
+            spool.write(l)
+            yield l
+    return _spooled(), _rewound(spool)
+
+def _rewound(fh):
+    fh.seek(0)
+    for l in fh:
+        yield l
+
 def simplify_list(l):
     """ Collapse consecutive repeats in list """
     return [k for k, g in groupby(l)]
 
 def sort_gtf(liter, chroms=None):
     ''' Sort GTF file '''
-    alllines = defaultdict(list)  
-    for l in liter:
-        alllines[l[0]].append(l)
-    
+    alllines = list(liter)
     if chroms is None:
-        chroms = sorted(alllines.keys())
+        chroms = sorted(set(l[0] for l in alllines))
     
-    for cchrom in chroms:
-        if cchrom not in alllines: continue 
-        for l in sorted(alllines[cchrom],key=lambda x:int(x[3])):
+    # Sort by chromosome rank then start, lines not in chroms have rank -1
+    rank = {c:i for i,c in enumerate(chroms)}
+    crank = np.fromiter((rank.get(l[0], -1) for l in alllines), np.int64, len(alllines))
+    spos = np.fromiter((int(l[3]) for l in alllines), np.int64, len(alllines))
+    order = np.lexsort((spos, crank))
+    for i in order[crank[order] >= 0]:
+        yield alllines[i]
+
+# Estimated memory used by a split line in addition to the length of its fields
+_LINE_OVERHEAD = 600
+
+def external_sort_gtf(liter, chroms=None, max_memory=512 * 1024**2, tmpdir=None, compress=False):
+    ''' Sort GTF file using temporary files
+        Lines are read until their estimated size reaches max_memory, then sorted
+        and written to a temporary file (gzipped if compress is True). The sorted
+        runs are merged to give the same order as sort_gtf.
+    '''
+    def _write_run(lines):
+        fh = tempfile.NamedTemporaryFile(dir=tmpdir, suffix='.gtf.gz' if compress else '.gtf', delete=False)
+        fh.close()
+        outh = gzip.open(fh.name, 'wb', compresslevel=1) if compress else open(fh.name, 'w')
+        with outh:
+            write_lines(outh, ('\t'.join(l) for l in sort_gtf(lines, chroms)))
+        return fh.name
+    
+    def _read_run(fn):
+        with (gzip.open(fn, 'rb') if compress else open(fn, 'rU')) as fh:
+            for l in tab_line_gen(fh):
+                yield l
+    
+    runs = []
+    try:
+        chunk, size = [], 0
+        for l in liter:
+            chunk.append(l)
+            size += sum(len(f) for f in l) + _LINE_OVERHEAD
+            if size >= max_memory:
+                runs.append(_write_run(chunk))
+                chunk, size = [], 0
+        if not runs:
+            # Everything fits in memory
+            for l in sort_gtf(chunk, chroms):
+                yield l
+            return
+        if chunk:
+            runs.append(_write_run(chunk))
+            chunk = []
+        for l in merge_sorted_gtf([_read_run(fn) for fn in runs], chroms):
             yield l
+    finally:
+        for fn in runs:
+            os.remove(fn)
 
+def merge_sorted_gtf(liters, chroms=None):
+    ''' Merge GTF lines from iterables that are each sorted as by sort_gtf
+        Lines with the same position are ordered by iterable, so the result is the
+        same as sorting the concatenated iterables. Lines on chromosomes not in
+        chroms are skipped.
+    '''
+    if chroms is not None:
+        rank = {c:i for i,c in enumerate(chroms)}
+        _key = lambda l: (rank[l[0]], int(l[3]))
+    else:
+        _key = lambda l: (l[0], int(l[3]))
+    
+    def _keyed(liter, i):
+        for l in liter:
+            if chroms is not None and l[0] not in rank: continue
+            yield _key(l) + (i,), l
+    
+    for k,l in heapq.merge(*[_keyed(liter, i) for i,liter in enumerate(liters)]):
+        yield l
+
+def sort_gtflines(gtf, chroms=None):
+    ''' Sort GTFLine objects by chromosome then start position
+        Same order as sort_gtf; annotations on chromosomes not in chroms are removed.
+    '''
+    gtf = list(gtf)
+    if chroms is None:
+        chroms = sorted(set(g.chrom for g in gtf))
+    rank = {c:i for i,c in enumerate(chroms)}
+    return sorted((g for g in gtf if g.chrom in rank), key=lambda x:(rank[x.chrom], x.start))
+
+def check_sorted_gtf(liter, chroms=None):
+    ''' Pass through GTF lines that are already sorted
+        Lines are yielded as they are read. ValueError is raised if a line is out of
+        order. Lines on chromosomes not in chroms are skipped.
+    '''
+    rank = {c:i for i,c in enumerate(chroms)} if chroms is not None else None
+    prev = None
+    for l in liter:
+        if rank is None:
+            key = (l[0], int(l[3]))
+        elif l[0] in rank:
+            key = (rank[l[0]], int(l[3]))
+        else:
+            continue
+        if prev is not None and key < prev:
+            raise ValueError('GTF is not sorted: %s:%s' % (l[0], l[3]))
+        prev = key
+        yield l
 
 # GTFCOLS = ['chrom','source','feature','start','end','score','strand','frame']
 
-class GTFLine:
+# Types for known attributes. Attributes not listed here have their type guessed.
+ATTRSCHEMA = {
+    'repStart': int, 'repEnd': int, 'repLeft': int,
+    'model_cov': int, 'exons': int, 'exon_number': int,
+    'model_pct': float,
+    'gene_id': str, 'transcript_id': str, 'locus': str, 'oLocus': str,
+    'repName': str, 'repClass': str, 'repFamily': str, 'id': str,
+    'geneRegion': str, 'category': str, 'conflict': str,
+}
+
+def guess_int(v):
+    ''' Convert v to int if possible, otherwise return v '''
+    try:
+        return int(v)
+    except ValueError:
+        return v
+
+def guess_value(v):
+    ''' Convert string to int or float if possible '''
+    try:
+        return int(v)
+    except ValueError:
+        try:
+            return float(v)
+        except ValueError:
+            return v
+
+def convert_attr(k, v):
+    ''' Convert value of attribute k according to ATTRSCHEMA
+        Values that cannot be converted (i.e. non-numeric repStart) are converted with
+        guess_value, as for attributes not in ATTRSCHEMA.
+    '''
+    try:
+        return ATTRSCHEMA.get(k, guess_value)(v)
+    except ValueError:
+        return guess_value(v)
+
+def _parse_attrs_re(attrstr):
+    ''' Parse GTF attribute string using regular expression '''
+    return {k:convert_attr(k, v) for k,v in re.findall('(\S+)\s+"([\s\S]+?)";', attrstr)}
+
+def parse_attrs(attrstr):
+    ''' Parse GTF attribute string into dictionary
+        Attributes are expected to be formatted as 'key "value";' separated by a single
+        space. Values are converted according to ATTRSCHEMA (see convert_attr).
+        Strings that do not follow the expected format, or have values that cannot
+        be converted, are parsed with a regular expression.
+    '''
+    ret = {}
+    s = attrstr.strip()
+    if not s.endswith('";'):
+        return _parse_attrs_re(attrstr) if s else ret
+    try:
+        for tok in s[:-2].split('"; '):
+            k,sep,v = tok.partition(' "')
+            if not sep or ' ' in k or '"' in v:
+                return _parse_attrs_re(attrstr)
+            ret[k] = ATTRSCHEMA.get(k, guess_value)(v)
+    except ValueError:
+        return _parse_attrs_re(attrstr)
+    return ret
+
+class GTFLine(object):
+    ''' Record for one line of a GTF file
+        The attribute string is kept as-is and only parsed into the "attr" dictionary
+        when it is first accessed. Lines that are never inspected are written back out
+        using the original string.
+    '''
     # Columns in a GTF line
     GTFCOLS = ['chrom','source','feature','start','end','score','strand','frame']
     # Attributes that should be at the front of attribute string
     ATTRORDER = ['gene_id', 'transcript_id', 'locus', 'repName']
     
+    __slots__ = ('chrom','source','feature','start','end','score','strand','frame',
+                 '_attrstr','_attr')
+    
     def __init__(self,row):
-        for c,v in zip(self.GTFCOLS, row[:8]):
-            try:
-                setattr(self,c,int(v))
-            except ValueError:
-                setattr(self,c,v)
-        _attrd = dict(re.findall('(\S+)\s+"([\s\S]+?)";',row[8]))
-        self.attr = {}
-        for k,v in _attrd.iteritems():
-            try:
-                self.attr[k] = int(v)
-            except ValueError:
-                try:
-                    self.attr[k] = float(v)
-                except ValueError:
-                    self.attr[k] = v
+        self.chrom, self.source, self.feature = row[0], row[1], row[2]
+        self.start = int(row[3])
+        self.end = int(row[4])
+        self.score = row[5] if row[5] == '.' else guess_int(row[5])
+        self.strand, self.frame = row[6], row[7]
+        self._attrstr = row[8] if len(row) > 8 else ''
+        self._attr = None
+    
+    @property
+    def attr(self):
+        if self._attr is None:
+            self._attr = parse_attrs(self._attrstr)
+        return self._attr
+    
+    @attr.setter
+    def attr(self, d):
+        self._attr = d
     
     def fmt_attrs(self):
+        if self._attr is None:
+            return self._attrstr
         ret = ['%s "%s";' % (k,self.attr[k]) for k in self.ATTRORDER if k in self.attr]
         ret += ['%s "%s";' % (k,v) for k,v in self.attr.iteritems() if k not in self.ATTRORDER]
         return ' '.join(ret)
@@ -68,6 +281,15 @@ class GTFLine:
         else:
             return gdict[self.chrom][self.start:self.end].reverse_complement()
     
+    def copy(self):
+        ''' Return a copy of this line '''
+        ret = GTFLine.__new__(GTFLine)
+        for c in self.__slots__:
+            setattr(ret, c, getattr(self, c))
+        if self._attr is not None:
+            ret._attr = dict(self._attr)
+        return ret
+    
     def asdict(self):
         ret = {k:v for k,v in self.attr.iteritems()}
         ret.update({k:getattr(self,k) for k in self.GTFCOLS})
@@ -76,6 +298,678 @@ class GTFLine:
     def __str__(self):
         return '\t'.join(self.fmt())
 
+def locus_block_gen(infile):
+    ''' Generate (locus, [GTFLine]) for each locus in GTF file
+        Lines are grouped by the "locus" attribute. A locus is complete when a
+        "### <locus> ###" separator is found, when the chromosome changes, or when a
+        line from another locus begins after the end of the locus. The end of the
+        locus is the end of its span line, or the largest end of its lines if the span
+        line has not been read. The input should contain separators or be sorted by
+        position, so memory is proportional to the number of lines in overlapping
+        loci rather than the whole file.
+    '''
+    def _records():
+        for l in infile:
+            if l.startswith('#'):
+                if LOCUS_SEPARATOR.match(l):
+                    yield None
+                continue
+            yield GTFLine(l.strip('\n').split('\t'))
+    return locus_blocks(_records())
+
+def locus_blocks(gtf):
+    ''' Generate (locus, [GTFLine]) for each locus in GTFLine iterable
+        See locus_block_gen. None in gtf is treated as a locus separator.
+    '''
+    openlocs = OrderedDict()
+    locend = {}
+    for g in gtf:
+        if g is None:
+            for locid,locus in openlocs.iteritems():
+                yield locid, locus
+            openlocs.clear()
+            locend.clear()
+            continue
+        locid = g.attr['locus']
+        done = []
+        for k in openlocs:
+            if k == locid: continue
+            if locend[k][0] != g.chrom or locend[k][1] < g.start:
+                done.append(k)
+        for k in done:
+            yield k, openlocs.pop(k)
+            locend.pop(k)
+        # Lines read before the span line (i.e. exons sorted before a span with the
+        # same start) extend the locus until the span line is found
+        chrom, end, hasspan = locend.get(locid, (g.chrom, g.end, False))
+        if g.feature.startswith('span'):
+            locend[locid] = (g.chrom, g.end, True)
+        elif not hasspan:
+            locend[locid] = (g.chrom, max(end, g.end), False)
+        openlocs.setdefault(locid, []).append(g)
+    for locid,locus in openlocs.iteritems():
+        yield locid, locus
+
+def write_locus(outfile, locid, locus):
+    ''' Write locus separator followed by annotations '''
+    print >>outfile, '### %s ###' % locid
+    print >>outfile, '\n'.join(str(_) for _ in locus)
+
+### Columnar GTF #########################################################################
+
+def _factorize(values):
+    ''' Encode values as integer codes
+        Returns (codes, labels) with labels in order of first appearance. None is
+        encoded as -1.
+    '''
+    values = list(values)
+    codes = np.full(len(values), -1, dtype=np.int32)
+    if None in values:
+        idx = [i for i,v in enumerate(values) if v is not None]
+        values = [values[i] for i in idx]
+    else:
+        idx = slice(None)
+    if not values:
+        return codes, []
+    uniq, first, inverse = np.unique(np.array(values, dtype=str), return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(uniq), dtype=np.int32)
+    rank[order] = np.arange(len(uniq), dtype=np.int32)
+    codes[idx] = rank[inverse]
+    return codes, [str(u) for u in uniq[order]]
+
+def _int_array(values):
+    ''' Convert sequence of integer strings to int64 array, raises ValueError '''
+    return np.array(map(int, values), dtype=np.int64)
+
+def _score_array(values, na):
+    ''' Convert GTF scores to int64 array, or float64 if any score is not an integer
+        Missing ('.') and non-numeric scores are na.
+    '''
+    values = [v if v != '.' else na for v in values]
+    try:
+        return _int_array(values)
+    except ValueError:
+        ret = np.empty(len(values), dtype=np.float64)
+        for i,v in enumerate(values):
+            try:
+                ret[i] = float(v)
+            except ValueError:
+                ret[i] = na
+        return ret
+
+def _extract_attr(block, lines, name):
+    ''' Values of attribute in newline-separated attribute strings
+        Each line in block must start with a space, lines is block split into lines.
+        Returns list with the value for each line, None if the attribute is not
+        present.
+    '''
+    needle = ' %s "' % name
+    nfound = block.count(needle)
+    if nfound == 0:
+        return [None] * len(lines)
+    vals = re.findall(re.escape(needle) + '([^"\n]*)";', block)
+    if nfound == len(vals) == len(lines) and all(needle in l for l in lines):
+        # Found exactly once in every line
+        return vals
+    vals = [None] * len(lines)
+    for i,l in enumerate(lines):
+        m = re.search(re.escape(needle) + '([^"]*)";', l)
+        if m is not None:
+            vals[i] = m.group(1)
+    return vals
+
+class GTFTable(object):
+    ''' Column-oriented GTF records backed by numpy arrays
+        String columns (chrom, source, feature, strand, frame) and the categorical rmsk
+        attributes are stored as integer codes into per-column lists of labels; the
+        coordinates, score and numeric rmsk attributes are stored as int64 arrays.
+        Scores are float64 if any score is not an integer.
+        Missing values are -1 for categorical codes and GTFTable.NA for integers.
+        The raw attribute strings are kept so that rows can be viewed as GTFLine.
+    '''
+    NA = -2**62
+    CATCOLS = ['chrom','source','feature','strand','frame']
+    INTCOLS = ['start','end','score']
+    INTATTRS = ['repStart','repEnd','repLeft']
+    CATATTRS = ['repName','geneRegion','locus']
+    
+    def __init__(self, cols, levels, attrstrs):
+        self.cols = cols
+        self.levels = levels
+        self.attrstrs = attrstrs
+    
+    @classmethod
+    def from_rows(cls, rows, catattrs=()):
+        ''' Create table from split GTF lines, i.e. output of tab_line_gen
+            Columns are converted with numpy. Attributes are extracted from the block
+            of attribute strings with one regular expression search per attribute,
+            rows are only parsed individually if a value cannot be converted.
+            Attributes in catattrs are stored as categorical columns in addition to
+            CATATTRS.
+        '''
+        rows = [r if len(r) >= 9 else r + [''] * (9 - len(r)) for r in rows]
+        fields = zip(*rows) if rows else [()] * 9
+        attrstrs = list(fields[8])
+        # Leading space so that every attribute name follows a space
+        block = ' ' + '\n '.join(attrstrs)
+        lines = block.split('\n') if rows else []
+        cols, levels = {}, {}
+        for c in cls.CATCOLS:
+            cols[c], levels[c] = _factorize(fields[GTFLine.GTFCOLS.index(c)])
+        for c in cls.CATATTRS + [c for c in catattrs if c not in cls.CATATTRS]:
+            cols[c], levels[c] = _factorize(_extract_attr(block, lines, c))
+        cols['start'] = _int_array(fields[3])
+        cols['end'] = _int_array(fields[4])
+        cols['score'] = _score_array(fields[5], cls.NA)
+        for c in cls.INTATTRS:
+            vals = _extract_attr(block, lines, c)
+            missing = np.array([v is None for v in vals], dtype=bool)
+            try:
+                arr = _int_array([v if v is not None else '0' for v in vals])
+            except ValueError:
+                # Values that are not integers are converted as by parse_attrs
+                arr = np.array([parse_attrs(a).get(c, cls.NA) for a in attrstrs], dtype=np.int64)
+            arr[missing] = cls.NA
+            cols[c] = arr
+        return cls(cols, levels, attrstrs)
+    
+    @classmethod
+    def from_lines(cls, gtf):
+        ''' Create table from GTFLine objects '''
+        return cls.from_rows(g.fmt() for g in gtf)
+    
+    @classmethod
+    def concat(cls, tables):
+        ''' Concatenate tables
+            Categorical codes are remapped so that labels are in order of first
+            appearance, as if the rows had been loaded with from_rows. Categorical
+            columns missing from some of the tables are dropped.
+        '''
+        catcols = [c for c in tables[0].levels if all(c in t.levels for t in tables)]
+        cols, levels = {}, {}
+        for c in catcols:
+            labels, index, codes = [], {}, []
+            for t in tables:
+                remap = np.full(len(t.levels[c]) + 1, -1, dtype=np.int32)
+                for i,l in enumerate(t.levels[c]):
+                    if l not in index:
+                        index[l] = len(labels)
+                        labels.append(l)
+                    remap[i] = index[l]
+                # Missing values (-1) index the last element, which stays -1
+                codes.append(remap[t.cols[c]])
+            cols[c], levels[c] = np.concatenate(codes), labels
+        for c in cls.INTCOLS + cls.INTATTRS:
+            cols[c] = np.concatenate([t.cols[c] for t in tables])
+        attrstrs = [a for t in tables for a in t.attrstrs]
+        return cls(cols, levels, attrstrs)
+    
+    def add_catattrs(self, catattrs):
+        ''' Add categorical columns for attributes in catattrs that are not stored '''
+        new = [c for c in catattrs if c not in self.levels]
+        if not new:
+            return
+        attrstrs = list(self.attrstrs)
+        block = ' ' + '\n '.join(attrstrs)
+        lines = block.split('\n') if attrstrs else []
+        self.cols, self.levels = dict(self.cols), dict(self.levels)
+        for c in new:
+            self.cols[c], self.levels[c] = _factorize(_extract_attr(block, lines, c))
+    
+    @classmethod
+    def chunks(cls, rows, chunksize=500000):
+        ''' Generate tables with up to chunksize rows each from split GTF lines '''
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, chunksize))
+            if not chunk:
+                return
+            yield cls.from_rows(chunk)
+    
+    def __len__(self):
+        return len(self.attrstrs)
+    
+    def __getitem__(self, col):
+        return self.cols[col]
+    
+    def __iter__(self):
+        return (self.line(i) for i in xrange(len(self)))
+    
+    def code(self, col, label):
+        ''' Return code for label in categorical column, -1 if not present '''
+        try:
+            return self.levels[col].index(label)
+        except ValueError:
+            return -1
+    
+    def take(self, idx):
+        ''' Return new table with rows at indices (or boolean mask) idx '''
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        cols = {c:v[idx] for c,v in self.cols.iteritems()}
+        return GTFTable(cols, self.levels, [self.attrstrs[i] for i in idx])
+    
+    def filter(self, mask):
+        ''' Return new table with rows where mask is True '''
+        return self.take(mask)
+    
+    def sort(self, chroms=None):
+        ''' Return new table sorted by chromosome then start position
+            Chromosomes are ordered by chroms (if provided) or by name. Rows on
+            chromosomes not listed in chroms are removed.
+        '''
+        if chroms is None:
+            chroms = sorted(self.levels['chrom'])
+        rank = np.full(len(self.levels['chrom']), -1, dtype=np.int64)
+        for i,c in enumerate(chroms):
+            cc = self.code('chrom', c)
+            if cc >= 0: rank[cc] = i
+        crank = rank[self.cols['chrom']]
+        order = np.lexsort((self.cols['start'], crank))
+        return self.take(order[crank[order] >= 0])
+    
+    def groupby(self, col):
+        ''' Generate (label, indices) for each value of categorical column
+            Groups are in order of label code, rows within each group are in table
+            order. Rows with missing values are not included.
+        '''
+        codes = self.cols[col]
+        order = np.argsort(codes, kind='mergesort')
+        scodes = codes[order]
+        bounds = np.flatnonzero(np.diff(scodes)) + 1
+        for idx in np.split(order, bounds):
+            if len(idx) and codes[idx[0]] >= 0:
+                yield self.levels[col][codes[idx[0]]], idx
+    
+    def score_strs(self, idx):
+        ''' Formatted scores for rows at indices idx, '.' for missing scores '''
+        score = self.cols['score'][idx]
+        if score.dtype.kind == 'i':
+            return np.where(score != self.NA, score.astype(str), '.')
+        return np.array([self.score_str(v) for v in score], dtype=object)
+    
+    @classmethod
+    def score_str(cls, v):
+        ''' Format score value, '.' if missing '''
+        if v == cls.NA:
+            return '.'
+        return '%d' % v if float(v).is_integer() else repr(float(v))
+    
+    def row(self, i):
+        ''' Return the GTF fields for row i '''
+        lv, cv = self.levels, self.cols
+        return [lv['chrom'][cv['chrom'][i]], lv['source'][cv['source'][i]],
+                lv['feature'][cv['feature'][i]], str(cv['start'][i]), str(cv['end'][i]),
+                self.score_str(cv['score'][i]),
+                lv['strand'][cv['strand'][i]], lv['frame'][cv['frame'][i]],
+                self.attrstrs[i]]
+    
+    def line(self, i):
+        ''' Return row i as GTFLine
+            The GTFLine is a copy, changes are not reflected in the table.
+        '''
+        return GTFLine(self.row(i))
+    
+    def lines(self, idx=None):
+        ''' Return list of GTFLine for rows at indices idx (default all rows) '''
+        if idx is None: idx = xrange(len(self))
+        return [self.line(i) for i in idx]
+
+### GTF parse cache ######################################################################
+# Parsed GTFTables are stored in a ".gtfcache" directory next to the source file, one
+# subdirectory per source. Columns are saved as .npy files so that they can be memory
+# mapped. The total size of each cache directory is limited to GTFCACHE_MAXSIZE bytes;
+# least recently used entries are removed first. Set GTFCACHE=0 to disable.
+
+GTFCACHE_NAME = '.gtfcache'
+GTFCACHE_MAXSIZE = int(os.environ.get('GTFCACHE_MAXSIZE', 2 * 1024**3))
+
+class _AttrBlob(object):
+    ''' Sequence of attribute strings stored in a single byte array '''
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i+1]].tostring()
+
+def gtf_cache_dir(path):
+    ''' Cache directory for GTF file at path '''
+    return os.path.join(os.path.dirname(os.path.abspath(path)), GTFCACHE_NAME)
+
+def gtf_cache_entry(path):
+    ''' Cache entry (directory) for GTF file at path '''
+    abspath = os.path.abspath(path)
+    key = hashlib.sha1(abspath).hexdigest()[:16]
+    return os.path.join(gtf_cache_dir(path), '%s.%s' % (os.path.basename(abspath), key))
+
+def file_sha1(path):
+    ''' SHA1 digest of file contents '''
+    h = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _open_gtf(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rU')
+
+def save_gtf_cache(table, entry, meta):
+    ''' Write GTFTable to cache entry '''
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(entry))
+    for c,v in table.cols.iteritems():
+        np.save(os.path.join(tmpdir, '%s.npy' % c), v)
+    offsets = np.zeros(len(table) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(a) for a in table.attrstrs])
+    np.save(os.path.join(tmpdir, 'attr_offsets.npy'), offsets)
+    np.save(os.path.join(tmpdir, 'attr_blob.npy'),
+            np.frombuffer(''.join(table.attrstrs), dtype=np.uint8))
+    meta = dict(meta, levels=table.levels)
+    with open(os.path.join(tmpdir, 'meta.json'), 'w') as outh:
+        json.dump(meta, outh)
+    if os.path.exists(entry):
+        shutil.rmtree(entry)
+    os.rename(tmpdir, entry)
+
+def load_gtf_cache(entry):
+    ''' Load GTFTable from cache entry, columns are memory mapped '''
+    with open(os.path.join(entry, 'meta.json')) as fh:
+        meta = json.load(fh)
+    levels = {c:[str(v) for v in l] for c,l in meta['levels'].iteritems()}
+    cols = {c:np.load(os.path.join(entry, '%s.npy' % c), mmap_mode='r') for c in levels}
+    cols.update({c:np.load(os.path.join(entry, '%s.npy' % c), mmap_mode='r')
+                 for c in GTFTable.INTCOLS + GTFTable.INTATTRS})
+    attrstrs = _AttrBlob(np.load(os.path.join(entry, 'attr_blob.npy'), mmap_mode='r'),
+                         np.load(os.path.join(entry, 'attr_offsets.npy'), mmap_mode='r'))
+    return GTFTable(cols, levels, attrstrs)
+
+def _check_gtf_cache(path, entry):
+    ''' Return True if cache entry is valid for file at path
+        Entries match if the file size and modification time are unchanged. If only
+        the modification time differs, the content hash is compared.
+    '''
+    try:
+        with open(os.path.join(entry, 'meta.json')) as fh:
+            meta = json.load(fh)
+    except (IOError, ValueError):
+        return False
+    st = os.stat(path)
+    if meta['size'] != st.st_size or meta['path'] != os.path.abspath(path):
+        return False
+    if meta['mtime'] != st.st_mtime:
+        if meta['sha1'] != file_sha1(path):
+            return False
+        meta['mtime'] = st.st_mtime
+        with open(os.path.join(entry, 'meta.json'), 'w') as outh:
+            json.dump(meta, outh)
+    return True
+
+def evict_gtf_cache(cachedir, maxsize=None):
+    ''' Remove least recently used entries until cache is smaller than maxsize '''
+    if maxsize is None: maxsize = GTFCACHE_MAXSIZE
+    entries = list_gtf_cache(cachedir)
+    total = sum(e[2] for e in entries)
+    for entry, used, size in sorted(entries, key=lambda x:x[1]):
+        if total <= maxsize: break
+        shutil.rmtree(entry)
+        total -= size
+
+def list_gtf_cache(cachedir):
+    ''' Return (entry, last used, size) for entries in cache directory '''
+    ret = []
+    if not os.path.isdir(cachedir):
+        return ret
+    for n in os.listdir(cachedir):
+        entry = os.path.join(cachedir, n)
+        if not os.path.exists(os.path.join(entry, 'meta.json')): continue
+        size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        ret.append((entry, os.path.getmtime(os.path.join(entry, 'meta.json')), size))
+    return ret
+
+def invalidate_gtf_cache(path):
+    ''' Remove cache entry for GTF file at path. Returns True if entry existed '''
+    entry = gtf_cache_entry(path)
+    if os.path.isdir(entry):
+        shutil.rmtree(entry)
+        return True
+    return False
+
+def read_gtf_table(infile, cache=None, catattrs=()):
+    ''' Load GTF into GTFTable
+        infile is a filename or file object. Regular files are loaded from the parse
+        cache if possible, otherwise they are parsed and added to the cache. Streams
+        such as stdin are always parsed. Attributes in catattrs are stored as
+        categorical columns (see GTFTable.from_rows).
+    '''
+    if cache is None:
+        cache = os.environ.get('GTFCACHE', '1') != '0'
+    path = infile if isinstance(infile, basestring) else getattr(infile, 'name', None)
+    if not cache or path is None or not os.path.isfile(path):
+        fh = _open_gtf(infile) if isinstance(infile, basestring) else infile
+        return GTFTable.from_rows(tab_line_gen(fh), catattrs)
+    
+    entry = gtf_cache_entry(path)
+    if _check_gtf_cache(path, entry):
+        os.utime(os.path.join(entry, 'meta.json'), None)
+        table = load_gtf_cache(entry)
+        table.add_catattrs(catattrs)
+        return table
+    
+    with _open_gtf(path) as fh:
+        table = GTFTable.from_rows(tab_line_gen(fh), catattrs)
+    st = os.stat(path)
+    meta = {'path': os.path.abspath(path), 'size': st.st_size, 'mtime': st.st_mtime,
+            'sha1': file_sha1(path)}
+    try:
+        if not os.path.isdir(gtf_cache_dir(path)):
+            os.makedirs(gtf_cache_dir(path))
+        save_gtf_cache(table, entry, meta)
+        evict_gtf_cache(gtf_cache_dir(path))
+    except (IOError, OSError) as e:
+        print >>sys.stderr, 'Warning: unable to write GTF cache for %s: %s' % (path, e)
+    return table
+
+### RepeatMasker store ###################################################################
+
+# Columns of the UCSC rmsk table, the database dump (rmsk.txt.gz) has no header
+RMSK_COLUMNS = ['bin', 'swScore', 'milliDiv', 'milliDel', 'milliIns', 'genoName',
+                'genoStart', 'genoEnd', 'genoLeft', 'strand', 'repName', 'repClass',
+                'repFamily', 'repStart', 'repEnd', 'repLeft', 'id']
+RMSK_TEXTCOLS = set(['genoName', 'strand', 'repName', 'repClass', 'repFamily'])
+
+class RmskStore(object):
+    ''' RepeatMasker table stored in SQLite database
+        The database is built once per assembly from the UCSC rmsk table dump (see
+        build). Records are indexed by repName, repFamily, and (genoName, genoStart).
+        Query methods return records as lists of strings in RMSK_COLUMNS order, the
+        same as lines of the UCSC table split on tabs, in the order of the table.
+    '''
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise IOError('RepeatMasker store %s does not exist' % path)
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self.con.text_factory = str
+        self.meta = dict(self.con.execute('SELECT key, value FROM meta'))
+        self.maxlen = int(self.meta['maxlen'])
+    
+    @classmethod
+    def build(cls, path, rmskfile, assembly=None, batchsize=100000):
+        ''' Create store at path from lines of UCSC rmsk table '''
+        if os.path.exists(path):
+            os.remove(path)
+        con = sqlite3.connect(path)
+        con.text_factory = str
+        coldefs = ', '.join('%s %s' % (c, 'TEXT' if c in RMSK_TEXTCOLS else 'INTEGER') for c in RMSK_COLUMNS)
+        con.execute('PRAGMA journal_mode = OFF')
+        con.execute('PRAGMA synchronous = OFF')
+        con.execute('CREATE TABLE rmsk (%s)' % coldefs)
+        con.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        insert = 'INSERT INTO rmsk VALUES (%s)' % ', '.join('?' * len(RMSK_COLUMNS))
+        sidx, eidx = RMSK_COLUMNS.index('genoStart'), RMSK_COLUMNS.index('genoEnd')
+        maxlen, nrows, batch = 0, 0, []
+        for l in tab_line_gen(rmskfile):
+            if l[0] == 'bin': continue # Header from MySQL output
+            batch.append(l)
+            maxlen = max(maxlen, int(l[eidx]) - int(l[sidx]))
+            if len(batch) >= batchsize:
+                con.executemany(insert, batch)
+                nrows += len(batch)
+                batch = []
+        con.executemany(insert, batch)
+        nrows += len(batch)
+        con.execute('CREATE INDEX rmsk_repName ON rmsk (repName)')
+        con.execute('CREATE INDEX rmsk_repFamily ON rmsk (repFamily)')
+        con.execute('CREATE INDEX rmsk_pos ON rmsk (genoName, genoStart)')
+        con.executemany('INSERT INTO meta VALUES (?, ?)',
+                        [('assembly', assembly or ''), ('rows', str(nrows)), ('maxlen', str(maxlen))])
+        con.commit()
+        con.close()
+        return cls(path)
+    
+    def _fetch(self, where, params):
+        sql = 'SELECT %s FROM rmsk WHERE %s ORDER BY rowid' % (', '.join(RMSK_COLUMNS), where)
+        return [[str(v) for v in r] for r in self.con.execute(sql, params)]
+    
+    def models(self, names):
+        ''' Records for models (repName) in names '''
+        names = list(names)
+        return self._fetch('repName IN (%s)' % ', '.join('?' * len(names)), names)
+    
+    def families(self, names):
+        ''' Records for repeat families (repFamily) in names '''
+        names = list(names)
+        return self._fetch('repFamily IN (%s)' % ', '.join('?' * len(names)), names)
+    
+    def region(self, chrom, start, end, names=None):
+        ''' Records overlapping region, optionally only for models in names
+            Coordinates are 0-based, half-open as in the UCSC table.
+        '''
+        # genoStart is indexed, records starting before start - maxlen cannot overlap
+        where = 'genoName = ? AND genoStart >= ? AND genoStart < ? AND genoEnd > ?'
+        params = [chrom, start - self.maxlen, end, start]
+        if names is not None:
+            names = list(names)
+            where += ' AND repName IN (%s)' % ', '.join('?' * len(names))
+            params += names
+        return self._fetch(where, params)
+    
+    def write_table(self, outfile, rows):
+        ''' Write records with header, same format as the UCSC MySQL output '''
+        write_lines(outfile, ['\t'.join(RMSK_COLUMNS)] + ['\t'.join(r) for r in rows])
+    
+    def close(self):
+        self.con.close()
+
+_RMSK_STORES = {}
+
+def open_rmsk_store(path):
+    ''' Open RmskStore, connections are reused for each path '''
+    key = os.path.abspath(path)
+    if key not in _RMSK_STORES:
+        _RMSK_STORES[key] = RmskStore(path)
+    return _RMSK_STORES[key]
+
+### Interval joins #######################################################################
+
+def read_chrom_sizes(infile):
+    ''' Return OrderedDict with chromosome sizes from tab-delimited file '''
+    return OrderedDict((l[0], int(l[1])) for l in tab_line_gen(infile) if len(l) > 1)
+
+def flank_join(spans, hits, flank=0, chromsizes=None, stranded=True):
+    ''' Find hits overlapping spans extended by flank on both sides
+        Equivalent to "bedtools slop -b flank" followed by "bedtools intersect -wo"
+        (with -s if stranded is True). Extended spans are clipped to the chromosome
+        sizes in chromsizes. Spans and hits are sorted by position and compared in a
+        single sweep for each chromosome (and strand).
+        Generates (span, [hits]) for every span in order of position; hits are in
+        order of start position.
+    '''
+    def _key(g):
+        return (g.chrom, g.strand) if stranded else g.chrom
+    
+    byhits = defaultdict(list)
+    for h in hits:
+        byhits[_key(h)].append(h)
+    for l in byhits.itervalues():
+        l.sort(key=lambda x:x.start)
+    
+    crank = {}
+    for s in spans:
+        crank.setdefault(s.chrom, len(crank))
+    # Index of next hit and hits that may overlap current span, per key
+    nexthit = defaultdict(int)
+    active = defaultdict(list)
+    for s in sorted(spans, key=lambda x:(crank[x.chrom], x.start)):
+        fs = max(1, s.start - flank)
+        fe = s.end + flank
+        if chromsizes is not None and s.chrom in chromsizes:
+            fe = min(chromsizes[s.chrom], fe)
+        k = _key(s)
+        cand = byhits[k]
+        j = nexthit[k]
+        while j < len(cand) and cand[j].start <= fe:
+            active[k].append(cand[j])
+            j += 1
+        nexthit[k] = j
+        # Hits ending before this span cannot overlap later spans
+        active[k] = [h for h in active[k] if h.end >= fs]
+        yield s, [h for h in active[k] if h.start <= fe]
+
+### Cytogenetic bands ####################################################################
+
+class CytobandIndex(object):
+    ''' Index for finding cytogenetic bands that overlap genomic intervals
+        Bands are stored per chromosome as arrays sorted by start position. The band
+        name is the chromosome (without "chr") followed by the gene_id attribute,
+        i.e. "1p36.33".
+    '''
+    def __init__(self, bands):
+        bychrom = defaultdict(list)
+        for b in bands:
+            name = '%s%s' % (b.chrom.strip('chr'), b.attr['gene_id'])
+            bychrom[b.chrom].append((b.start, b.end, name))
+        self.starts, self.maxends, self.ends, self.names = {}, {}, {}, {}
+        for chrom, l in bychrom.iteritems():
+            l.sort()
+            self.starts[chrom] = np.array([b[0] for b in l], dtype=np.int64)
+            self.ends[chrom] = np.array([b[1] for b in l], dtype=np.int64)
+            # Running maximum of end positions, bands overlapping [s, e] are between
+            # the first band with maxend >= s and the last band with start <= e
+            self.maxends[chrom] = np.maximum.accumulate(self.ends[chrom])
+            self.names[chrom] = [b[2] for b in l]
+    
+    def assign(self, spans):
+        ''' Return list with names of bands overlapping each annotation in spans '''
+        ret = [[] for _ in spans]
+        bychrom = defaultdict(list)
+        for i,g in enumerate(spans):
+            bychrom[g.chrom].append(i)
+        for chrom, idx in bychrom.iteritems():
+            if chrom not in self.starts: continue
+            starts = np.array([spans[i].start for i in idx], dtype=np.int64)
+            ends = np.array([spans[i].end for i in idx], dtype=np.int64)
+            lo = np.searchsorted(self.maxends[chrom], starts, 'left')
+            hi = np.searchsorted(self.starts[chrom], ends, 'right')
+            bends, names = self.ends[chrom], self.names[chrom]
+            for i,s,l,h in zip(idx, starts, lo, hi):
+                ret[i] = [names[j] for j in xrange(l, h) if bends[j] >= s]
+        return ret
+
+_CYTOBAND_INDEX = {}
+
+def load_cytoband_index(path):
+    ''' Load CytobandIndex from cytoband GTF, indexes are cached by path '''
+    key = os.path.abspath(path)
+    if key not in _CYTOBAND_INDEX:
+        _CYTOBAND_INDEX[key] = CytobandIndex(read_gtf_table(path))
+    return _CYTOBAND_INDEX[key]
+
 ### Manipulate locus #####################################################################
 
 def remove_dups(_locus):
@@ -93,16 +987,27 @@ def create_spanning(_locus, feat='span'):
     spanning.end = max(a.end for a in _locus)
     return spanning
 
+def position_key(strand):
+    ''' Sort key for annotations within locus, in order of position on strand
+        Plus strand annotations are ordered by start then end, minus strand
+        annotations by end then start from right to left. Ties are broken by the id
+        attribute, so the order does not depend on input order.
+    '''
+    if strand == '+':
+        return lambda x:(x.start, x.end, x.attr['id'])
+    return lambda x:(-x.end, -x.start, x.attr['id'])
+
 def adjust_overlaps(_locus, strand=None):
     ''' Adjust annotations within locus to eliminate overlaps
         For overlapping annotations on the plus strand, the start position of the second
         annotation is adjusted so that it begins after the first annotation ends.
         The same is true for the minus strand, except we are adjusting the end position
-        and annotations are considered from right to left.
+        and annotations are considered from right to left. Annotations are ordered
+        with position_key.
     '''
     if strand is None: strand = _locus[0].strand
+    _locus.sort(key=position_key(strand))
     if strand == '+':
-        _locus.sort(key=lambda x:x.start)
         for i,p1 in enumerate(_locus[1:]):
             p0 = _locus[i]
             gdist = p1.start - p0.end
@@ -110,7 +1015,6 @@ def adjust_overlaps(_locus, strand=None):
                 p1.start = p1.start - gdist + 1
                 p1.attr['repStart'] = p1.attr['repStart'] - gdist
     else:
-        _locus.sort(key=lambda x:x.end, reverse=True)
         for i,p1 in enumerate(_locus[1:]):
             p0 = _locus[i]
             gdist = p0.start - p1.end
@@ -121,13 +1025,95 @@ def adjust_overlaps(_locus, strand=None):
     return _locus
 
 def guess_rmsk_model_lengths(gtf):
-    ''' Calculate the length of models from attributes '''
-    ret = defaultdict(list)
-    for g in gtf:
+    ''' Calculate the length of models from attributes
+        The most common length is used for each repName, ties are broken as by
+        Counter.most_common (see select_model_lengths).
+    '''
+    if isinstance(gtf, GTFTable):
+        return _table_model_lengths(gtf)
+    counts = {}
+    for i,g in enumerate(gtf):
         if 'repName' in g.attr:
             sz = (g.attr['repEnd'] - g.attr['repLeft']) if g.strand == '+' else (g.attr['repEnd'] - g.attr['repStart'])
-            ret[g.attr['repName']].append(sz)
-    return {k:Counter(v).most_common()[0][0] for k,v in ret.iteritems()}
+            key = (g.attr['repName'], sz)
+            if key in counts:
+                counts[key][0] += 1
+            else:
+                counts[key] = [1, i]
+    return select_model_lengths(counts)
+
+def _table_model_lengths(table):
+    ''' Most common model length for each repName in GTFTable '''
+    return select_model_lengths(count_model_lengths(table))
+
+def rmsk_model_sizes(table):
+    ''' Model length given by the rmsk coordinates of each row in GTFTable '''
+    plus = table['strand'] == table.code('strand', '+')
+    return np.where(plus, table['repEnd'] - table['repLeft'], table['repEnd'] - table['repStart'])
+
+def count_model_lengths(table, counts=None, offset=0):
+    ''' Count model lengths for each repName in GTFTable
+        counts maps (repName, length) to [count, first row]. Rows are numbered
+        starting at offset, so counts can be accumulated over consecutive tables.
+    '''
+    counts = {} if counts is None else counts
+    has = np.flatnonzero(table['repName'] >= 0)
+    names, sz = table['repName'][has], rmsk_model_sizes(table)[has]
+    if len(names) == 0:
+        return counts
+    # Count runs of identical (repName, size), first row of each run is its first occurrence
+    order = np.lexsort((sz, names))
+    names, sz, rows = names[order], sz[order], has[order]
+    runstart = np.flatnonzero(np.r_[True, (np.diff(names) != 0) | (np.diff(sz) != 0)])
+    runcounts = np.diff(np.r_[runstart, len(names)])
+    for n,s,c,f in zip(names[runstart], sz[runstart], runcounts, rows[runstart]):
+        key = (table.levels['repName'][n], int(s))
+        if key in counts:
+            counts[key][0] += int(c)
+        else:
+            counts[key] = [int(c), offset + int(f)]
+    return counts
+
+def select_model_lengths(counts):
+    ''' Select most common length for each repName from count_model_lengths
+        Lengths are added to a Counter in order of first occurrence, so ties are
+        broken by Counter.most_common in the same way as counting every hit.
+    '''
+    bymodel = defaultdict(list)
+    for (name, sz), (c, first) in counts.iteritems():
+        bymodel[name].append((first, sz, c))
+    ret = {}
+    for name, l in bymodel.iteritems():
+        szcounts = Counter()
+        for first, sz, c in sorted(l):
+            szcounts[sz] = c
+        ret[name] = szcounts.most_common()[0][0]
+    return ret
+
+def write_model_lengths(fn, mlen, update=False):
+    ''' Write model lengths table, tab-separated repName and length
+        If update is True, lengths already in fn for other models are kept.
+    '''
+    if update and os.path.exists(fn):
+        mlen = dict(read_model_lengths(fn), **mlen)
+    with open(fn + '.tmp', 'w') as outh:
+        write_lines(outh, ('%s\t%d' % (k, mlen[k]) for k in sorted(mlen)))
+    os.rename(fn + '.tmp', fn)
+
+def read_model_lengths(fn):
+    ''' Read model lengths table written by write_model_lengths '''
+    with open(fn, 'rU') as fh:
+        return {l[0]:int(l[1]) for l in tab_line_gen(fh) if len(l) > 1}
+
+_MODEL_LENGTHS = {}
+
+def load_model_lengths(fn):
+    ''' Load model lengths table, tables are cached by path and reloaded if changed '''
+    key = os.path.abspath(fn)
+    mtime = os.path.getmtime(fn)
+    if key not in _MODEL_LENGTHS or _MODEL_LENGTHS[key][0] != mtime:
+        _MODEL_LENGTHS[key] = (mtime, read_model_lengths(fn))
+    return _MODEL_LENGTHS[key][1]
 
 def get_span(_locus):
     spn = [a for a in _locus if a.feature.startswith('span')]
@@ -145,16 +1131,37 @@ def raw_input_stderr(*args):
     sys.stdout = sys.__stdout__
     return x    
 
-def find_overlaps(gtf):
-    ''' Find overlapping annotations within GTF '''
-    # Cluster the "span" lines using bedtools cluster
-    p1 = Popen('bedtools cluster -i -', shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    o,e = p1.communicate(input='\n'.join(str(g) for g in gtf))
-    # Parse bedtools output
-    _clust = defaultdict(list)
-    for l in tab_line_gen(o.strip('\n').split('\n')):
-        _clust[l[-1]].append(GTFLine(l[:9]))
-    return _clust
+def cluster_intervals(gtf, stranded=False, maxdist=0):
+    ''' Cluster annotations that overlap or are within maxdist of each other
+        Clusters are assigned in the same way as "bedtools cluster" (with -s if
+        stranded is True and -d maxdist). Book-ended annotations are clustered when
+        maxdist is 0. Annotations are sorted by chromosome (in order of appearance) and
+        start position before clustering.
+        Returns a list of clusters, each a list of the original annotations.
+    '''
+    crank = {}
+    for g in gtf:
+        crank.setdefault(g.chrom, len(crank))
+    clusters = []
+    # Current cluster for each strand: [chrom, end, members]
+    current = {}
+    for g in sorted(gtf, key=lambda x:(crank[x.chrom], x.start)):
+        key = g.strand if stranded else None
+        cur = current.get(key)
+        if cur is None or cur[0] != g.chrom or (g.start - 1) - cur[1] > maxdist:
+            cur = current[key] = [g.chrom, g.end, []]
+            clusters.append(cur[2])
+        elif g.end > cur[1]:
+            cur[1] = g.end
+        cur[2].append(g)
+    return clusters
+
+def find_overlaps(gtf, stranded=False, maxdist=0):
+    ''' Find overlapping annotations within GTF
+        Returns dictionary mapping cluster number (as string, starting at 1) to list of
+        annotations in cluster.
+    '''
+    return {str(i+1):c for i,c in enumerate(cluster_intervals(gtf, stranded, maxdist))}
 
 def groupstr(k,cgroup):
     ret = "### Overlap group %s ###\n" % k